@@ -0,0 +1,100 @@
+// Microbenchmark of the cost record.cpp adds to each instrumented call.
+//
+// Each thread calls an empty function in a loop and times the loop. The makefile builds this
+// program without instrumentation and with -finstrument-functions and record.o, and runs the
+// instrumented build with recording off (RECORD_CCT unset) and with each recording format (see:
+// make bench-record):
+//   recordBenchmark [build label] [calls per thread] [max threads]
+//
+// For 1, 2, 4, ... up to max threads, one JSON object per line is printed:
+//   {"build": "instrumented", "recording": true, "format": "binary", "timestamps": false,
+//    "threads": 2, "callsPerThread": 1000000, "nsPerCall": 244.2, "callsPerSecond": 4021604.7}
+// format is "none" when not recording.
+// nsPerCall is the average time of one call (and its entering and exiting events) on a thread, and
+// callsPerSecond is the number of calls made by every thread together per second of wall time.
+
+#include <atomic>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <string>
+#include <thread>
+#include <vector>
+
+// Keeps the compiler from removing the benchmarked calls.
+static std::atomic<uint64_t> g_sink(0);
+
+__attribute__((noinline))
+void benchmarkedCall(uint64_t value) {
+  asm volatile("" : : "r"(value) : "memory");
+}
+
+__attribute__((no_instrument_function))
+static uint64_t nowNs() {
+  return std::chrono::duration_cast<std::chrono::nanoseconds>(
+      std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+// Makes calls calls and stores the time they took in *elapsed_ns.
+void callLoop(uint64_t calls, uint64_t* elapsed_ns) {
+  uint64_t start = nowNs();
+  for (uint64_t i = 0; i < calls; i++)
+    benchmarkedCall(i);
+  *elapsed_ns = nowNs() - start;
+  g_sink.fetch_add(calls, std::memory_order_relaxed);
+}
+
+__attribute__((no_instrument_function))
+static const char* environmentValue(const char* variable, const char* default_value) {
+  const char* value = std::getenv(variable);
+  return value && *value ? value : default_value;
+}
+
+// Thread counts double up to max_threads, which is always measured.
+__attribute__((no_instrument_function))
+static unsigned nextThreadCount(unsigned threads, unsigned max_threads) {
+  if (threads < max_threads && threads * 2 > max_threads)
+    return max_threads;
+  return threads * 2;
+}
+
+int main(int argc, char** argv) {
+  if (argc != 4) {
+    fprintf(stderr, "Usage: %s [build label] [calls per thread] [max threads]\n", argv[0]);
+    return 1;
+  }
+  const char* build = argv[1];
+  uint64_t calls = std::strtoull(argv[2], nullptr, 10);
+  unsigned max_threads = std::strtoul(argv[3], nullptr, 10);
+  bool recording = std::getenv("RECORD_CCT") != nullptr;
+  const char* format = environmentValue("RECORD_CCT_FORMAT", "text");
+  const char* timestamps = environmentValue("RECORD_CCT_TIMESTAMPS", "0");
+  bool timed = recording && std::string(timestamps) != "0";
+
+  // Warm up, so the first measurement does not include registering the main thread.
+  uint64_t warmup_ns;
+  callLoop(calls / 10 + 1, &warmup_ns);
+
+  for (unsigned threads = 1; threads <= max_threads; threads = nextThreadCount(threads, max_threads)) {
+    std::vector<uint64_t> elapsed_ns(threads);
+    std::vector<std::thread> workers;
+    uint64_t start = nowNs();
+    for (unsigned thread = 0; thread < threads; thread++)
+      workers.emplace_back(callLoop, calls, &elapsed_ns[thread]);
+    for (std::thread& worker : workers)
+      worker.join();
+    uint64_t wall_ns = nowNs() - start;
+
+    double total_ns = 0;
+    for (uint64_t ns : elapsed_ns)
+      total_ns += ns;
+    double ns_per_call = total_ns / threads / calls;
+    double calls_per_second = wall_ns ? calls * threads * 1e9 / wall_ns : 0;
+    printf("{\"build\": \"%s\", \"recording\": %s, \"format\": \"%s\", \"timestamps\": %s, "
+           "\"threads\": %u, \"callsPerThread\": %llu, \"nsPerCall\": %.2f, \"callsPerSecond\": %.1f}\n",
+           build, recording ? "true" : "false", recording ? format : "none", timed ? "true" : "false",
+           threads, static_cast<unsigned long long>(calls), ns_per_call, calls_per_second);
+    fflush(stdout);
+  }
+  return 0;
+}
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# benchmark.py - benchmark the calling context tree analysis pipeline on synthetic recordings.
+#
+# Recordings are generated with a given number of events, call depth, fan-out, threads, function
+# names and divergence rate, and each stage of the pipeline (parsing, JSON encoding, demangling,
+# comparing and stats) is timed in its own process so that its peak memory can be measured. The
+# results can be saved as a baseline and later runs compared against it.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import compare
+from cct import CCT, CompactCCT
+from demangler import Demangler
+from profiling import peakRss
+import stats
+
+DEFAULT_BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "baseline.json")
+
+# Number of events written for a thread before switching to the next thread.
+_THREAD_EVENTS_PER_TURN = 256
+
+# Return nameCount distinct mangled function names (e.g., _Z2f0v, which demangles to f0()).
+def _functionNames(nameCount):
+    names = []
+    for index in xrange(nameCount):
+        name = "f" + str(index)
+        names.append("_Z" + str(len(name)) + name + "v")
+    return names
+
+# Yield (isEntering, functionName) events of one thread, eventCount rounded down to an even number
+# in all. The thread's calls are made from a single thread function. Every other call makes up to
+# fanOut calls, and calls are only nested depth deep. structureRandom decides the shape of the
+# calls and their names, and divergenceRandom decides which calls are made to another name
+# instead, so recordings generated with the same structureRandom seed have the same shape whatever
+# their divergence rate.
+def _threadEvents(threadName, eventCount, depth, fanOut, names, divergenceRate, structureRandom, divergenceRandom):
+    if eventCount < 2:
+        return
+    # Each call being made, as [name, number of calls left to make].
+    stack = [[threadName, eventCount]]
+    remainingEvents = eventCount - 1
+    yield True, threadName
+    while stack:
+        call = stack[-1]
+        # There must be enough events left to exit every call being made.
+        if call[1] > 0 and len(stack) < depth and remainingEvents >= len(stack) + 2:
+            call[1] -= 1
+            name = names[int(structureRandom.random() * len(names))]
+            if divergenceRandom.random() < divergenceRate:
+                name = names[int(divergenceRandom.random() * len(names))]
+            stack.append([name, int(structureRandom.random() * (fanOut + 1))])
+            remainingEvents -= 1
+            yield True, name
+        else:
+            stack.pop()
+            remainingEvents -= 1
+            yield False, call[0]
+
+# Write a synthetic text recording (see: record.cpp) of eventCount events to outFile, split
+# between threadCount threads whose events are interleaved. Calls are made to nameCount function
+# names. Recordings generated with the same seed have the same calls, except that a fraction
+# divergenceRate of calls are made to a different, random name. Returns the number of events
+# written, which is less than eventCount if it cannot be split evenly into pairs of entering and
+# exiting events for each thread.
+def generateRecording(outFile, eventCount, depth = 8, fanOut = 4, threadCount = 1, nameCount = 1000, divergenceRate = 0.0, seed = 0):
+    names = _functionNames(nameCount)
+    threads = []
+    for thread in xrange(threadCount):
+        threadName = "_Z" + str(len("thread" + str(thread))) + "thread" + str(thread) + "v"
+        structureRandom = random.Random(seed * 1000003 + thread)
+        divergenceRandom = random.Random(-(seed * 1000003 + thread) - 1)
+        events = _threadEvents(threadName, eventCount / threadCount, depth, fanOut, names, divergenceRate, structureRandom, divergenceRandom)
+        threads.append(("tid" + str(thread + 1), events))
+    written = 0
+    while threads:
+        activeThreads = []
+        for threadId, events in threads:
+            lines = []
+            for entering, name in events:
+                if entering:
+                    lines.append(threadId + " entering " + name + "\n")
+                else:
+                    lines.append(threadId + " exiting " + name + "\n")
+                if len(lines) == _THREAD_EVENTS_PER_TURN:
+                    activeThreads.append((threadId, events))
+                    break
+            outFile.write("".join(lines))
+            written += len(lines)
+        threads = activeThreads
+    return written
+
+# Each stage is set up from the paths of recordings A and B, and returns a function doing the
+# work that is timed and the number of events that work processes.
+def _parseStage(recordingA, recordingB, events):
+    return lambda: CCT.fromRecordFile(recordingA), events
+
+def _compactParseStage(recordingA, recordingB, events):
+    return lambda: CompactCCT.fromRecordFile(recordingA), events
+
+def _jsonStage(recordingA, recordingB, events):
+    cct = CCT.fromRecordFile(recordingA)
+    def encode():
+        with open(os.devnull, 'w') as outFile:
+            cct.dumpJson(outFile)
+    return encode, events
+
+def _demangleStage(recordingA, recordingB, events):
+    cct = CCT.fromRecordFile(recordingA)
+    return lambda: cct.demangle(Demangler()), events
+
+def _compareStage(recordingA, recordingB, events):
+    cctA = CCT.fromRecordFile(recordingA)
+    cctB = CCT.fromRecordFile(recordingB)
+    return lambda: (compare._findDivergences(cctA, cctB), compare._findDivergences(cctB, cctA)), events * 2
+
+def _statsStage(recordingA, recordingB, events):
+    return lambda: stats._recordingStats(recordingA), events
+
+_STAGES = [
+    ("parse", _parseStage),
+    ("parse-compact", _compactParseStage),
+    ("json", _jsonStage),
+    ("demangle", _demangleStage),
+    ("compare", _compareStage),
+    ("stats", _statsStage),
+]
+
+# Run a stage in this process, returning its wall time, events per second and peak RSS in KB.
+def _runStage(stage, recordingA, recordingB, events):
+    setup = dict(_STAGES)[stage]
+    work, workEvents = setup(recordingA, recordingB, events)
+    start = time.time()
+    work()
+    seconds = time.time() - start
+    eventsPerSecond = 0.0
+    if seconds > 0:
+        eventsPerSecond = workEvents / seconds
+    return {"seconds": seconds, "eventsPerSecond": eventsPerSecond, "maxRss": peakRss()}
+
+# Run a stage in a new process, so its peak RSS is not affected by other stages.
+def _measureStage(stage, recordingA, recordingB, events):
+    command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--events", str(events), recordingA, recordingB]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise AssertionError("Benchmark stage " + stage + " failed: " + err)
+    return json.loads(out)
+
+# Return the change of each stage's time from the baseline as a percentage, or None if the
+# baseline was measured with a different configuration.
+def _baselineChanges(results, baseline):
+    if baseline is None or baseline["config"] != results["config"]:
+        return None
+    changes = {}
+    for stage, result in results["stages"].iteritems():
+        baselineResult = baseline["stages"].get(stage)
+        if baselineResult and baselineResult["seconds"] > 0:
+            changes[stage] = (result["seconds"] - baselineResult["seconds"]) * 100.0 / baselineResult["seconds"]
+    return changes
+
+def _printResults(results, baseline, changes):
+    print "Stage              Time      Events/s    Peak RSS"
+    for stage, setup in _STAGES:
+        result = results["stages"].get(stage)
+        if result is None:
+            continue
+        line = "{:<14}{:>8.2f}s{:>14,.0f}{:>10.0f}MB".format(stage, result["seconds"], result["eventsPerSecond"], result["maxRss"] / 1024.0)
+        if changes is not None and stage in changes:
+            line += "  (baseline {:.2f}s, {:+.1f}%)".format(baseline["stages"][stage]["seconds"], changes[stage])
+        print line
+    if baseline is not None and changes is None:
+        print ""
+        print "The baseline was measured with different options, so it was not compared."
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the calling context tree analysis pipeline on synthetic recordings")
+    parser.add_argument("-e", "--events", type=int, default=1000000, help="Number of events in each recording (default: 1000000)")
+    parser.add_argument("--depth", type=int, default=8, help="Maximum call depth (default: 8)")
+    parser.add_argument("--fan-out", type=int, default=4, help="Maximum number of calls made by each call (default: 4)")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads (default: 4)")
+    parser.add_argument("--names", type=int, default=1000, help="Number of distinct function names (default: 1000)")
+    parser.add_argument("--divergence", type=float, default=0.001, help="Fraction of calls in recording B made to a different name (default: 0.001)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--stages", default=",".join(stage for stage, setup in _STAGES), help="Comma separated stages to run (default: all)")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Output format")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILENAME, help="Baseline results to compare against (default: bench/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--max-regression", type=float, metavar="PERCENT", help="Exit with an error if a stage is more than PERCENT slower than the baseline")
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("recordings", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        recordingA, recordingB = args.recordings
+        print json.dumps(_runStage(args.run_stage, recordingA, recordingB, args.events))
+        return
+
+    stageNames = [stage for stage in args.stages.split(",") if stage]
+    for stage in stageNames:
+        if stage not in dict(_STAGES):
+            parser.error("Unknown stage " + stage + " (stages: " + ", ".join(stage for stage, setup in _STAGES) + ")")
+    config = {
+        "events": args.events,
+        "depth": args.depth,
+        "fanOut": args.fan_out,
+        "threads": args.threads,
+        "names": args.names,
+        "divergence": args.divergence,
+        "seed": args.seed,
+    }
+    results = {"config": config, "stages": {}}
+    try:
+        tempOutputDir = tempfile.mkdtemp()
+        recordingA = os.path.join(tempOutputDir, "a.txt")
+        recordingB = os.path.join(tempOutputDir, "b.txt")
+        for recording, divergenceRate in [(recordingA, 0.0), (recordingB, args.divergence)]:
+            with open(recording, 'w') as outFile:
+                events = generateRecording(outFile, args.events, args.depth, args.fan_out, args.threads, args.names, divergenceRate, args.seed)
+        for stage in stageNames:
+            results["stages"][stage] = _measureStage(stage, recordingA, recordingB, events)
+    finally:
+        shutil.rmtree(tempOutputDir)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as inFile:
+            baseline = json.load(inFile)
+    changes = _baselineChanges(results, baseline)
+    if args.format == "json":
+        results["baselineChanges"] = changes
+        print json.dumps(results, indent=2, sort_keys=True, separators=(",", ": "))
+    else:
+        _printResults(results, baseline, changes)
+
+    if args.save_baseline:
+        baselineDirectory = os.path.dirname(args.baseline)
+        if baselineDirectory and not os.path.isdir(baselineDirectory):
+            os.makedirs(baselineDirectory)
+        with open(args.baseline, 'w') as outFile:
+            json.dump({"config": config, "stages": results["stages"]}, outFile, indent=2, sort_keys=True, separators=(",", ": "))
+            outFile.write("\n")
+    if args.max_regression is not None and changes:
+        if any(change > args.max_regression for change in changes.itervalues()):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
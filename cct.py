@@ -3,13 +3,377 @@
 # A Calling Context Tree (CCT) has a single root which contains multiple calls to Functions which
 # can themselves have other calls.
 
+from array import array
+import bz2
 from collections import defaultdict
+from contextlib import contextmanager
+from demangler import demangleNamesWithCommand
+import gzip
+import hashlib
+import io
+from itertools import izip
 import json
+import mmap
+import multiprocessing
+import os
 import re
+import struct
 import subprocess
 
+# Read recordings in large chunks; recordings of real programs can be several gigabytes.
+_RECORD_BUFFER_SIZE = 1 << 20
+
+# Iterate over the lines of a string, including line endings, without copying the whole string.
+def _iterLines(string):
+    start = 0
+    while start < len(string):
+        end = string.find("\n", start)
+        if end == -1:
+            end = len(string)
+        else:
+            end += 1
+        yield string[start:end]
+        start = end
+
+# The record format (see: record.cpp):
+#   [optional @time ][optional threadid ][entering|exiting][function]
+#   symbol [function id] [function address] [function]
+_RECORD_RX = re.compile(r"^(?:@(?P<time>\d+) )?(?P<threadId>[^\s]*)\s?(?P<enteringExiting>entering|exiting)\s(?P<functionName>.+)\n")
+_SYMBOL_RX = re.compile(r"^symbol (?P<functionId>\d+) (?P<address>[^\s]+) (?P<functionName>.+)\n")
+
+# Parse record lines into (threadId, isEntering, functionName, time) events, where time is in
+# nanoseconds, or None if the recording has no times (see: RECORD_CCT_TIMESTAMPS in record.cpp).
+# Recordings that use function ids (RECORD_CCT_FORMAT=ids, see: record.cpp) name functions by id
+# and end with a symbol table; if symbols is given, it is filled with a map from each id to its
+# function name.
+def _recordEvents(lines, symbols = None):
+    for line in lines:
+        match = _RECORD_RX.match(line)
+        if not match:
+            match = _SYMBOL_RX.match(line)
+            if match and symbols is not None:
+                symbols["#" + match.group("functionId")] = match.group("functionName")
+            continue
+        threadId = match.group("threadId")
+        if not threadId:
+            threadId = "no thread"
+        time = match.group("time")
+        if time is not None:
+            time = int(time)
+        yield threadId, match.group("enteringExiting") == "entering", match.group("functionName"), time
+
+# Runs of consecutive record lines of one thread, the record lines that enter a call, and symbol
+# lines (see: _RECORD_RX and _SYMBOL_RX), matched in a whole chunk of a recording at once. record.cpp
+# writes each thread's events a buffer at a time, so a recording is mostly long runs of one thread.
+_RECORD_RUN_RX = re.compile(r"^(?:@\d+ )?([^\s]*)\s?(?:entering|exiting)\s.+\n(?:(?:@\d+ )?\1\s?(?:entering|exiting)\s.+\n)*", re.M)
+_ENTERING_LINE_RX = re.compile(r"^(?:@\d+ )?[^\s]*\s?entering\s.", re.M)
+_SYMBOL_LINE_RX = re.compile(r"^symbol (\d+) [^\s]+ (.+)\n", re.M)
+_RUN_RECORD_RX = re.compile(r"(?:@(\d+) )?[^\s]*\s?(entering|exiting)\s(.+)\n")
+
+# Find the runs of lines of each thread in a byte range of a recording. Lines belong to the range
+# they start in. Returns a list of (threadId, start offset, end offset, calls entered) and the
+# symbol table of the range.
+def _findRecordRuns(arguments):
+    filename, start, end = arguments
+    runs = []
+    symbols = {}
+    with open(filename, 'rb') as inFile:
+        if start > 0:
+            inFile.seek(start - 1)
+            start += len(inFile.readline()) - 1
+        chunkOffset = start
+        while chunkOffset < end:
+            chunk = inFile.read(min(_RECORD_BUFFER_SIZE, end - chunkOffset))
+            if not chunk:
+                break
+            if not chunk.endswith("\n"):
+                chunk += inFile.readline()
+            for match in _RECORD_RUN_RX.finditer(chunk):
+                runStart, runEnd = match.span()
+                runs.append((match.group(1), chunkOffset + runStart, chunkOffset + runEnd, len(_ENTERING_LINE_RX.findall(chunk, runStart, runEnd))))
+            if "symbol " in chunk:
+                for match in _SYMBOL_LINE_RX.finditer(chunk):
+                    symbols["#" + match.group(1)] = match.group(2)
+            chunkOffset += len(chunk)
+    return runs, symbols
+
+# Parse the calls of one shard of a recording's threads from the runs of their lines, in file order.
+# Each thread's events form their own subtree, so every shard can check nesting and build its
+# threads' calls independently. The shard's calls are numbered from base, so the merged tree can
+# use its parent and call columns unchanged. Returns the shard's names, name ids, parents, first,
+# next and last calls and durations (as CompactCCT columns without the root, durations being None
+# if the recording has no times), each call from the root as (offset, index), and the first
+# nesting error as (offset, message) or None.
+def _parseRecordShard(arguments):
+    filename, base, runs = arguments
+    names = []
+    nameIdsByName = {}
+    nameIds = array('i')
+    parents = array('i')
+    firstCalls = array('i')
+    nextCalls = array('i')
+    lastCalls = array('i')
+    durations = None
+    rootCalls = []
+    currentIndexByThread = {}
+    error = None
+    with open(filename, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+        for threadId, start, end, calls in runs:
+            inFile.seek(start)
+            chunk = inFile.read(end - start)
+            currentIndex = currentIndexByThread.get(threadId, 0)
+            for match in _RUN_RECORD_RX.finditer(chunk):
+                time, enteringExiting, functionName = match.groups()
+                if time is not None:
+                    time = int(time)
+                    if durations is None:
+                        if nameIds:
+                            raise ValueError("Recording has events with and without times.")
+                        durations = array('d')
+                elif durations is not None:
+                    raise ValueError("Recording has events with and without times.")
+                if enteringExiting == "entering":
+                    index = base + len(nameIds)
+                    nameId = nameIdsByName.get(functionName)
+                    if nameId is None:
+                        nameId = nameIdsByName[functionName] = len(names)
+                        names.append(functionName)
+                    nameIds.append(nameId)
+                    parents.append(currentIndex)
+                    firstCalls.append(-1)
+                    nextCalls.append(-1)
+                    lastCalls.append(-1)
+                    if time is not None:
+                        durations.append(time)
+                    if currentIndex == 0:
+                        rootCalls.append((start + match.start(), index))
+                    else:
+                        lastCall = lastCalls[currentIndex - base]
+                        if lastCall < 0:
+                            firstCalls[currentIndex - base] = index
+                        else:
+                            nextCalls[lastCall - base] = index
+                        lastCalls[currentIndex - base] = index
+                    currentIndex = index
+                else:
+                    if currentIndex == 0 or names[nameIds[currentIndex - base]] != functionName:
+                        error = (start + match.start(), "Incorrect nesting found when exiting " + functionName)
+                        break
+                    if time is not None:
+                        durations[currentIndex - base] = time - durations[currentIndex - base]
+                    currentIndex = parents[currentIndex - base]
+            if error is not None:
+                break
+            currentIndexByThread[threadId] = currentIndex
+        if error is None:
+            for threadId, index in currentIndexByThread.iteritems():
+                if index != 0:
+                    inFile.seek(0, io.SEEK_END)
+                    error = (inFile.tell(), "Incorrect nesting found when exiting " + names[nameIds[index - base]])
+                    break
+    durationData = None
+    if durations is not None:
+        durationData = durations.tostring()
+    return names, nameIds.tostring(), parents.tostring(), firstCalls.tostring(), nextCalls.tostring(), lastCalls.tostring(), durationData, rootCalls, error
+
+# Parse a recording on disk in several processes and merge the results into a CompactCCT. The
+# processes first find the runs of lines of each thread in a byte range of the recording each. The
+# threads are then split into shards with about as many calls each, and each process parses one
+# shard, reading only the lines of its threads. A single thread's calls are parsed by one process,
+# so a recording dominated by one thread parses little faster. Calls from the root are kept in the
+# order they were recorded, so the result is the same as parsing the recording in one process.
+def _parseRecordFileInParallel(filename, processes):
+    size = os.path.getsize(filename)
+    pool = multiprocessing.Pool(processes)
+    try:
+        ranges = pool.map(_findRecordRuns, [(filename, size * index / processes, size * (index + 1) / processes) for index in xrange(processes)])
+        # Each thread's runs in file order and its number of calls.
+        runsByThread = {}
+        callsByThread = defaultdict(int)
+        symbols = {}
+        for runs, rangeSymbols in ranges:
+            symbols.update(rangeSymbols)
+            for run in runs:
+                runsByThread.setdefault(run[0], []).append(run)
+                callsByThread[run[0]] += run[3]
+        # Give each thread, largest first, to the shard with the fewest calls.
+        shardCount = max(1, min(processes, len(runsByThread)))
+        shardThreads = [[] for shard in xrange(shardCount)]
+        shardCalls = [0] * shardCount
+        for calls, threadId in sorted(((calls, threadId) for threadId, calls in callsByThread.iteritems()), reverse=True):
+            shard = shardCalls.index(min(shardCalls))
+            shardThreads[shard].append(threadId)
+            shardCalls[shard] += calls
+        shardArguments = []
+        base = 1
+        for shard in xrange(shardCount):
+            runs = sorted((run for threadId in shardThreads[shard] for run in runsByThread[threadId]), key=lambda run: run[1])
+            shardArguments.append((filename, base, runs))
+            base += shardCalls[shard]
+        shards = pool.map(_parseRecordShard, shardArguments)
+    finally:
+        pool.close()
+        pool.join()
+    return _mergeRecordShards(shards, symbols)
+
+# Merge the calls parsed by each shard of a recording into a CompactCCT, renaming function ids with
+# symbols. The shards' calls are numbered one after the other, so only their name ids are mapped.
+def _mergeRecordShards(shards, symbols):
+    errors = [shard[8] for shard in shards if shard[8] is not None]
+    if errors:
+        raise AssertionError(min(errors)[1])
+    tree = CompactCCT()
+    if any(shard[6] is not None for shard in shards):
+        tree._durations = array('d', [0.0])
+    rootCalls = []
+    for names, nameIdData, parentData, firstCallData, nextCallData, lastCallData, durationData, shardRootCalls, error in shards:
+        shardNameIds = array('i')
+        shardNameIds.fromstring(nameIdData)
+        if durationData is not None:
+            tree._durations.fromstring(durationData)
+        elif tree._durations is not None and shardNameIds:
+            raise ValueError("Recording has events with and without times.")
+        nameIdMap = [tree._internName(name) for name in names]
+        tree._nameIds.extend(array('i', map(nameIdMap.__getitem__, shardNameIds)))
+        tree._parents.fromstring(parentData)
+        tree._firstCalls.fromstring(firstCallData)
+        tree._nextCalls.fromstring(nextCallData)
+        tree._lastCalls.fromstring(lastCallData)
+        rootCalls.extend(shardRootCalls)
+    for callOffset, index in sorted(rootCalls):
+        tree._linkCall(0, index)
+    if symbols:
+        tree._renameFunctions(symbols)
+    return tree
+
+# Binary recordings (see: record.cpp) start with a header, followed by events of three uint32s
+# (thread index, 0 if entering or 1 if exiting, function id), a table of function names, and a
+# footer of the name table's offset. Recordings with times have a different header, and two more
+# uint32s per event holding the low and high halves of the time.
+_BINARY_RECORD_HEADER = "CCTRECB1"
+_TIMED_BINARY_RECORD_HEADER = "CCTRECT1"
+_BINARY_RECORD_HEADERS = (_BINARY_RECORD_HEADER, _TIMED_BINARY_RECORD_HEADER)
+_BINARY_RECORD_FOOTER = "CCTSYMB1"
+_BINARY_RECORD_FOOTER_FORMAT = "=Q8s"
+_BINARY_RECORD_NAME_FORMAT = "=II"
+_BINARY_RECORD_EVENT_SIZE = 3
+_TIMED_BINARY_RECORD_EVENT_SIZE = 5
+# Number of events to decode at a time.
+_BINARY_RECORD_CHUNK_EVENTS = 1 << 16
+
+# Read the function name table of a binary recording, returning the names, table offset and header.
+def _readBinaryRecordNames(inFile):
+    inFile.seek(0)
+    header = inFile.read(len(_BINARY_RECORD_HEADER))
+    if header not in _BINARY_RECORD_HEADERS:
+        raise ValueError("Recording is not a binary recording.")
+    footerSize = struct.calcsize(_BINARY_RECORD_FOOTER_FORMAT)
+    inFile.seek(0, io.SEEK_END)
+    end = inFile.tell() - footerSize
+    if end < len(_BINARY_RECORD_HEADER):
+        raise ValueError("Binary recording is incomplete.")
+    inFile.seek(end)
+    namesOffset, footer = struct.unpack(_BINARY_RECORD_FOOTER_FORMAT, inFile.read(footerSize))
+    if footer != _BINARY_RECORD_FOOTER:
+        raise ValueError("Binary recording is incomplete.")
+
+    inFile.seek(namesOffset)
+    names = {}
+    nameHeaderSize = struct.calcsize(_BINARY_RECORD_NAME_FORMAT)
+    while inFile.tell() < end:
+        functionId, length = struct.unpack(_BINARY_RECORD_NAME_FORMAT, inFile.read(nameHeaderSize))
+        names[functionId] = inFile.read(length)
+    return names, namesOffset, header
+
+# Decode a binary recording into (threadIndex, isEntering, functionName, time) events. Events are
+# decoded in bulk, a chunk at a time.
+def _binaryRecordEvents(inFile):
+    names, namesOffset, header = _readBinaryRecordNames(inFile)
+    eventSize = _BINARY_RECORD_EVENT_SIZE
+    if header == _TIMED_BINARY_RECORD_HEADER:
+        eventSize = _TIMED_BINARY_RECORD_EVENT_SIZE
+    inFile.seek(len(header))
+    remainingValues = (namesOffset - len(header)) / array('I').itemsize
+    while remainingValues > 0:
+        values = array('I')
+        values.fromstring(inFile.read(min(remainingValues, _BINARY_RECORD_CHUNK_EVENTS * eventSize) * values.itemsize))
+        remainingValues -= len(values)
+        if eventSize == _TIMED_BINARY_RECORD_EVENT_SIZE:
+            for index in xrange(0, len(values), eventSize):
+                yield values[index], values[index + 1] == 0, names[values[index + 2]], values[index + 3] | (values[index + 4] << 32)
+        else:
+            for index in xrange(0, len(values), eventSize):
+                yield values[index], values[index + 1] == 0, names[values[index + 2]], None
+
+# Use a demangler, either a demangler command or a Demangler, to build a map from mangled function
+# names to demangled function names.
+def _demangleNames(demangler, mangledNames):
+    if isinstance(demangler, basestring):
+        return demangleNamesWithCommand(demangler, mangledNames)
+    return demangler.demangleNames(mangledNames)
+
+# Count a list of calls by function name.
+def callCountsByName(calls):
+    callCounts = defaultdict(int)
+    for call in calls:
+        callCounts[call.name] += 1
+    return callCounts
+
+# Count the most calls to each name made by a single call that function stands for.
+def _mostCallsByName(function):
+    if isinstance(function, AggregatedFunction):
+        return dict((call.name, call.mostCallsPerParent()) for call in function.calls)
+    return callCountsByName(function.calls)
+
+# Subtree hashes (see: Function.subtreeHash) add the hashes of a Function's calls modulo 2^64, so
+# they do not depend on call order.
+_SUBTREE_HASH_MASK = (1 << 64) - 1
+
+# Return the hash of a subtree from its root's key (see: Function._hashKey) and the sum of the
+# hashes of its calls.
+def _hashSubtree(key, callsHash):
+    return hash((key, callsHash & _SUBTREE_HASH_MASK))
+
+# Tree traversal. Call trees can be far deeper than Python's recursion limit (e.g., a recursive
+# quicksort), so traversals use an explicit stack instead of recursion.
+ENTER = 0
+EXIT = 1
+
+# Walk the tree rooted at function in depth-first order, yielding (ENTER, function) before a
+# Function's calls are walked and (EXIT, function) after. If descend is given, it is called after
+# a Function is entered and the Function's calls are only walked if it returns true.
+def walk(function, descend = None):
+    stack = [(ENTER, function)]
+    while stack:
+        event, function = stack.pop()
+        yield event, function
+        if event == ENTER:
+            stack.append((EXIT, function))
+            if descend is None or descend(function):
+                stack.extend([(ENTER, call) for call in reversed(function.calls)])
+
+# Yield function and every Function below it, parents before their calls.
+def preOrder(function):
+    for event, function in walk(function):
+        if event == ENTER:
+            yield function
+
+# Yield function and every Function below it, calls before their parents.
+def postOrder(function):
+    for event, function in walk(function):
+        if event == EXIT:
+            yield function
+
 class Function(object):
 
+    # The number of calls a Function stands for; more than one in an AggregatedCCT.
+    count = 1
+    # The time between entering and exiting the call, or None if the recording has no times. In an
+    # AggregatedCCT, the total time of the calls the Function stands for.
+    duration = None
+    # The cached hash of this Function's subtree (see: subtreeHash), or None.
+    _subtreeHash = None
+
     def __init__(self, name):
         self.calls = []
         self.name = name
@@ -27,15 +391,22 @@ class Function(object):
         self.calls.append(call)
         self._callCountsByName[call.name] += 1
         call.parent = self
+        # The subtree changed, so this Function's hash and its callers' hashes are out of date.
+        function = self
+        while function is not None and function._subtreeHash is not None:
+            function._subtreeHash = None
+            function = function.parent
 
     def callCountToFunctionName(self, name):
         return self._callCountsByName[name]
 
     def callStack(self):
         stack = []
-        if self.parent:
-            stack.extend(self.parent.callStack())
-        stack.append(self)
+        function = self
+        while function and not function.isRoot():
+            stack.append(function)
+            function = function.parent
+        stack.reverse()
         return stack
 
     def callNameStack(self):
@@ -47,28 +418,67 @@ class Function(object):
     def uniqueCallNames(self):
         return self._callCountsByName.keys()
 
+    # The time spent in this call but not in its calls, or None if the recording has no times.
+    def exclusiveDuration(self):
+        if self.duration is None:
+            return None
+        return self.duration - sum(call.duration or 0 for call in self.calls)
+
+    # An order-insensitive hash of this Function's name and calls and, in turn, of their names and
+    # calls (a Merkle tree). Functions with the same hash make the same calls, in any order, which
+    # make the same calls, so comparing their hashes compares their whole subtrees (see:
+    # compare._walkDivergences). The hashes of a subtree are computed bottom-up in one pass the
+    # first time they are needed and kept until a Function in the subtree is renamed or called.
+    def subtreeHash(self):
+        if self._subtreeHash is None:
+            # Find the Functions that are not hashed yet, parents before their calls, and hash them
+            # in reverse.
+            functions = []
+            stack = [self]
+            while stack:
+                function = stack.pop()
+                functions.append(function)
+                stack.extend([call for call in function.calls if call._subtreeHash is None])
+            for function in reversed(functions):
+                callsHash = 0
+                if function.calls:
+                    callsHash = sum([call._subtreeHash for call in function.calls])
+                function._subtreeHash = _hashSubtree(function._hashKey(), callsHash)
+        return self._subtreeHash
+
+    # What is hashed along with the hashes of a Function's calls (see: subtreeHash).
+    def _hashKey(self):
+        return self.name
+
     def _collectAllUniqueCallNames(self, names):
-        names.add(self.name)
-        for call in self.calls:
-            call._collectAllUniqueCallNames(names)
+        for function in preOrder(self):
+            names.add(function.name)
 
-    def _demangle(self, demangleMap):
+    # Rename this Function and every Function below it using a map from old to new names.
+    def _renameFunctions(self, nameMap):
+        for function in preOrder(self):
+            function._rename(nameMap)
+
+    def _rename(self, nameMap):
+        self._subtreeHash = None
         if (self.name):
             oldName = self.name
-            self.name = demangleMap[oldName]
+            self.name = nameMap[oldName]
         oldCallCountsByName = self._callCountsByName
         self._callCountsByName = defaultdict(int)
         for oldName, count in oldCallCountsByName.iteritems():
-            self._callCountsByName[demangleMap[oldName]] = count
-        for call in self.calls:
-            call._demangle(demangleMap)
+            self._callCountsByName[nameMap[oldName]] += count
 
     def asJson(self, indent = None):
         return json.dumps(self, sort_keys=False, indent=indent, cls=FunctionJSONEncoder)
 
+    # Write this Function as JSON to a file object without building the whole string in memory.
+    def dumpJson(self, fileobj, indent = None, compact = False):
+        _dumpJson(self, fileobj, indent, compact)
+
     @staticmethod
     def fromJson(string):
-        return json.loads(string, cls=FunctionJSONDecoder)
+        return _loadJsonString(string)
 
 # A CCT is the root for a calling context tree and represents the program entry point.
 class CCT(Function):
@@ -79,6 +489,9 @@ class CCT(Function):
     def asJson(self, indent = None):
         return json.dumps(self.calls, sort_keys=False, indent=indent, cls=FunctionJSONEncoder)
 
+    def dumpJson(self, fileobj, indent = None, compact = False):
+        _dumpJson(self.calls, fileobj, indent, compact)
+
     def callStack(self):
         return []
 
@@ -87,20 +500,50 @@ class CCT(Function):
 
     @staticmethod
     def fromRecord(string):
-        # The record format (see: record.cpp):
-        #   [optional threadid ][entering|exiting][function]
-        recordRx = re.compile(r"^(?P<threadId>[^\s]*)\s?(?P<enteringExiting>entering|exiting)\s(?P<functionName>.+)\n", re.MULTILINE)
+        return CCT.fromRecordStream(_iterLines(string))
 
+    # Build a CCT from a recording on disk without reading the entire recording into memory. If
+    # processes is greater than 1, the recording's threads are parsed in that many processes.
+    @staticmethod
+    def fromRecordFile(filename, processes = 1):
+        if processes > 1:
+            return CCT._fromCompactCCT(_parseRecordFileInParallel(filename, processes))
+        with open(filename, 'r', _RECORD_BUFFER_SIZE) as inFile:
+            return CCT.fromRecordStream(inFile)
+
+    # Build a CCT incrementally from an iterable of record lines, such as a file object.
+    @staticmethod
+    def fromRecordStream(lines):
+        symbols = {}
+        cct = CCT._fromEvents(_recordEvents(lines, symbols))
+        if symbols:
+            cct._renameFunctions(symbols)
+        return cct
+
+    # Build a CCT from a binary recording (see: record.cpp).
+    @staticmethod
+    def fromBinaryRecord(data):
+        return CCT.fromBinaryRecordFile(io.BytesIO(data))
+
+    # Build a CCT from a binary recording, given a filename or a seekable binary file object.
+    @staticmethod
+    def fromBinaryRecordFile(file):
+        if not isinstance(file, basestring):
+            return CCT._fromEvents(_binaryRecordEvents(file))
+        with open(file, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+            return CCT._fromEvents(_binaryRecordEvents(inFile))
+
+    # Build a CCT from (threadId, isEntering, functionName, time) events. A Function's duration holds
+    # the time it was entered until it exits.
+    @staticmethod
+    def _fromEvents(events):
         rootFunction = CCT()
         currentFunctionByThread = {}
-        for match in recordRx.finditer(string):
-            threadId = match.group("threadId")
-            if not threadId:
-                threadId = "no thread"
-            enteringExiting = match.group("enteringExiting")
-            functionName = match.group("functionName")
-            if enteringExiting == "entering":
+        for threadId, entering, functionName, time in events:
+            if entering:
                 nextFunction = Function(functionName)
+                if time is not None:
+                    nextFunction.duration = time
                 if threadId not in currentFunctionByThread:
                     currentFunctionByThread[threadId] = rootFunction
                 currentFunctionByThread[threadId].addCall(nextFunction)
@@ -111,56 +554,1056 @@ class CCT(Function):
                 currentFunction = currentFunctionByThread[threadId]
                 if currentFunction.name != functionName:
                     raise AssertionError("Incorrect nesting found when exiting " + functionName)
+                if time is not None:
+                    currentFunction.duration = time - currentFunction.duration
                 currentFunctionByThread[threadId] = currentFunction.parent
         for threadId, function in currentFunctionByThread.items():
             if not function.isRoot():
                 raise AssertionError("Incorrect nesting found when exiting " + function.name)
         return rootFunction
 
+    # Copy the calls of a CompactCCT into a new CCT. Calls always follow their parent call, and
+    # calls from the same parent are in order, apart from calls from the root.
+    @staticmethod
+    def _fromCompactCCT(tree):
+        cct = CCT()
+        names = tree.names
+        nameIds = tree._nameIds
+        parents = tree._parents
+        durations = tree._durations
+        functions = [cct]
+        for index in xrange(1, len(tree)):
+            function = Function(names[nameIds[index]])
+            if durations is not None:
+                function.duration = durations[index]
+            functions.append(function)
+            if parents[index]:
+                functions[parents[index]].addCall(function)
+        for index in tree._callIndices(0):
+            cct.addCall(functions[index])
+        return cct
+
     @staticmethod
     def fromJson(string):
-        decodedFunctions = json.loads(string, cls=FunctionJSONDecoder)
+        return CCT._fromDecodedJson(_loadJsonString(string))
+
+    # Build a CCT from JSON in a file object, reading the file a chunk at a time.
+    @staticmethod
+    def loadJson(fileobj):
+        return CCT._fromDecodedJson(_loadJson(fileobj))
+
+    @staticmethod
+    def _fromDecodedJson(decodedFunctions):
         cct = CCT()
         for function in decodedFunctions:
             cct.addCall(function)
         return cct
 
-    # Use a demangler to convert mangled function names to demangled function names.
-    # See c++filt: https://linux.die.net/man/1/c++filt
+    # Use a demangler command or a Demangler (see: demangler.py) to convert mangled function names
+    # to demangled function names. See c++filt: https://linux.die.net/man/1/c++filt
     # For example: _Z1Av => A().
     def demangle(self, demangler):
         mangledNames = set()
         self._collectAllUniqueCallNames(mangledNames)
+        # The root has no name.
+        mangledNames.discard(None)
+        self._renameFunctions(_demangleNames(demangler, mangledNames))
+
+# A Function stored in a CompactCCT. CompactFunctions are lightweight views onto the CompactCCT's
+# arrays: they are created on demand and compare equal when they refer to the same call.
+class CompactFunction(Function):
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactFunction) and self._tree is other._tree and self._index == other._index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._tree), self._index))
 
-        proc = subprocess.Popen(demangler, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = proc.communicate('\n'.join(str(e) for e in mangledNames))
-        if err != "":
-            raise AssertionError(err)
-        demangledNames = filter(None, out.split("\n"))
+    @property
+    def name(self):
+        nameId = self._tree._nameIds[self._index]
+        if nameId < 0:
+            return None
+        return self._tree.names[nameId]
 
-        mangledCount = len(mangledNames)
-        demangledCount = len(demangledNames)
-        if mangledCount != demangledCount:
-            raise AssertionError("Demangling failed: tried to demangle " + str(mangledCount) + " functions but " + str(demangledCount) + " were demangled.")
+    @property
+    def duration(self):
+        durations = self._tree._durations
+        if durations is None or self._index == 0:
+            return None
+        return durations[self._index]
 
-        demangledNameMap = {}
-        for index, mangledName in enumerate(mangledNames):
-            demangledNameMap[mangledName] = demangledNames[index]
+    @property
+    def parent(self):
+        parentIndex = self._tree._parents[self._index]
+        if parentIndex < 0:
+            return None
+        return self._tree._function(parentIndex)
 
-        self._demangle(demangledNameMap)
+    @property
+    def calls(self):
+        return [self._tree._function(index) for index in self._tree._callIndices(self._index)]
+
+    def addCall(self, call):
+        raise ValueError("Calls cannot be added to a CompactFunction.")
+
+    def subtreeHash(self):
+        return self._tree._subtreeHashOf(self._index)
+
+    def callCountToFunctionName(self, name):
+        nameId = self._tree._nameIdsByName.get(name)
+        if nameId is None:
+            return 0
+        nameIds = self._tree._nameIds
+        count = 0
+        for index in self._tree._callIndices(self._index):
+            if nameIds[index] == nameId:
+                count += 1
+        return count
+
+    def uniqueCallNames(self):
+        nameIds = self._tree._nameIds
+        names = self._tree.names
+        uniqueNameIds = []
+        seen = set()
+        for index in self._tree._callIndices(self._index):
+            nameId = nameIds[index]
+            if nameId not in seen:
+                seen.add(nameId)
+                uniqueNameIds.append(nameId)
+        return [names[nameId] for nameId in uniqueNameIds]
+
+# A CCT stored as columns of integers rather than as Function objects. Each call is an index into
+# the parent, first call, next sibling call and name id arrays, and each function name is stored
+# once in a table of names. This uses a small fraction of the memory of a CCT and supports the
+# read-only parts of the Function API so it can be compared and analyzed like a CCT.
+class CompactCCT(CompactFunction):
+
+    def __init__(self):
+        CompactFunction.__init__(self, self, 0)
+        self.names = []
+        self._nameIdsByName = {}
+        self._nameIds = array('i', [-1])
+        self._parents = array('i', [-1])
+        # The duration of each call if the recording has times, or None.
+        self._durations = None
+        self._firstCalls = array('i', [-1])
+        self._nextCalls = array('i', [-1])
+        self._lastCalls = array('i', [-1])
+        # The subtree hash of each call (see: Function.subtreeHash), or None until one is needed.
+        self._subtreeHashes = None
+
+    def __len__(self):
+        return len(self._nameIds)
+
+    def asJson(self, indent = None):
+        return json.dumps(self.calls, sort_keys=False, indent=indent, cls=FunctionJSONEncoder)
+
+    def dumpJson(self, fileobj, indent = None, compact = False):
+        _dumpJson(self.calls, fileobj, indent, compact)
+
+    def callStack(self):
+        return []
+
+    def isRoot(self):
+        return True
+
+    def _function(self, index):
+        if index == 0:
+            return self
+        return CompactFunction(self, index)
+
+    def _callIndices(self, index):
+        nextCalls = self._nextCalls
+        index = self._firstCalls[index]
+        while index >= 0:
+            yield index
+            index = nextCalls[index]
+
+    # Return the subtree hash of the call at index, first hashing every call. Calls always follow
+    # their parent call, so hashing calls from the last to the first hashes them bottom-up.
+    def _subtreeHashOf(self, index):
+        if self._subtreeHashes is None:
+            names = self.names
+            nameIds = self._nameIds
+            parents = self._parents
+            hashes = [0] * len(nameIds)
+            callsHashes = [0] * len(nameIds)
+            for callIndex in xrange(len(nameIds) - 1, 0, -1):
+                callHash = _hashSubtree(names[nameIds[callIndex]], callsHashes[callIndex])
+                hashes[callIndex] = callHash
+                callsHashes[parents[callIndex]] += callHash
+            hashes[0] = _hashSubtree(None, callsHashes[0])
+            self._subtreeHashes = hashes
+        return self._subtreeHashes[index]
+
+    def _internName(self, name):
+        nameId = self._nameIdsByName.get(name)
+        if nameId is None:
+            nameId = len(self.names)
+            self.names.append(name)
+            self._nameIdsByName[name] = nameId
+        return nameId
+
+    # Append a call to name from the call at parentIndex and return the index of the new call.
+    def _addCall(self, parentIndex, name):
+        if not name:
+            raise ValueError("Function cannot be added without a name.")
+        index = len(self._nameIds)
+        self._subtreeHashes = None
+        self._nameIds.append(self._internName(name))
+        self._parents.append(parentIndex)
+        self._firstCalls.append(-1)
+        self._nextCalls.append(-1)
+        self._lastCalls.append(-1)
+        self._linkCall(parentIndex, index)
+        return index
+
+    # Add a call to name entered at time (None if the recording has no times) and return its index.
+    # A call's duration holds the time it was entered until it exits.
+    def _enterCall(self, parentIndex, name, time):
+        if (time is None) != (self._durations is None):
+            if time is None or len(self._nameIds) > 1:
+                raise ValueError("Recording has events with and without times.")
+            self._durations = array('d', [0.0])
+        index = self._addCall(parentIndex, name)
+        if time is not None:
+            self._durations.append(time)
+        return index
+
+    # Exit the call at index at time and return the index of its parent.
+    def _exitCall(self, index, time):
+        if (time is None) != (self._durations is None):
+            raise ValueError("Recording has events with and without times.")
+        if time is not None:
+            self._durations[index] = time - self._durations[index]
+        return self._parents[index]
+
+    # Make the call at index the last call from the call at parentIndex.
+    def _linkCall(self, parentIndex, index):
+        lastCall = self._lastCalls[parentIndex]
+        if lastCall < 0:
+            self._firstCalls[parentIndex] = index
+        else:
+            self._nextCalls[lastCall] = index
+        self._lastCalls[parentIndex] = index
+
+    @staticmethod
+    def fromRecord(string):
+        return CompactCCT.fromRecordStream(_iterLines(string))
+
+    # Build a CompactCCT from a recording on disk, parsing its threads in several processes if
+    # processes is greater than 1.
+    @staticmethod
+    def fromRecordFile(filename, processes = 1):
+        if processes > 1:
+            return _parseRecordFileInParallel(filename, processes)
+        with open(filename, 'r', _RECORD_BUFFER_SIZE) as inFile:
+            return CompactCCT.fromRecordStream(inFile)
+
+    @staticmethod
+    def fromRecordStream(lines):
+        symbols = {}
+        cct = CompactCCT._fromEvents(_recordEvents(lines, symbols))
+        if symbols:
+            cct._renameFunctions(symbols)
+        return cct
+
+    @staticmethod
+    def fromBinaryRecord(data):
+        return CompactCCT.fromBinaryRecordFile(io.BytesIO(data))
+
+    @staticmethod
+    def fromBinaryRecordFile(file):
+        if not isinstance(file, basestring):
+            return CompactCCT._fromEvents(_binaryRecordEvents(file))
+        with open(file, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+            return CompactCCT._fromEvents(_binaryRecordEvents(inFile))
+
+    @staticmethod
+    def _fromEvents(events):
+        tree = CompactCCT()
+        currentIndexByThread = {}
+        for threadId, entering, functionName, time in events:
+            # Recordings without times skip the checks of _enterCall and _exitCall.
+            timed = time is not None or tree._durations is not None
+            if entering:
+                if timed:
+                    currentIndexByThread[threadId] = tree._enterCall(currentIndexByThread.get(threadId, 0), functionName, time)
+                else:
+                    currentIndexByThread[threadId] = tree._addCall(currentIndexByThread.get(threadId, 0), functionName)
+            else:
+                currentIndex = currentIndexByThread.get(threadId, 0)
+                if currentIndex == 0 or tree.names[tree._nameIds[currentIndex]] != functionName:
+                    raise AssertionError("Incorrect nesting found when exiting " + functionName)
+                if timed:
+                    currentIndexByThread[threadId] = tree._exitCall(currentIndex, time)
+                else:
+                    currentIndexByThread[threadId] = tree._parents[currentIndex]
+        for threadId, index in currentIndexByThread.items():
+            if index != 0:
+                raise AssertionError("Incorrect nesting found when exiting " + tree.names[tree._nameIds[index]])
+        return tree
+
+    # Load a recording in any format (see: loadRecordingFile), reusing the cache file next to it
+    # (see: fromCacheFile) if the cache was built from the same recording, and writing the cache
+    # otherwise. The cache only saves time, so failing to write it is not an error.
+    @staticmethod
+    def fromRecordFileWithCache(filename, processes = 1, cacheFilename = None):
+        if cacheFilename is None:
+            cacheFilename = filename + _CCT_CACHE_SUFFIX
+        tree = CompactCCT.fromCacheFile(cacheFilename, filename)
+        if tree is not None:
+            return tree
+        tree = _loadRecordingFile(filename, processes, CompactCCT)
+        try:
+            tree.writeCacheFile(cacheFilename, filename)
+        except (IOError, OSError):
+            pass
+        return tree
+
+    # Load the cache file next to a recording (see: fromRecordFileWithCache) without loading the
+    # recording. Returns None if there is no cache built from the recording.
+    @staticmethod
+    def fromRecordFileCache(filename):
+        return CompactCCT.fromCacheFile(filename + _CCT_CACHE_SUFFIX, filename)
+
+    # Load a CompactCCT from a cache file written by writeCacheFile. The cache is memory-mapped and
+    # its columns are copied straight into arrays, so there is nothing to parse. Returns None if
+    # the cache does not exist, is invalid, or was not built from the recording at sourceFilename.
+    @staticmethod
+    def fromCacheFile(cacheFilename, sourceFilename):
+        headerSize = struct.calcsize(_CCT_CACHE_HEADER_FORMAT)
+        try:
+            with open(cacheFilename, 'rb') as inFile:
+                cacheMap = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+        try:
+            if len(cacheMap) < headerSize:
+                return None
+            header, size, mtime, digest, callCount, namesSize, timed = struct.unpack(_CCT_CACHE_HEADER_FORMAT, cacheMap[:headerSize])
+            columnSize = callCount * array('i').itemsize
+            durationsSize = 0
+            if timed:
+                durationsSize = callCount * array('d').itemsize
+            if header != _CCT_CACHE_HEADER or len(cacheMap) != headerSize + _CCT_CACHE_COLUMNS * columnSize + durationsSize + namesSize:
+                return None
+            try:
+                if (size, mtime, digest) != _recordFileSignature(sourceFilename):
+                    return None
+            except (IOError, OSError):
+                return None
 
+            tree = CompactCCT()
+            columns = []
+            offset = headerSize
+            for index in xrange(_CCT_CACHE_COLUMNS):
+                column = array('i')
+                column.fromstring(buffer(cacheMap, offset, columnSize))
+                columns.append(column)
+                offset += columnSize
+            tree._parents, tree._firstCalls, tree._nextCalls, tree._lastCalls, tree._nameIds = columns
+            if timed:
+                tree._durations = array('d')
+                tree._durations.fromstring(buffer(cacheMap, offset, durationsSize))
+                offset += durationsSize
+            if namesSize > 0:
+                tree.names = cacheMap[offset:offset + namesSize].split("\0")
+            tree._nameIdsByName = dict(izip(tree.names, xrange(len(tree.names))))
+            return tree
+        finally:
+            cacheMap.close()
+
+    # Write the CompactCCT to a cache file for the recording at sourceFilename. The cache is written
+    # to a temporary file and renamed, so a partly written cache is never read.
+    def writeCacheFile(self, cacheFilename, sourceFilename):
+        for name in self.names:
+            if "\0" in name:
+                raise ValueError("Function names with NUL characters cannot be cached.")
+        size, mtime, digest = _recordFileSignature(sourceFilename)
+        names = "\0".join(self.names)
+        tempFilename = cacheFilename + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tempFilename, 'wb') as outFile:
+                timed = int(self._durations is not None)
+                outFile.write(struct.pack(_CCT_CACHE_HEADER_FORMAT, _CCT_CACHE_HEADER, size, mtime, digest, len(self._nameIds), len(names), timed))
+                for column in [self._parents, self._firstCalls, self._nextCalls, self._lastCalls, self._nameIds]:
+                    column.tofile(outFile)
+                if timed:
+                    self._durations.tofile(outFile)
+                outFile.write(names)
+            os.rename(tempFilename, cacheFilename)
+        finally:
+            if os.path.exists(tempFilename):
+                os.remove(tempFilename)
+
+    # Copy the calls of an existing CCT into a new CompactCCT.
+    @staticmethod
+    def fromCCT(cct):
+        tree = CompactCCT()
+        indices = []
+        for event, function in walk(cct):
+            if event == EXIT:
+                indices.pop()
+            elif indices:
+                indices.append(tree._addCall(indices[-1], function.name))
+                if function.duration is not None:
+                    if tree._durations is None:
+                        tree._durations = array('d', [0.0]) * (len(tree) - 1)
+                    tree._durations.append(function.duration)
+            else:
+                indices.append(0)
+        return tree
+
+    # Demangling only needs to rewrite the table of names.
+    def demangle(self, demangler):
+        self._renameFunctions(_demangleNames(demangler, self.names))
+
+    def _renameFunctions(self, nameMap):
+        self._subtreeHashes = None
+        oldNames = self.names
+        self.names = []
+        self._nameIdsByName = {}
+        nameIdMap = [self._internName(nameMap[name]) for name in oldNames]
+        if len(self.names) != len(oldNames):
+            # Several old names were renamed to the same name.
+            for index in xrange(1, len(self._nameIds)):
+                self._nameIds[index] = nameIdMap[self._nameIds[index]]
+
+# CompactCCT cache files start with a header of the size, modification time and digest of the
+# recording they were built from, the number of calls, the size of the name table and whether the
+# recording has times, followed by the parent, first call, next call, last call and name id
+# columns, the duration column if the recording has times, and the function names separated by
+# NUL characters.
+_CCT_CACHE_HEADER = "CCTCACH2"
+_CCT_CACHE_HEADER_FORMAT = "=8sQd20sQQQ"
+_CCT_CACHE_COLUMNS = 5
+_CCT_CACHE_SUFFIX = ".cctb"
+# Only this much of the start and end of a recording is hashed, so checking a cache stays fast for
+# recordings of several gigabytes.
+_CCT_CACHE_DIGEST_SIZE = 1 << 16
+
+# Return the size, modification time and digest identifying the contents of a recording.
+def _recordFileSignature(filename):
+    stat = os.stat(filename)
+    size = stat.st_size
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as inFile:
+        digest.update(inFile.read(_CCT_CACHE_DIGEST_SIZE))
+        if size > _CCT_CACHE_DIGEST_SIZE:
+            inFile.seek(max(_CCT_CACHE_DIGEST_SIZE, size - _CCT_CACHE_DIGEST_SIZE))
+            digest.update(inFile.read())
+    return size, stat.st_mtime, digest.digest()
+
+# A Function in an AggregatedCCT, standing for every call with the same call name stack. count is
+# the number of those calls, and callsPerParent maps a number of calls N to the number of parent
+# calls that made exactly N of them.
+class AggregatedFunction(Function):
+
+    def __init__(self, name):
+        Function.__init__(self, name)
+        self.count = 0
+        self.callsPerParent = defaultdict(int)
+        self._callsByName = {}
+
+    def addCall(self, call):
+        if call.name in self._callsByName:
+            raise ValueError("Function already calls an aggregated Function named " + call.name + ".")
+        Function.addCall(self, call)
+        self._callsByName[call.name] = call
+
+    # The number of calls to name from every call this Function stands for.
+    def callCountToFunctionName(self, name):
+        call = self._callsByName.get(name)
+        if call is None:
+            return 0
+        return call.count
+
+    # The most calls to this Function made by a single parent call.
+    def mostCallsPerParent(self):
+        if not self.callsPerParent:
+            return 0
+        return max(self.callsPerParent)
+
+    # The number of calls to this Function from parent calls that made more than count of them.
+    def callsFromParentsWithMoreCallsThan(self, count):
+        return sum(calls * parents for calls, parents in self.callsPerParent.iteritems() if calls > count)
+
+    # Aggregated Functions with the same subtree also stand for the same numbers of calls from each
+    # parent call.
+    def _hashKey(self):
+        return self.name, tuple(sorted(self.callsPerParent.iteritems()))
+
+    def _callNamed(self, name):
+        call = self._callsByName.get(name)
+        if call is None:
+            call = AggregatedFunction(name)
+            self.addCall(call)
+        return call
+
+    # Record that one call to this Function made callCounts[name] calls to each name.
+    def _addCallsPerParent(self, callCounts):
+        for name, count in callCounts.iteritems():
+            self._callsByName[name].callsPerParent[count] += 1
+
+    # Renaming can give several calls from a Function the same name, and those calls are merged.
+    # Which parent call made each call is not kept, so merged calls are counted in callsPerParent
+    # as if they were made by different parent calls.
+    def _renameFunctions(self, nameMap):
+        for function in preOrder(self):
+            function._subtreeHash = None
+            if function.name:
+                function.name = nameMap[function.name]
+        # Merge calls with the same name, parents before their calls.
+        stack = [self]
+        while stack:
+            function = stack.pop()
+            calls = function.calls
+            function.calls = []
+            function._callsByName = {}
+            function._callCountsByName = defaultdict(int)
+            for call in calls:
+                mergedCall = function._callsByName.get(call.name)
+                if mergedCall is None:
+                    call.parent = None
+                    function.addCall(call)
+                    continue
+                mergedCall.count += call.count
+                if call.duration is not None:
+                    mergedCall.duration = (mergedCall.duration or 0) + call.duration
+                for calls, parents in call.callsPerParent.iteritems():
+                    mergedCall.callsPerParent[calls] += parents
+                for grandchild in call.calls:
+                    grandchild.parent = mergedCall
+                    mergedCall.calls.append(grandchild)
+            stack.extend(function.calls)
+
+# An AggregatedCCT stores each calling context once, merging every call with the same call name
+# stack into one AggregatedFunction with a call count. Call order is lost, but the counts are
+# enough to compare CCTs (see: compare.py), and programs that make many calls in loops produce
+# far smaller trees. As JSON, an AggregatedCCT only has its calling contexts.
+class AggregatedCCT(AggregatedFunction):
+
+    def __init__(self):
+        AggregatedFunction.__init__(self, None)
+        self.count = 1
+
+    def asJson(self, indent = None):
+        return json.dumps(self.calls, sort_keys=False, indent=indent, cls=FunctionJSONEncoder)
+
+    def dumpJson(self, fileobj, indent = None, compact = False):
+        _dumpJson(self.calls, fileobj, indent, compact)
+
+    def callStack(self):
+        return []
+
+    def isRoot(self):
+        return True
+
+    @staticmethod
+    def fromRecord(string):
+        return AggregatedCCT.fromRecordStream(_iterLines(string))
+
+    @staticmethod
+    def fromRecordFile(filename, processes = 1):
+        if processes > 1:
+            return AggregatedCCT.fromCCT(_parseRecordFileInParallel(filename, processes))
+        with open(filename, 'r', _RECORD_BUFFER_SIZE) as inFile:
+            return AggregatedCCT.fromRecordStream(inFile)
+
+    # Load an aggregated recording (RECORD_CCT_FORMAT=aggregate, see: record.cpp), in which the
+    # recorder has already merged the calls of each thread's calling contexts.
+    @staticmethod
+    def fromAggregateRecord(string):
+        return AggregatedCCT.fromAggregateRecordStream(_iterLines(string))
+
+    @staticmethod
+    def fromAggregateRecordFile(filename):
+        with open(filename, 'r', _RECORD_BUFFER_SIZE) as inFile:
+            return AggregatedCCT.fromAggregateRecordStream(inFile)
+
+    # Nodes are merged by name as they are read, which merges the contexts of different threads and
+    # of different addresses with the same name. Calls from the root are counted across threads,
+    # as in a tree aggregated from events.
+    @staticmethod
+    def fromAggregateRecordStream(lines):
+        lines = iter(lines)
+        if next(lines, "").rstrip("\n") != _AGGREGATE_RECORD_HEADER:
+            raise ValueError("Recording is not an aggregated recording.")
+        tree = AggregatedCCT()
+        functionsByNode = {0: tree}
+        symbols = {}
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "symbol" and len(fields) >= 4:
+                symbols["#" + fields[1]] = line.rstrip("\n").split(" ", 3)[3]
+                continue
+            if fields[0] != "node" or len(fields) not in (6, 7):
+                raise ValueError("Aggregated recording has an invalid line: " + line.rstrip("\n"))
+            parent = functionsByNode.get(int(fields[2]))
+            if parent is None:
+                raise ValueError("Aggregated recording has a node before its parent: " + line.rstrip("\n"))
+            call = parent._callNamed("#" + fields[3])
+            call.count += int(fields[4])
+            for callsAndParents in fields[5].split(","):
+                calls, parents = callsAndParents.split(":")
+                call.callsPerParent[int(calls)] += int(parents)
+            if len(fields) == 7:
+                call.duration = (call.duration or 0) + int(fields[6])
+            functionsByNode[int(fields[1])] = call
+        names = set()
+        tree._collectAllUniqueCallNames(names)
+        names.discard(None)
+        tree._renameFunctions(dict((name, symbols.get(name, name)) for name in names))
+        for call in tree.calls:
+            call.callsPerParent = defaultdict(int, {call.count: 1})
+        return tree
+
+    # Build an AggregatedCCT straight from an iterable of record lines, without building a CCT.
+    @staticmethod
+    def fromRecordStream(lines):
+        symbols = {}
+        tree = AggregatedCCT._fromEvents(_recordEvents(lines, symbols))
+        if symbols:
+            tree._renameFunctions(symbols)
+        return tree
+
+    @staticmethod
+    def fromBinaryRecord(data):
+        return AggregatedCCT.fromBinaryRecordFile(io.BytesIO(data))
+
+    @staticmethod
+    def fromBinaryRecordFile(file):
+        if not isinstance(file, basestring):
+            return AggregatedCCT._fromEvents(_binaryRecordEvents(file))
+        with open(file, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+            return AggregatedCCT._fromEvents(_binaryRecordEvents(inFile))
+
+    @staticmethod
+    def _fromEvents(events):
+        tree = AggregatedCCT()
+        # Each thread's stack of the calls being made, with the number of calls each has made by
+        # name and the time it was entered. Calls from the root are counted across threads.
+        rootCallCounts = defaultdict(int)
+        stacksByThread = {}
+        for threadId, entering, functionName, time in events:
+            stack = stacksByThread.get(threadId)
+            if stack is None:
+                stack = stacksByThread[threadId] = [(tree, rootCallCounts, None)]
+            if entering:
+                function, callCounts, startTime = stack[-1]
+                call = function._callNamed(functionName)
+                call.count += 1
+                callCounts[functionName] += 1
+                stack.append((call, defaultdict(int), time))
+            else:
+                if len(stack) == 1 or stack[-1][0].name != functionName:
+                    raise AssertionError("Incorrect nesting found when exiting " + functionName)
+                function, callCounts, startTime = stack.pop()
+                if time is not None:
+                    function.duration = (function.duration or 0) + time - startTime
+                function._addCallsPerParent(callCounts)
+        for threadId, stack in stacksByThread.items():
+            if len(stack) > 1:
+                raise AssertionError("Incorrect nesting found when exiting " + stack[-1][0].name)
+        tree._addCallsPerParent(rootCallCounts)
+        return tree
+
+    # Aggregate the calls of an existing CCT or CompactCCT.
+    @staticmethod
+    def fromCCT(cct):
+        if isinstance(cct, CompactCCT):
+            return AggregatedCCT._fromCompactCCT(cct)
+        tree = AggregatedCCT()
+        stack = []
+        for event, function in walk(cct):
+            if event == EXIT:
+                aggregatedFunction, callCounts = stack.pop()
+                aggregatedFunction._addCallsPerParent(callCounts)
+            elif stack:
+                parent, callCounts = stack[-1]
+                call = parent._callNamed(function.name)
+                call.count += 1
+                if function.duration is not None:
+                    call.duration = (call.duration or 0) + function.duration
+                callCounts[function.name] += 1
+                stack.append((call, defaultdict(int)))
+            else:
+                stack.append((tree, defaultdict(int)))
+        return tree
+
+    # Aggregate the calls of a CompactCCT in pre-order using its arrays, without creating a
+    # CompactFunction for every call.
+    @staticmethod
+    def _fromCompactCCT(compactTree):
+        tree = AggregatedCCT()
+        names = compactTree.names
+        nameIds = compactTree._nameIds
+        parents = compactTree._parents
+        firstCalls = compactTree._firstCalls
+        nextCalls = compactTree._nextCalls
+        durations = compactTree._durations
+        functions = [tree] + [None] * (len(compactTree) - 1)
+        # (parent index, name id) -> calls made by the parent call to that name.
+        callCounts = defaultdict(int)
+        index = firstCalls[0]
+        while index > 0:
+            parentIndex = parents[index]
+            call = functions[parentIndex]._callNamed(names[nameIds[index]])
+            call.count += 1
+            if durations is not None:
+                call.duration = (call.duration or 0) + durations[index]
+            functions[index] = call
+            callCounts[(parentIndex, nameIds[index])] += 1
+            if firstCalls[index] >= 0:
+                index = firstCalls[index]
+                continue
+            while index > 0 and nextCalls[index] < 0:
+                index = parents[index]
+            if index > 0:
+                index = nextCalls[index]
+        for (parentIndex, nameId), count in callCounts.iteritems():
+            functions[parentIndex]._callsByName[names[nameId]].callsPerParent[count] += 1
+        return tree
+
+    def demangle(self, demangler):
+        mangledNames = set()
+        self._collectAllUniqueCallNames(mangledNames)
+        mangledNames.discard(None)
+        self._renameFunctions(_demangleNames(demangler, mangledNames))
+
+# Aggregated recordings (see: RECORD_CCT_FORMAT=aggregate in record.cpp) start with this line.
+_AGGREGATE_RECORD_HEADER = "CCTAGGR1"
+
+# Compressed recordings are recognized by the magic bytes at their start.
+_GZIP_MAGIC = "\x1f\x8b"
+_BZ2_MAGIC = "BZh"
+_XZ_MAGIC = "\xfd7zXZ\x00"
+
+# Return "gzip", "bz2" or "xz" if a recording is compressed, or None.
+def _recordingCompression(filename):
+    with open(filename, 'rb') as inFile:
+        magic = inFile.read(len(_XZ_MAGIC))
+    if magic.startswith(_GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(_BZ2_MAGIC):
+        return "bz2"
+    if magic.startswith(_XZ_MAGIC):
+        return "xz"
+    return None
+
+# Open a recording, decompressing it as it is read if it is compressed.
+@contextmanager
+def _openRecordingFile(filename, compression):
+    if compression == "gzip":
+        with gzip.GzipFile(filename, 'rb') as gzipFile:
+            yield io.BufferedReader(gzipFile, _RECORD_BUFFER_SIZE)
+    elif compression == "bz2":
+        with bz2.BZ2File(filename, 'rb', _RECORD_BUFFER_SIZE) as bz2File:
+            yield bz2File
+    elif compression == "xz":
+        # Python 2 cannot decompress xz, so xz does.
+        proc = subprocess.Popen(["xz", "--decompress", "--stdout", filename], bufsize=_RECORD_BUFFER_SIZE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finished = False
+        try:
+            yield proc.stdout
+            # Only check that xz succeeded if the whole recording was read.
+            finished = proc.stdout.read(1) == ""
+        finally:
+            if not finished and proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            err = proc.stderr.read()
+            proc.wait()
+        if finished and proc.returncode != 0:
+            raise IOError("Could not decompress " + filename + ": " + err)
+    else:
+        with open(filename, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+            yield inFile
+
+# Load a text recording, binary recording or JSON CCT from disk as a treeType (CCT, CompactCCT or
+# AggregatedCCT), decompressing it as it is parsed if it is compressed with gzip, bzip2 or xz.
+def _loadRecordingFile(filename, processes, treeType):
+    compression = _recordingCompression(filename)
+    with _openRecordingFile(filename, compression) as inFile:
+        start = inFile.read(len(_BINARY_RECORD_HEADER))
+        if start in _BINARY_RECORD_HEADERS:
+            if compression:
+                # Binary recordings are read from both ends, so they are decompressed in memory.
+                return treeType.fromBinaryRecord(start + inFile.read())
+            return treeType.fromBinaryRecordFile(filename)
+    if start == _AGGREGATE_RECORD_HEADER:
+        if treeType is not AggregatedCCT:
+            raise ValueError("Aggregated recordings can only be loaded as an AggregatedCCT.")
+        with _openRecordingFile(filename, compression) as inFile:
+            return AggregatedCCT.fromAggregateRecordStream(inFile)
+    if start.lstrip().startswith("["):
+        with _openRecordingFile(filename, compression) as inFile:
+            cct = CCT.loadJson(inFile)
+        if treeType is not CCT:
+            return treeType.fromCCT(cct)
+        return cct
+    if compression:
+        with _openRecordingFile(filename, compression) as inFile:
+            return treeType.fromRecordStream(inFile)
+    # Only uncompressed text recordings can be split between processes.
+    return treeType.fromRecordFile(filename, processes)
+
+# Yield the (threadId, isEntering, functionName, time) events of a recording on disk in any format (see:
+# loadRecordingFile) without building a CCT. If symbols is given, the function names of recordings
+# with a symbol table are added to it.
+def recordingFileEvents(filename, symbols = None):
+    compression = _recordingCompression(filename)
+    with _openRecordingFile(filename, compression) as inFile:
+        start = inFile.read(len(_BINARY_RECORD_HEADER))
+    if start in _BINARY_RECORD_HEADERS:
+        if compression:
+            with _openRecordingFile(filename, compression) as inFile:
+                data = inFile.read()
+            for event in _binaryRecordEvents(io.BytesIO(data)):
+                yield event
+        else:
+            with open(filename, 'rb', _RECORD_BUFFER_SIZE) as inFile:
+                for event in _binaryRecordEvents(inFile):
+                    yield event
+    elif start == _AGGREGATE_RECORD_HEADER:
+        raise ValueError("Aggregated recordings have no events.")
+    elif start.lstrip().startswith("["):
+        # JSON CCTs have no events, so they are made from the CCT.
+        with _openRecordingFile(filename, compression) as inFile:
+            cct = CCT.loadJson(inFile)
+        for event in treeEvents(cct):
+            yield event
+    else:
+        with _openRecordingFile(filename, compression) as inFile:
+            for event in _recordEvents(inFile, symbols):
+                yield event
+
+# Is a recording on disk an aggregated recording (RECORD_CCT_FORMAT=aggregate, see: record.cpp),
+# compressed or not? These have no events, so they can only be loaded as an AggregatedCCT.
+def isAggregateRecordingFile(filename):
+    with _openRecordingFile(filename, _recordingCompression(filename)) as inFile:
+        return inFile.read(len(_AGGREGATE_RECORD_HEADER)) == _AGGREGATE_RECORD_HEADER
+
+# Is a recording on disk a JSON CCT, compressed or not?
+def _isJsonRecordingFile(filename):
+    with _openRecordingFile(filename, _recordingCompression(filename)) as inFile:
+        return inFile.read(len(_BINARY_RECORD_HEADER)).lstrip().startswith("[")
+
+# Yield (threadId, isEntering, functionName, time) events for the calls in a tree, as if they were
+# made by one thread named "no thread". If the tree has times, each call is entered when its
+# previous sibling exited, and exits its duration later.
+def treeEvents(tree):
+    # The time each call being walked was entered and the time its last walked call exited.
+    times = []
+    for event, function in walk(tree):
+        if function is tree:
+            continue
+        duration = function.duration
+        if duration is None:
+            yield "no thread", event == ENTER, function.name, None
+        elif event == ENTER:
+            start = 0
+            if times:
+                start = times[-1][1]
+            times.append([start, start])
+            yield "no thread", True, function.name, start
+        else:
+            end = times.pop()[0] + duration
+            if times:
+                times[-1][1] = end
+            yield "no thread", False, function.name, end
+
+# Load a recording from disk: a text recording, binary recording or JSON CCT, optionally
+# compressed with gzip, bzip2 or xz. If useCache is set the recording is loaded as a CompactCCT
+# and cached next to the recording (see: CompactCCT.fromRecordFileWithCache), unless it is a JSON
+# CCT. If aggregate is set, the recording is loaded as an AggregatedCCT. Aggregated recordings are
+# always loaded as an AggregatedCCT.
+def loadRecordingFile(filename, processes = 1, useCache = False, aggregate = False):
+    if isAggregateRecordingFile(filename):
+        # Aggregated recordings are already small, so they are not cached.
+        return _loadRecordingFile(filename, processes, AggregatedCCT)
+    # JSON CCTs are saved trees rather than recordings of a run (e.g., examples/*.json), so they
+    # are not cached either.
+    if useCache and not _isJsonRecordingFile(filename):
+        tree = CompactCCT.fromRecordFileWithCache(filename, processes)
+        if aggregate:
+            return AggregatedCCT.fromCCT(tree)
+        return tree
+    if aggregate:
+        return _loadRecordingFile(filename, processes, AggregatedCCT)
+    return _loadRecordingFile(filename, processes, CCT)
+
+# An index from every calling context in a CCT to the most calls made to that context by a single
+# Function. A calling context is interned as an integer id keyed on its parent context's id and
+# its function name, so each call name stack maps to exactly one id without hashing whole stacks.
+class ContextIndex(object):
+
+    ROOT_CONTEXT = 0
+
+    # If shard is given as (interior, units), sets of call name stacks, only calls in those contexts
+    # and below units are indexed (see: compare._walkDivergences); if units is None, only calls in
+    # interior are. The contexts below a call only depend on its call name stack, so this finds the
+    # same contexts and counts for those calls as an index of the whole CCT.
+    def __init__(self, cct, shard = None):
+        # (parent context, function name) -> [context, most calls from one parent Function]
+        self._contexts = {}
+        # The hashes of (context, subtree hash) for every Function that makes calls (see:
+        # Function.subtreeHash).
+        self._subtreeHashes = set()
+        # The context of each Function being walked, or None if it is not indexed.
+        contexts = []
+        # The call name stack of each Function being walked while shard limits the calls indexed,
+        # or None below a call in units.
+        nameStacks = []
+        interior = units = None
+        if shard is not None:
+            interior, units = shard
+        # Return the call name stack of a call to name from a Function with nameStack, None if the
+        # call is below a unit, or False if the call is not indexed.
+        def callNameStack(nameStack, name):
+            if nameStack is None:
+                return None
+            nameStack += (name,)
+            if nameStack in interior:
+                return nameStack
+            if units is not None and nameStack in units:
+                return None
+            return False
+        descend = lambda function: contexts[-1] is not None
+        for event, function in walk(cct, descend):
+            if event == EXIT:
+                contexts.pop()
+                nameStacks.pop()
+                continue
+            if not contexts:
+                context = ContextIndex.ROOT_CONTEXT
+                nameStack = None
+                if shard is not None:
+                    nameStack = ()
+            else:
+                nameStack = callNameStack(nameStacks[-1], function.name)
+                if nameStack is False:
+                    contexts.append(None)
+                    nameStacks.append(None)
+                    continue
+                context = self._contexts[(contexts[-1], function.name)][0]
+            contexts.append(context)
+            nameStacks.append(nameStack)
+            mostCallsByName = _mostCallsByName(function)
+            if mostCallsByName and context != ContextIndex.ROOT_CONTEXT:
+                self._subtreeHashes.add(hash((context, function.subtreeHash())))
+            for name, count in mostCallsByName.iteritems():
+                if callNameStack(nameStack, name) is False:
+                    continue
+                key = (context, name)
+                entry = self._contexts.get(key)
+                if entry is None:
+                    self._contexts[key] = [len(self._contexts) + 1, count]
+                elif entry[1] < count:
+                    entry[1] = count
+
+    def __len__(self):
+        return len(self._contexts)
+
+    # Return (context, most calls from one parent Function) for calls to name from parentContext,
+    # or (None, 0) if the calling context does not exist.
+    def find(self, parentContext, name):
+        entry = self._contexts.get((parentContext, name))
+        if entry is None:
+            return None, 0
+        return entry[0], entry[1]
+
+    # Return whether a Function in context has the same subtree as function (see:
+    # Function.subtreeHash).
+    def hasSubtree(self, context, function):
+        return hash((context, function.subtreeHash())) in self._subtreeHashes
+
+    # Return the context of function's call stack, or None if the call stack does not exist.
+    def contextOf(self, function):
+        context = ContextIndex.ROOT_CONTEXT
+        for name in function.callNameStack():
+            context, count = self.find(context, name)
+            if context is None:
+                return None
+        return context
+
+# Encode Functions as {"name": name, "calls": [...]} objects. Functions are encoded without
+# recursion, matching the output json would produce for the equivalent nested objects.
 class FunctionJSONEncoder(json.JSONEncoder):
 
     def default(self, function):
         if not isinstance(function, Function):
             return super(FunctionJSONEncoder, self).default(function)
 
-        jsonValue = {"name": function.name}
-        if len(function.calls) > 0:
-            jsonValue["calls"] = []
-            for call in function.calls:
-                jsonValue["calls"].append(self.default(call))
-        return jsonValue
+        jsonValues = []
+        for event, call in walk(function):
+            if event == ENTER:
+                jsonValues.append({"name": call.name})
+                continue
+            jsonValue = jsonValues.pop()
+            if not jsonValues:
+                return jsonValue
+            parentJsonValue = jsonValues[-1]
+            if "calls" not in parentJsonValue:
+                parentJsonValue["calls"] = []
+            parentJsonValue["calls"].append(jsonValue)
+
+    def iterencode(self, o, _one_shot = False):
+        if isinstance(o, Function):
+            return self._iterencodeFunctions([o], 0)
+        if isinstance(o, list) and o and all(isinstance(function, Function) for function in o):
+            return self._iterencodeFunctionList(o)
+        return super(FunctionJSONEncoder, self).iterencode(o, _one_shot)
+
+    def _newlineIndent(self, level):
+        if self.indent is None:
+            return ""
+        return "\n" + " " * (self.indent * level)
+
+    def _iterencodeFunctionList(self, functions):
+        yield "["
+        for chunk in self._iterencodeFunctions(functions, 1):
+            yield chunk
+        yield self._newlineIndent(0) + "]"
+
+    # Encode functions as the items of a list (or a single value if level is 0) whose items are
+    # indented at level.
+    def _iterencodeFunctions(self, functions, level):
+        encodeString = json.encoder.encode_basestring_ascii if self.ensure_ascii else json.encoder.encode_basestring
+        # Whether the next Function is the first item of the innermost list being encoded.
+        firstItems = [True]
+        for function in functions:
+            for event, call in walk(function):
+                if event == ENTER:
+                    if level > 0:
+                        if firstItems[-1]:
+                            yield self._newlineIndent(level)
+                            firstItems[-1] = False
+                        else:
+                            yield self.item_separator + self._newlineIndent(level)
+                    yield "{" + self._newlineIndent(level + 1) + '"name"' + self.key_separator
+                    yield encodeString(call.name) if call.name is not None else "null"
+                    if call.calls:
+                        yield self.item_separator + self._newlineIndent(level + 1) + '"calls"' + self.key_separator + "["
+                        firstItems.append(True)
+                        level += 2
+                else:
+                    if call.calls:
+                        level -= 2
+                        firstItems.pop()
+                        yield self._newlineIndent(level + 1) + "]"
+                    yield self._newlineIndent(level) + "}"
 
 class FunctionJSONDecoder(json.JSONDecoder):
 
@@ -168,12 +1611,172 @@ class FunctionJSONDecoder(json.JSONDecoder):
         json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
 
     def object_hook(self, obj):
-        if "name" not in obj:
-            return obj
-        name = obj["name"]
-        function = Function(name)
-        if "calls" in obj:
-            for call in obj["calls"]:
-                if isinstance(call, Function):
-                    function.addCall(call)
-        return function
+        return _functionFromJsonObject(obj)
+
+# Decode {"name": name, "calls": [...]} objects as Functions, and other objects as dicts.
+def _functionFromJsonObject(obj):
+    if "name" not in obj:
+        return obj
+    name = obj["name"]
+    function = Function(name)
+    if "calls" in obj:
+        for call in obj["calls"]:
+            if isinstance(call, Function):
+                function.addCall(call)
+    return function
+
+# Write the JSON encoding of Functions to a file object in chunks, rather than as one string. If
+# compact is set, no whitespace is written between items.
+def _dumpJson(value, fileobj, indent, compact):
+    separators = None
+    if compact:
+        separators = (",", ":")
+    encoder = FunctionJSONEncoder(sort_keys=False, indent=indent, separators=separators)
+    chunks = []
+    size = 0
+    for chunk in encoder.iterencode(value):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= _RECORD_BUFFER_SIZE:
+            fileobj.write("".join(chunks))
+            chunks = []
+            size = 0
+    fileobj.write("".join(chunks))
+
+# Decode a JSON string as _loadJson does, so deep trees do not need recursion.
+def _loadJsonString(string):
+    if isinstance(string, unicode):
+        string = string.encode("utf-8")
+    return _loadJson(io.BytesIO(string))
+
+# A JSON token: punctuation, a string without escapes, the start of any other string, or a number,
+# true, false or null.
+_JSON_TOKEN_RX = re.compile(r'[ \t\n\r]*(?:([\[\]{}:,])|"([^"\\\x00-\x1f]*)"|(")|(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null))')
+# The start of a Function: its name and either the start of its calls or the end of the object.
+_JSON_FUNCTION_START_RX = re.compile(r'[ \t\n\r]*\{[ \t\n\r]*"name"[ \t\n\r]*:[ \t\n\r]*"([^"\\\x00-\x1f]*)"[ \t\n\r]*(?:(,)[ \t\n\r]*"calls"[ \t\n\r]*:[ \t\n\r]*\[|\})')
+_JSON_WHITESPACE_RX = re.compile(r"[ \t\n\r]*")
+_JSON_LITERALS = {"true": True, "false": False, "null": None}
+# Keep at least this much of the file after the current token in memory, so that tokens are not
+# split by the end of the buffer.
+_JSON_LOOKAHEAD = 1 << 12
+
+# States of _loadJson: what is expected after the last token.
+_JSON_VALUE = 0
+_JSON_VALUE_OR_END_OF_LIST = 1
+_JSON_KEY = 2
+_JSON_KEY_OR_END_OF_OBJECT = 3
+_JSON_COLON = 4
+_JSON_SEPARATOR = 5
+_JSON_END = 6
+
+# Decode a JSON value from a file object, decoding Function objects as FunctionJSONDecoder does.
+# The file is read a chunk at a time and nested values are decoded with an explicit stack, so deep
+# trees do not need recursion.
+def _loadJson(fileobj):
+    buffer = ""
+    position = 0
+    endOfFile = False
+    # Each list or object being decoded, with the key of the value being decoded for objects.
+    stack = []
+    state = _JSON_VALUE
+    result = None
+    while True:
+        if len(buffer) - position < _JSON_LOOKAHEAD and not endOfFile:
+            chunk = fileobj.read(_RECORD_BUFFER_SIZE)
+            if chunk:
+                buffer = buffer[position:] + chunk
+                position = 0
+            else:
+                endOfFile = True
+            continue
+        if state == _JSON_VALUE or state == _JSON_VALUE_OR_END_OF_LIST:
+            # Decode the start of a Function, or all of a Function without calls, at once rather
+            # than a token at a time.
+            match = _JSON_FUNCTION_START_RX.match(buffer, position)
+            if match and stack:
+                name, callsStart = match.groups()
+                position = match.end()
+                if callsStart is None:
+                    container, key = stack[-1]
+                    if key is None:
+                        container.append(Function(name.decode("utf-8")))
+                    else:
+                        container[key] = Function(name.decode("utf-8"))
+                    state = _JSON_SEPARATOR
+                else:
+                    stack.append([{"name": name.decode("utf-8")}, "calls"])
+                    stack.append([[], None])
+                    state = _JSON_VALUE_OR_END_OF_LIST
+                continue
+        match = _JSON_TOKEN_RX.match(buffer, position)
+        if not match:
+            if _JSON_WHITESPACE_RX.match(buffer, position).end() == len(buffer) and state == _JSON_END:
+                return result
+            raise ValueError("Invalid JSON near: " + repr(buffer[position:position + 32]))
+        punctuation, string, stringStart, literal = match.groups()
+        position = match.end()
+
+        if punctuation is None:
+            if stringStart is not None:
+                # Decode strings with escapes using json, reading more of the file until the whole
+                # string is in the buffer.
+                while True:
+                    try:
+                        string, position = json.decoder.scanstring(buffer, position)
+                        break
+                    except ValueError:
+                        chunk = fileobj.read(_RECORD_BUFFER_SIZE)
+                        if not chunk:
+                            raise
+                        buffer += chunk
+            elif string is not None:
+                string = string.decode("utf-8")
+            if string is not None and (state == _JSON_KEY or state == _JSON_KEY_OR_END_OF_OBJECT):
+                stack[-1][1] = string
+                state = _JSON_COLON
+                continue
+            if state != _JSON_VALUE and state != _JSON_VALUE_OR_END_OF_LIST:
+                raise ValueError("Unexpected value near: " + repr(buffer[match.start():match.start() + 32]))
+            if string is not None:
+                value = string
+            elif literal in _JSON_LITERALS:
+                value = _JSON_LITERALS[literal]
+            elif "." in literal or "e" in literal or "E" in literal:
+                value = float(literal)
+            else:
+                value = int(literal)
+        elif punctuation == "{" and (state == _JSON_VALUE or state == _JSON_VALUE_OR_END_OF_LIST):
+            stack.append([{}, None])
+            state = _JSON_KEY_OR_END_OF_OBJECT
+            continue
+        elif punctuation == "[" and (state == _JSON_VALUE or state == _JSON_VALUE_OR_END_OF_LIST):
+            stack.append([[], None])
+            state = _JSON_VALUE_OR_END_OF_LIST
+            continue
+        elif punctuation == ":" and state == _JSON_COLON:
+            state = _JSON_VALUE
+            continue
+        elif punctuation == "," and state == _JSON_SEPARATOR:
+            if isinstance(stack[-1][0], dict):
+                state = _JSON_KEY
+            else:
+                state = _JSON_VALUE
+            continue
+        elif punctuation == "}" and (state == _JSON_SEPARATOR or state == _JSON_KEY_OR_END_OF_OBJECT) and isinstance(stack[-1][0], dict):
+            value = _functionFromJsonObject(stack.pop()[0])
+        elif punctuation == "]" and (state == _JSON_SEPARATOR or state == _JSON_VALUE_OR_END_OF_LIST) and isinstance(stack[-1][0], list):
+            value = stack.pop()[0]
+        else:
+            raise ValueError("Unexpected " + repr(punctuation) + " near: " + repr(buffer[match.start():match.start() + 32]))
+
+        # Add the finished value to the innermost list or object.
+        if not stack:
+            result = value
+            state = _JSON_END
+            continue
+        container, key = stack[-1]
+        if key is None:
+            container.append(value)
+        else:
+            container[key] = value
+        state = _JSON_SEPARATOR
@@ -3,9 +3,15 @@
 # compare.py - compare calling context trees.
 
 import argparse
+from collections import defaultdict
+from itertools import islice
 import json
+import multiprocessing
 import os.path
-from cct import CCT, Function
+import sys
+from cct import AggregatedFunction, CCT, CompactCCT, ContextIndex, EXIT, Function, callCountsByName, loadRecordingFile, preOrder, walk
+from demangler import DEFAULT_CACHE_FILENAME, Demangler, tryDemangleNames
+from profiling import addProfileArguments, Profiler, profilerFromArguments, reportProfile
 
 # Return the cases where a subtreeA differs from another tree. In graph theory this is the tree
 # embedding problem but to be practical on CCTs, only the following divergences are located:
@@ -15,130 +21,797 @@ from cct import CCT, Function
 #
 # Function call order is intentionally ignored because iteration order frequently depends on
 # pointers (e.g., iterating over a hash map of pointers to objects).
-def _findDivergences(subtree, otherCCT):
-    divergences = []
-    for call in subtree.calls:
-        foundStack, foundStackWithEnoughCalls = _findStack(call.callStack(), otherCCT)
+#
+# Rather than searching otherCCT for the call stack of every call, the calling contexts of
+# otherCCT are indexed once and subtree is walked in a single pass, looking up each call's
+# context from its parent's context. Calls whose whole subtree is also found in the same
+# context of otherCCT (see: Function.subtreeHash) are not walked, since nothing below them can
+# diverge, so the walk mostly visits the parts of subtree that differ.
+#
+# Either tree can be an AggregatedCCT, in which case a divergent AggregatedFunction stands for as
+# many divergences as the calls it merged that diverge (see: Divergence.count).
+#
+# If maxDivergences is given, the search stops once that many divergences have been found.
+def _findDivergences(subtree, otherCCT, otherIndex = None, maxDivergences = None):
+    if otherIndex is None:
+        otherIndex = ContextIndex(otherCCT)
+    divergences = islice(_walkDivergences(subtree, otherIndex), maxDivergences)
+    return [Divergence(call, reason, count) for call, reason, path, count in divergences]
+
+_STACK_NOT_FOUND_REASON = "Equivalent stack was not found."
 
-        if not foundStack:
-            divergences.append(Divergence(call, "Equivalent stack was not found."))
+def _insufficientCallsReason(name):
+    return "Did not find sufficient calls to " + name + "."
+
+# Yield (call, reason, path, count) for each divergence of subtree from the CCT indexed by
+# otherIndex, in pre-order. The path holds the index of each call on the way from subtree to the
+# divergent call among its parent's calls; it is only valid until the next divergence is yielded.
+# count is the number of divergent calls that call stands for.
+#
+# If shard is given as (interior, units), sets of call name stacks from subtree (see:
+# _shardContexts), only calls in those contexts and below units are walked. Calls in units and
+# below them are compared, and calls in interior are only walked through to reach units. If units
+# is None, only calls in interior are walked and compared.
+def _walkDivergences(subtree, otherIndex, shard = None):
+    # The context in otherCCT of each Function being walked, or None if it was not found, and
+    # the counts of the Function's calls by name.
+    otherContexts = [otherIndex.contextOf(subtree)]
+    callCounts = [callCountsByName(subtree.calls)]
+    # The index of each Function being walked among its parent's calls, and the number of calls
+    # of each Function that have been walked so far.
+    path = []
+    walkedCalls = [0]
+    # The call name stack of each Function being walked while shard limits the calls walked, or
+    # None below a call in units.
+    nameStacks = [None]
+    if shard is not None:
+        interior, units = shard
+        nameStacks[0] = ()
+    descend = lambda function: function is subtree or otherContexts[-1] is not None
+    for event, call in walk(subtree, descend):
+        if call is subtree:
+            continue
+        if event == EXIT:
+            otherContexts.pop()
+            callCounts.pop()
+            path.pop()
+            walkedCalls.pop()
+            nameStacks.pop()
             continue
+        path.append(walkedCalls[-1])
+        walkedCalls[-1] += 1
+        walkedCalls.append(0)
 
-        if not foundStackWithEnoughCalls:
-            divergences.append(Divergence(call, "Did not find sufficient calls to " + call.name + "."))
+        compare = True
+        nameStack = nameStacks[-1]
+        if nameStack is not None:
+            nameStack += (call.name,)
+            if nameStack in interior:
+                compare = units is None
+            elif units is not None and nameStack in units:
+                nameStack = None
+            else:
+                otherContexts.append(None)
+                callCounts.append(None)
+                nameStacks.append(None)
+                continue
+        nameStacks.append(nameStack)
+
+        otherContext, otherCallCount = otherIndex.find(otherContexts[-1], call.name)
+        otherContexts.append(otherContext)
+        if otherContext is None:
+            if compare:
+                yield call, _STACK_NOT_FOUND_REASON, path, call.count
+            callCounts.append(None)
+            continue
 
-        divergences.extend(_findDivergences(call, otherCCT))
+        if not compare:
+            pass
+        elif isinstance(call, AggregatedFunction):
+            count = call.callsFromParentsWithMoreCallsThan(otherCallCount)
+            if count > 0:
+                yield call, _insufficientCallsReason(call.name), path, count
+        elif otherCallCount < callCounts[-1][call.name]:
+            yield call, _insufficientCallsReason(call.name), path, 1
+        if otherIndex.hasSubtree(otherContext, call):
+            # The same subtree is in the same context of otherCCT, so nothing below call diverges.
+            otherContexts[-1] = None
+            callCounts.append(None)
+            continue
+        callCounts.append(callCountsByName(call.calls))
+
+# The CCTs being compared by _findDivergencesInParallel. Worker processes are forked after this is
+# set, so they share the CCTs rather than each being sent a copy.
+_parallelCCTs = None
+
+# Find the divergences of both CCTs from each other for calls in a shard of their contexts (see:
+# _walkDivergences). Divergences are returned as (path, reason, count) because Functions cannot be
+# shared between processes.
+def _findShardDivergences(shard):
+    cctA, cctB = _parallelCCTs
+    divergencePaths = []
+    for cct, otherCCT in [(cctA, cctB), (cctB, cctA)]:
+        otherIndex = ContextIndex(otherCCT, shard)
+        divergencePaths.append([(tuple(path), reason, count) for call, reason, path, count in _walkDivergences(cct, otherIndex, shard)])
+    return divergencePaths
+
+# Split the calling contexts of cctA and cctB into units that can be compared independently, since
+# the contexts below a call only depend on its call name stack. Starting with the calls from the
+# root, every context that makes calls is replaced by the contexts it calls, a level at a time,
+# until there are at least count contexts. Recordings of one thread have a single call from the
+# root (main), so its calls or theirs are split instead. Returns the replaced contexts (interior)
+# and each unit with its number of calls, as call name stacks.
+def _shardContexts(cctA, cctB, count):
+    interior = set()
+    units = {}
+    # Each context of the level being split, with its Functions in both CCTs.
+    contexts = {(): [cctA, cctB]}
+    while contexts:
+        calls = {}
+        for nameStack, functions in contexts.iteritems():
+            for function in functions:
+                for call in function.calls:
+                    calls.setdefault(nameStack + (call.name,), []).append(call)
+        for nameStack in calls:
+            interior.add(nameStack[:-1])
+        for nameStack, functions in contexts.iteritems():
+            if nameStack and nameStack not in interior:
+                units[nameStack] = sum(function.count for function in functions)
+        contexts = calls
+        if len(units) + len(contexts) >= count:
+            break
+    for nameStack, functions in contexts.iteritems():
+        units[nameStack] = sum(function.count for function in functions)
+    interior.discard(())
+    return interior, units
+
+# Find the divergences of cctA from cctB and of cctB from cctA using a pool of processes. Contexts
+# are split into units (see: _shardContexts), which are sharded across the processes, and each
+# shard indexes and compares its own units. The contexts above the units are compared first.
+# Divergences are returned in the same order as _findDivergences returns them.
+def _findDivergencesInParallel(cctA, cctB, processes):
+    global _parallelCCTs
+    interior, units = _shardContexts(cctA, cctB, processes * 4)
+    # Balance the shards by the number of calls in each unit.
+    shards = [[0, set()] for shard in xrange(processes * 4)]
+    for count, nameStack in sorted([(count, nameStack) for nameStack, count in units.iteritems()], reverse=True):
+        shard = min(shards, key=lambda shard: shard[0])
+        shard[0] += count
+        shard[1].add(nameStack)
+    shardUnits = [(interior, nameStacks) for count, nameStacks in shards if nameStacks]
+
+    _parallelCCTs = (cctA, cctB)
+    try:
+        shardDivergencePaths = [_findShardDivergences((interior, None))]
+        if len(shardUnits) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                shardDivergencePaths.extend(pool.map(_findShardDivergences, shardUnits, 1))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            shardDivergencePaths.extend(map(_findShardDivergences, shardUnits))
+    finally:
+        _parallelCCTs = None
 
+    divergences = []
+    for cctIndex, cct in enumerate([cctA, cctB]):
+        divergencePaths = []
+        for paths in shardDivergencePaths:
+            divergencePaths.extend(paths[cctIndex])
+        # Sorting paths puts the divergences in pre-order.
+        divergencePaths.sort()
+        cctDivergences = []
+        # The calls of each Function on the paths, by path, since listing the calls of a
+        # CompactFunction creates a Function for each of them.
+        callsByPath = {}
+        for path, reason, count in divergencePaths:
+            function = cct
+            for depth, index in enumerate(path):
+                calls = callsByPath.get(path[:depth])
+                if calls is None:
+                    calls = callsByPath[path[:depth]] = function.calls
+                function = calls[index]
+            cctDivergences.append(Divergence(function, reason, count))
+        divergences.append(cctDivergences)
     return divergences
 
-# A Function from one CCT that was expected but not found in a second CCT.
+# A Function from one CCT that was expected but not found in a second CCT. count is the number of
+# divergent calls the Function stands for, which is more than one for AggregatedFunctions.
 class Divergence(object):
-    def __init__(self, function, reason):
+    def __init__(self, function, reason, count = 1):
         self.function = function
         self.reason = reason
+        self.count = count
+
+# The total time spent in a calling context in two CCTs. nameStack is the context's call name
+# stack, and durationA and durationB are its time in each CCT in nanoseconds.
+class TimeChange(object):
+    def __init__(self, nameStack, durationA, durationB):
+        self.nameStack = nameStack
+        self.durationA = durationA
+        self.durationB = durationB
+
+    # The change in time as a percentage of the time in A.
+    def percentChange(self):
+        return (self.durationB - self.durationA) * 100.0 / self.durationA
+
+# Whether a CCT was built from a recording with times (see: RECORD_CCT_TIMESTAMPS in record.cpp).
+def _isTimed(cct):
+    calls = cct.calls
+    return not calls or calls[0].duration is not None
+
+# Add the time spent in each calling context of cct to durationsByContext, numbering contexts by
+# (parent context, name) in contexts, where the root's context is 0. Calls with the same call name
+# stack are one context, so their times are added.
+def _addContextDurations(cct, contexts, durationsByContext):
+    stack = []
+    for event, function in walk(cct):
+        if event == EXIT:
+            stack.pop()
+        elif stack:
+            key = (stack[-1], function.name)
+            context = contexts.get(key)
+            if context is None:
+                context = contexts[key] = len(contexts) + 1
+            durationsByContext[context] += function.duration
+            stack.append(context)
+        else:
+            stack.append(0)
 
-# Check for the following relationship between a call stack and a subtree:
-#     1) foundStack: Do the function names in the stack appear in the subtree in the correct order?
-#     2) foundStackWithEnoughCalls: Let lastCallName be the name of the last function call in the
-#        call stack. If lastCallName is called N times by the last call's parent, does the subtree
-#        contain at least N calls to lastCallName?
-def _findStack(callStack, otherSubtree):
-    function = callStack[0]
-    if len(callStack) == 1:
-        callCountToFunctionName = otherSubtree.callCountToFunctionName(function.name)
-        if callCountToFunctionName < 1:
-            return False, False
-        if callCountToFunctionName < function.parent.callCountToFunctionName(function.name):
-            return True, False
-        return True, True
-
-    foundStack = False
-    foundStackWithEnoughCalls = False
-    for otherCall in otherSubtree.calls:
-        if function.name != otherCall.name:
+# Return the calling contexts found in both cctA and cctB whose total time changed by at least
+# minPercent of their time in cctA and by at least minDuration nanoseconds, largest change first.
+def _findTimeChanges(cctA, cctB, minPercent, minDuration):
+    contexts = {}
+    durationsA = defaultdict(int)
+    durationsB = defaultdict(int)
+    _addContextDurations(cctA, contexts, durationsA)
+    _addContextDurations(cctB, contexts, durationsB)
+    changedContexts = []
+    for context, durationA in durationsA.iteritems():
+        durationB = durationsB.get(context)
+        if durationB is None or durationA <= 0:
             continue
-        nextFoundStack, nextFoundStackWithEnoughCalls = _findStack(callStack[1:], otherCall)
-        foundStack = foundStack or nextFoundStack
-        foundStackWithEnoughCalls = foundStackWithEnoughCalls or nextFoundStackWithEnoughCalls
-        if foundStackWithEnoughCalls:
-            break
-    return foundStack, foundStackWithEnoughCalls
+        change = abs(durationB - durationA)
+        if change >= minDuration and change * 100.0 >= minPercent * durationA:
+            changedContexts.append((change, context, durationA, durationB))
+    changedContexts.sort(key=lambda changedContext: changedContext[:2], reverse=True)
+
+    parents = {}
+    for (parentContext, name), context in contexts.iteritems():
+        parents[context] = (parentContext, name)
+    timeChanges = []
+    for change, context, durationA, durationB in changedContexts:
+        nameStack = []
+        while context:
+            context, name = parents[context]
+            nameStack.append(name)
+        nameStack.reverse()
+        timeChanges.append(TimeChange(nameStack, durationA, durationB))
+    return timeChanges
 
-def _loadCCT(file):
-    with open (file, 'r') as inFile:
-        data = inFile.read()
-    return CCT.fromRecord(data)
+# Format a time in nanoseconds as milliseconds.
+def _formatTime(time):
+    return "{:.3f}ms".format(time / 1e6)
 
-def _printDivergences(divergences):
+# Demangle every name in the call stacks of time changes with demangleNames, if it is given.
+def _demangleTimeChangeNames(timeChanges, demangleNames):
+    if not demangleNames:
+        return {}
+    return demangleNames(set(name for timeChange in timeChanges for name in timeChange.nameStack))
+
+# Print calling contexts whose time changed, by their call name stacks.
+def _printTimeChanges(timeChanges, aName = 'A', bName = 'B', demangledNames = None):
+    if demangledNames is None:
+        demangledNames = {}
+    if len(timeChanges) == 0:
+        print "No calling context time changes were found in the two call trees."
+        return
+    print "Time changed from " + aName + " to " + bName + " in " + str(len(timeChanges)) + " places:"
+    for timeChange in timeChanges:
+        # Contexts are printed whole, since different contexts can end with the same calls.
+        message = "  " + " -> ".join(demangledNames.get(name, name) for name in timeChange.nameStack)
+        message += ": " + _formatTime(timeChange.durationA) + " -> " + _formatTime(timeChange.durationB)
+        message += " ({:+.1f}%)".format(timeChange.percentChange())
+        print message
+
+# Write calling contexts whose time changed as JSON lines:
+#   {"type": "timeChange", "from": aName, "to": bName, "stack": [call names], "timeA": ns, "timeB": ns}
+def _writeTimeChangesAsJsonLines(outFile, timeChanges, aName = 'A', bName = 'B', demangleNames = None):
+    demangledNames = _demangleTimeChangeNames(timeChanges, demangleNames)
+    for timeChange in timeChanges:
+        stack = [demangledNames.get(name, name) for name in timeChange.nameStack]
+        timeChangeJson = {"type": "timeChange", "from": aName, "to": bName, "stack": stack, "timeA": timeChange.durationA, "timeB": timeChange.durationB}
+        outFile.write(json.dumps(timeChangeJson, sort_keys=True) + "\n")
+
+# Print divergences grouped by their last call name and penultimate call name. If demangledNames is
+# given, names are printed and grouped by their demangled names.
+def _printDivergences(divergences, demangledNames = None):
+    if demangledNames is None:
+        demangledNames = {}
     # Destructively group divergences by their last call name and penultimate call name.
     groupedDivergenceMap = {}
     for divergence in divergences:
-        key = divergence.function.name
-        if divergence.function.parent and divergence.function.parent.name:
-            key += divergence.function.parent.name
+        name = demangledNames.get(divergence.function.name, divergence.function.name)
+        parent = divergence.function.parent
+        parentName = None
+        if parent and parent.name:
+            parentName = demangledNames.get(parent.name, parent.name)
+        key = name
+        if parentName:
+            key += parentName
         if key in groupedDivergenceMap:
-            groupedDivergenceMap[key]["count"] += 1
+            groupedDivergenceMap[key]["count"] += divergence.count
         else:
             groupedDivergenceMap[key] = {}
-            groupedDivergenceMap[key]["function"] = divergence.function
-            groupedDivergenceMap[key]["count"] = 1
+            groupedDivergenceMap[key]["name"] = name
+            groupedDivergenceMap[key]["parentName"] = parentName
+            groupedDivergenceMap[key]["count"] = divergence.count
 
     for groupedDivergence in groupedDivergenceMap.values():
-        function = groupedDivergence["function"]
+        name = groupedDivergence["name"]
+        parentName = groupedDivergence["parentName"]
         count = groupedDivergence["count"]
-        parent = function.parent
         message = ""
-        if parent and parent.name:
-            message = "  " + function.name + " which was called by " + parent.name
+        if parentName:
+            message = "  " + name + " which was called by " + parentName
         else:
-            message = "  " + function.name
+            message = "  " + name
         if count > 1:
             message += " (" + str(count) + " instances)"
         print message
 
-def _printCCTDivergences(cctA, cctB, aName = 'A', bName = 'B'):
-    divergencesAB = _findDivergences(cctA, cctB)
-    divergencesBA = _findDivergences(cctB, cctA)
+# Return the names printed for divergences: the names of divergent calls and their parents.
+def _reportedNames(divergences):
+    names = set()
+    for divergence in divergences:
+        names.add(divergence.function.name)
+        parent = divergence.function.parent
+        if parent and parent.name:
+            names.add(parent.name)
+    return names
+
+# Print the divergences of cctA from cctB and of cctB from cctA. If demangleNames is given, it is
+# used to demangle only the names that are printed, so the CCTs can be compared by mangled name.
+# If profiler is given, finding, demangling and printing are measured as phases (see:
+# profiling.py). If maxDivergences is given, the search in each direction stops once that many
+# divergences have been found, and is not run in parallel.
+def _printCCTDivergences(cctA, cctB, aName = 'A', bName = 'B', processes = 1, demangleNames = None, profiler = None, maxDivergences = None):
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    with profiler.phase("find divergences") as phase:
+        if maxDivergences is not None:
+            divergencesAB = _findDivergences(cctA, cctB, maxDivergences=maxDivergences)
+            divergencesBA = _findDivergences(cctB, cctA, maxDivergences=maxDivergences)
+        elif processes > 1:
+            divergencesAB, divergencesBA = _findDivergencesInParallel(cctA, cctB, processes)
+        else:
+            divergencesAB = _findDivergences(cctA, cctB)
+            divergencesBA = _findDivergences(cctB, cctA)
+    phase.nodes = len(divergencesAB) + len(divergencesBA)
 
     if len(divergencesAB) == 0 and len(divergencesBA) == 0:
         print "No function call differences were found in the two call trees."
         return
 
-    if len(divergencesAB) > 0:
-        print aName + " diverged from " + bName + " in " + str(len(divergencesAB)) + " places:"
-        _printDivergences(divergencesAB)
+    demangledNames = None
+    if demangleNames:
+        with profiler.phase("demangle names") as phase:
+            names = _reportedNames(divergencesAB) | _reportedNames(divergencesBA)
+            demangledNames = demangleNames(names)
+        phase.nodes = len(names)
+
+    with profiler.phase("print divergences"):
+        if len(divergencesAB) > 0:
+            print aName + " diverged from " + bName + " in " + str(sum(divergence.count for divergence in divergencesAB)) + " places:"
+            _printDivergences(divergencesAB, demangledNames)
+            if len(divergencesAB) == maxDivergences:
+                print "  (stopped searching after " + str(maxDivergences) + " divergences)"
+            if len(divergencesBA) > 0:
+                print ''
+
         if len(divergencesBA) > 0:
-            print ''
+            print bName + " diverged from " + aName + " in " + str(sum(divergence.count for divergence in divergencesBA)) + " places:"
+            _printDivergences(divergencesBA, demangledNames)
+            if len(divergencesBA) == maxDivergences:
+                print "  (stopped searching after " + str(maxDivergences) + " divergences)"
+
+# Write the divergences of subtree from otherCCT to outFile as JSON lines as soon as each is found:
+#   {"type": "divergence", "from": subtreeName, "to": otherName, "stack": [call names],
+#    "reason": reason, "count": divergent calls}
+# followed by a summary line grouping them by their last call name and penultimate call name, as
+# they are printed as text (see: _printDivergences):
+#   {"type": "summary", "from": subtreeName, "to": otherName, "divergences": divergences written,
+#    "count": divergent calls, "maxDivergencesReached": false,
+#    "groups": [{"name": name, "calledBy": parent name or null, "count": divergent calls}]}
+# Divergences are not kept, so memory only grows with the number of groups. If maxDivergences is
+# given, the search stops once that many divergences have been written. If demangleNames is given,
+# names are demangled as they are first written.
+def _writeDivergencesAsJsonLines(outFile, subtree, otherCCT, subtreeName, otherName, maxDivergences = None, demangleNames = None):
+    demangledNames = {}
+    def demangle(names):
+        if demangleNames:
+            newNames = set(name for name in names if name not in demangledNames)
+            if newNames:
+                demangledNames.update(demangleNames(newNames))
+        return [demangledNames.get(name, name) for name in names]
+
+    # (name, parent name) -> divergent calls
+    groups = defaultdict(int)
+    divergenceCount = 0
+    callCount = 0
+    for call, reason, path, count in islice(_walkDivergences(subtree, ContextIndex(otherCCT)), maxDivergences):
+        nameStack = call.callNameStack()
+        stack = demangle(nameStack)
+        if reason != _STACK_NOT_FOUND_REASON:
+            # Name the call as it is named in the stack.
+            reason = _insufficientCallsReason(stack[-1])
+        divergenceJson = {"type": "divergence", "from": subtreeName, "to": otherName, "stack": stack, "reason": reason, "count": count}
+        outFile.write(json.dumps(divergenceJson, sort_keys=True) + "\n")
+        outFile.flush()
+        parentName = None
+        if len(nameStack) > 1:
+            parentName = nameStack[-2]
+        groups[(nameStack[-1], parentName)] += count
+        divergenceCount += 1
+        callCount += count
+
+    # Group by demangled names, like _printDivergences.
+    demangledGroups = defaultdict(int)
+    for (name, parentName), count in groups.iteritems():
+        if parentName is None:
+            demangledGroups[(demangle([name])[0], None)] += count
+        else:
+            demangledGroups[tuple(demangle([name, parentName]))] += count
+    groupsJson = [{"name": name, "calledBy": parentName, "count": count} for (name, parentName), count in demangledGroups.iteritems()]
+    groupsJson.sort(key=lambda group: (-group["count"], group["name"], group["calledBy"]))
+    summaryJson = {
+        "type": "summary",
+        "from": subtreeName,
+        "to": otherName,
+        "divergences": divergenceCount,
+        "count": callCount,
+        "maxDivergencesReached": divergenceCount == maxDivergences,
+        "groups": groupsJson,
+    }
+    outFile.write(json.dumps(summaryJson, sort_keys=True) + "\n")
+    outFile.flush()
+    return divergenceCount
+
+# Write the divergences of cctA from cctB and then of cctB from cctA as JSON lines (see:
+# _writeDivergencesAsJsonLines).
+def _writeCCTDivergencesAsJsonLines(outFile, cctA, cctB, aName = 'A', bName = 'B', maxDivergences = None, demangleNames = None, profiler = None):
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    for subtree, otherCCT, subtreeName, otherName in [(cctA, cctB, aName, bName), (cctB, cctA, bName, aName)]:
+        with profiler.phase("write divergences from " + otherName) as phase:
+            phase.nodes = _writeDivergencesAsJsonLines(outFile, subtree, otherCCT, subtreeName, otherName, maxDivergences, demangleNames)
+
+# Return the number of calls in a CCT of any kind, for profiling.
+def _callCount(cct):
+    if isinstance(cct, CompactCCT):
+        return len(cct) - 1
+    return sum(1 for function in preOrder(cct)) - 1
+
+# Calling contexts interned across the CCTs of a batch of recordings (see: _findBatchDivergences).
+# Each CCT is summarized once as the calls made to each of its contexts, and two summaries are
+# compared without walking either CCT, so comparing many CCTs with each other only costs one walk
+# of each CCT.
+class BatchContexts(object):
+
+    ROOT_CONTEXT = 0
+
+    def __init__(self):
+        # (parent context, function name) -> context
+        self._contexts = {}
+        # The parent context and function name of each context.
+        self.parents = [None]
+        self.names = [None]
+
+    def _context(self, parentContext, name):
+        key = (parentContext, name)
+        context = self._contexts.get(key)
+        if context is None:
+            context = self._contexts[key] = len(self.parents)
+            self.parents.append(parentContext)
+            self.names.append(name)
+        return context
+
+    # Return (callsByContext, mostCallsByContext) for cct, where callsByContext maps each context
+    # to {calls made to it by one parent Function: number of parent Functions}, like
+    # AggregatedFunction.callsPerParent, and mostCallsByContext maps each context to the most
+    # calls made to it by one parent Function.
+    def summarize(self, cct):
+        callsByContext = {}
+        contexts = []
+        for event, function in walk(cct):
+            if event == EXIT:
+                contexts.pop()
+                continue
+            if contexts:
+                context = self._context(contexts[-1], function.name)
+            else:
+                context = BatchContexts.ROOT_CONTEXT
+            contexts.append(context)
+            if not function.calls:
+                continue
+            if isinstance(function.calls[0], AggregatedFunction):
+                for call in function.calls:
+                    callsPerParent = self._callsPerParent(callsByContext, context, call.name)
+                    for calls, parents in call.callsPerParent.iteritems():
+                        callsPerParent[calls] += parents
+            else:
+                for name, calls in callCountsByName(function.calls).iteritems():
+                    self._callsPerParent(callsByContext, context, name)[calls] += 1
+        mostCallsByContext = {}
+        for context, callsPerParent in callsByContext.iteritems():
+            mostCallsByContext[context] = max(callsPerParent)
+        return callsByContext, mostCallsByContext
+
+    def _callsPerParent(self, callsByContext, parentContext, name):
+        context = self._context(parentContext, name)
+        callsPerParent = callsByContext.get(context)
+        if callsPerParent is None:
+            callsPerParent = callsByContext[context] = defaultdict(int)
+        return callsPerParent
+
+    # Return the number of divergent calls of a summarized CCT from another summarized CCT by the
+    # name of the divergent call and its parent's name. These are the divergences
+    # _walkDivergences finds: calls whose context is not in the other CCT although their parent's
+    # is, and calls from a parent Function that made more calls to their context than any Function
+    # in the other CCT.
+    def divergenceCounts(self, summary, otherSummary):
+        callsByContext, mostCallsByContext = summary
+        otherCallsByContext, otherMostCallsByContext = otherSummary
+        parents = self.parents
+        names = self.names
+        counts = defaultdict(int)
+        for context, callsPerParent in callsByContext.iteritems():
+            otherMostCalls = otherMostCallsByContext.get(context)
+            if otherMostCalls is None:
+                parentContext = parents[context]
+                if parentContext != BatchContexts.ROOT_CONTEXT and parentContext not in otherCallsByContext:
+                    # The parent's context diverged, so this context is not compared.
+                    continue
+                count = sum(calls * parentCount for calls, parentCount in callsPerParent.iteritems())
+            elif mostCallsByContext[context] > otherMostCalls:
+                count = sum(calls * parentCount for calls, parentCount in callsPerParent.iteritems() if calls > otherMostCalls)
+            else:
+                continue
+            counts[(names[context], names[parents[context]])] += count
+        return counts
+
+# The BatchContexts and CCT summaries being compared by _findBatchDivergences. Worker processes are
+# forked after this is set, so they share the summaries rather than each being sent a copy.
+_batchSummaries = None
+
+# Return the divergence counts of the CCT summarized at index summaryIndex of _batchSummaries from
+# the one at otherIndex (see: BatchContexts.divergenceCounts).
+def _countBatchDivergences(indexes):
+    summaryIndex, otherIndex = indexes
+    batchContexts, summaries = _batchSummaries
+    return dict(batchContexts.divergenceCounts(summaries[summaryIndex], summaries[otherIndex]))
+
+# A divergence found in some of the comparisons of a batch of recordings (see:
+# _findBatchDivergences), grouped by the name of the divergent call and its parent's name.
+# comparisons is the number of comparisons it was found in and count is the number of divergent
+# calls found in all of them.
+class BatchDivergence(object):
+    def __init__(self, name, parentName, comparisons, count):
+        self.name = name
+        self.parentName = parentName
+        self.comparisons = comparisons
+        self.count = count
+
+# Compare every CCT in badCCTs with every CCT in goodCCTs, in both directions, and return the
+# divergences of the bad CCTs from the good CCTs and of the good CCTs from the bad CCTs as lists of
+# BatchDivergences, the divergences found in the most comparisons first, and the number of
+# comparisons in each direction. Each CCT is walked once to
+# summarize it (see: BatchContexts), so goodCCTs and badCCTs can be iterators that load each CCT
+# only when it is needed, and the CCT is freed once it is summarized. Comparisons are run by a
+# pool of processes if processes is more than 1. If profiler is given, summarizing each CCT and
+# comparing them are measured as phases.
+def _findBatchDivergences(goodCCTs, badCCTs, processes = 1, profiler = None):
+    global _batchSummaries
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    batchContexts = BatchContexts()
+    summaries = []
+    def summarize(cct):
+        with profiler.phase("summarize CCT " + str(len(summaries) + 1)) as phase:
+            summaries.append(batchContexts.summarize(cct))
+        phase.nodes = len(summaries[-1][0])
+    for cct in goodCCTs:
+        summarize(cct)
+    goodIndexes = range(len(summaries))
+    for cct in badCCTs:
+        summarize(cct)
+    badIndexes = range(len(goodIndexes), len(summaries))
+    comparisons = [(bad, good) for bad in badIndexes for good in goodIndexes]
+    comparisons += [(good, bad) for bad in badIndexes for good in goodIndexes]
 
-    if len(divergencesBA) > 0:
-        print bName + " diverged from " + aName + " in " + str(len(divergencesBA)) + " places:"
-        _printDivergences(divergencesBA)
+    _batchSummaries = (batchContexts, summaries)
+    try:
+        with profiler.phase("find divergences") as phase:
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    comparisonCounts = pool.map(_countBatchDivergences, comparisons, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                comparisonCounts = map(_countBatchDivergences, comparisons)
+        phase.nodes = len(comparisons)
+    finally:
+        _batchSummaries = None
+
+    # The first half of the comparisons are of bad CCTs from good CCTs.
+    half = len(comparisons) / 2
+    divergences = []
+    for counts in [comparisonCounts[:half], comparisonCounts[half:]]:
+        # (name, parent name) -> [comparisons, count]
+        totals = {}
+        for comparisonCount in counts:
+            for key, count in comparisonCount.iteritems():
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [0, 0]
+                total[0] += 1
+                total[1] += count
+        batchDivergences = [BatchDivergence(name, parentName, total[0], total[1]) for (name, parentName), total in totals.iteritems()]
+        batchDivergences.sort(key=lambda divergence: (-divergence.comparisons, -divergence.count, divergence.name, divergence.parentName))
+        divergences.append(batchDivergences)
+    badDivergences, goodDivergences = divergences
+    return badDivergences, goodDivergences, len(goodIndexes) * len(badIndexes)
+
+# Print batch divergences with the number of comparisons of comparisonCount they were found in.
+def _printBatchDivergences(divergences, comparisonCount, demangledNames = None):
+    if demangledNames is None:
+        demangledNames = {}
+    for divergence in divergences:
+        message = "  " + demangledNames.get(divergence.name, divergence.name)
+        if divergence.parentName:
+            message += " which was called by " + demangledNames.get(divergence.parentName, divergence.parentName)
+        message += " (in " + str(divergence.comparisons) + "/" + str(comparisonCount) + " comparisons"
+        if divergence.count > 1:
+            message += ", " + str(divergence.count) + " instances"
+        message += ")"
+        print message
+
+# Print the divergences of the bad CCTs from the good CCTs and of the good CCTs from the bad CCTs
+# that were found in at least minFrequency of the comparisons between them. If demangleNames is
+# given, it is used to demangle only the names that are printed. If profiler is given, the phases
+# of the comparison are measured.
+def _printBatchCCTDivergences(goodCCTs, badCCTs, minFrequency, processes = 1, demangleNames = None, profiler = None):
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    badDivergences, goodDivergences, comparisonCount = _findBatchDivergences(goodCCTs, badCCTs, processes, profiler)
+    minComparisons = minFrequency * comparisonCount
+    badDivergences = [divergence for divergence in badDivergences if divergence.comparisons >= minComparisons]
+    goodDivergences = [divergence for divergence in goodDivergences if divergence.comparisons >= minComparisons]
+
+    if len(badDivergences) == 0 and len(goodDivergences) == 0:
+        print "No function call differences were found consistently between the good and bad call trees."
+        return
+
+    demangledNames = None
+    if demangleNames:
+        with profiler.phase("demangle names") as phase:
+            names = set()
+            for divergence in badDivergences + goodDivergences:
+                names.add(divergence.name)
+                if divergence.parentName:
+                    names.add(divergence.parentName)
+            demangledNames = demangleNames(names)
+        phase.nodes = len(names)
+
+    with profiler.phase("print divergences"):
+        if len(badDivergences) > 0:
+            print "Bad runs diverged from good runs in " + str(len(badDivergences)) + " places:"
+            _printBatchDivergences(badDivergences, comparisonCount, demangledNames)
+            if len(goodDivergences) > 0:
+                print ''
+
+        if len(goodDivergences) > 0:
+            print "Good runs diverged from bad runs in " + str(len(goodDivergences)) + " places:"
+            _printBatchDivergences(goodDivergences, comparisonCount, demangledNames)
 
 def main():
     parser = argparse.ArgumentParser(description="Compare calling context trees")
-    parser.add_argument("recordingA", help="Recording for run A")
-    parser.add_argument("recordingB", help="Recording for run B")
+    parser.add_argument("recordingA", nargs="?", help="Recording for run A")
+    parser.add_argument("recordingB", nargs="?", help="Recording for run B")
+    parser.add_argument("--good", nargs="+", metavar="RECORDING", help="Recordings of good runs to compare with every recording of a bad run, instead of recordings A and B")
+    parser.add_argument("--bad", nargs="+", metavar="RECORDING", help="Recordings of bad runs to compare with every recording of a good run")
+    parser.add_argument("--min-frequency", type=float, default=0.5, metavar="FRACTION", help="Only print divergences found in at least FRACTION of the comparisons of good and bad runs (default: 0.5)")
     parser.add_argument("-d", "--demangler", help="Demangler")
+    parser.add_argument("--demangle-cache", help="File caching demangled names across runs (default for the built-in demangler: " + DEFAULT_CACHE_FILENAME + ")")
+    parser.add_argument("--demangle-trees", action="store_true", help="Demangle every name before comparing, so names that demangle the same are compared as one")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used to parse and compare (with --max-divergences or --format jsonl, only to parse)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the parsed recordings cached next to them (recording.cctb)")
+    parser.add_argument("--aggregate", action="store_true", help="Merge calls with the same call stack before comparing, which is much faster for programs that make many calls in loops")
+    parser.add_argument("--time-change", type=float, metavar="PERCENT", help="Also print calling contexts whose time changed by at least PERCENT (requires recordings with times)")
+    parser.add_argument("--min-time", type=float, default=1.0, metavar="MS", help="Only print calling contexts whose time changed by at least MS milliseconds (default: 1)")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text", help="Output format: text grouped by call names, or jsonl to write each divergence as a JSON line as soon as it is found")
+    parser.add_argument("--max-divergences", type=int, metavar="N", help="Stop searching each recording for divergences after N are found")
+    addProfileArguments(parser)
     args = parser.parse_args()
+    profiler = profilerFromArguments(args)
 
-    cctA = _loadCCT(args.recordingA)
-    cctB = _loadCCT(args.recordingB)
+    batch = args.good is not None or args.bad is not None
+    if batch:
+        if args.good is None or args.bad is None:
+            parser.error("--good and --bad must be given together")
+        if args.recordingA is not None:
+            parser.error("recordings A and B cannot be given with --good and --bad")
+        if args.time_change is not None:
+            parser.error("--time-change cannot be used with --good and --bad")
+        if args.format != "text" or args.max_divergences is not None:
+            parser.error("--format and --max-divergences cannot be used with --good and --bad")
+    elif args.recordingB is None:
+        parser.error("recordings A and B, or --good and --bad, are required")
 
     if args.demangler:
-        cctA.demangle(args.demangler)
-        cctB.demangle(args.demangler)
+        demangler = Demangler(args.demangler, args.demangle_cache)
+        demangleNames = demangler.demangleNames
     else:
-        # Try demangling using c++filt but fail silently.
+        # Try demangling in-process, falling back to c++filt, but fail silently.
         # MacOS's c++filt version is older and strips underscores by default,
         # which is different from the latest GNU C++filt. Work around this
         # difference by forcing underscores to not be stripped using -n.
-        try:
-            cctA.demangle("c++filt -n")
-            cctB.demangle("c++filt -n")
-        except:
-            pass
+        demangler = Demangler(cacheFilename=args.demangle_cache or DEFAULT_CACHE_FILENAME)
+        demangleNames = lambda names: tryDemangleNames(demangler, names)
+
+    # The CCTs are compared by mangled name and only the names that are printed are demangled,
+    # unless every name should be demangled before comparing.
+    def loadCCT(recording):
+        with profiler.phase("load " + recording) as phase:
+            cct = loadRecordingFile(recording, args.jobs, not args.no_cache, args.aggregate)
+        if profiler.enabled:
+            phase.nodes = _callCount(cct)
+        if args.demangle_trees:
+            with profiler.phase("demangle " + recording):
+                try:
+                    cct.demangle(demangler)
+                except:
+                    if args.demangler:
+                        raise
+        return cct
+    if args.demangle_trees:
+        demangleNames = None
+
+    if batch:
+        # Each recording is loaded once, however many comparisons it is in, and only kept in
+        # memory until it is summarized (see: _findBatchDivergences).
+        goodCCTs = (loadCCT(recording) for recording in args.good)
+        badCCTs = (loadCCT(recording) for recording in args.bad)
+        _printBatchCCTDivergences(goodCCTs, badCCTs, args.min_frequency, args.jobs, demangleNames, profiler)
+        reportProfile(profiler, args)
+        return
+
+    cctA = loadCCT(args.recordingA)
+    cctB = loadCCT(args.recordingB)
+    if args.time_change is not None and not (_isTimed(cctA) and _isTimed(cctB)):
+        parser.error("--time-change requires recordings with times (see: RECORD_CCT_TIMESTAMPS)")
+
+    if args.format == "jsonl":
+        _writeCCTDivergencesAsJsonLines(sys.stdout, cctA, cctB, args.recordingA, args.recordingB, args.max_divergences, demangleNames, profiler)
+    else:
+        _printCCTDivergences(cctA, cctB, args.recordingA, args.recordingB, args.jobs, demangleNames, profiler, args.max_divergences)
+
+    if args.time_change is not None:
+        with profiler.phase("find time changes") as phase:
+            timeChanges = _findTimeChanges(cctA, cctB, args.time_change, args.min_time * 1e6)
+        phase.nodes = len(timeChanges)
+        with profiler.phase("print time changes"):
+            if args.format == "jsonl":
+                _writeTimeChangesAsJsonLines(sys.stdout, timeChanges, args.recordingA, args.recordingB, demangleNames)
+            else:
+                print ''
+                _printTimeChanges(timeChanges, args.recordingA, args.recordingB, _demangleTimeChangeNames(timeChanges, demangleNames))
 
-    _printCCTDivergences(cctA, cctB, args.recordingA, args.recordingB)
+    reportProfile(profiler, args)
 
 if __name__ == "__main__":
     main()
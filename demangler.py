@@ -0,0 +1,155 @@
+# demangler.py - demangle C++ function names.
+#
+# Demangling a large program's function names with a c++filt subprocess is slow, so a Demangler
+# demangles Itanium C++ ABI names (e.g., _Z1Av => A()) in-process using the C++ runtime's
+# __cxa_demangle, only falls back to c++filt for other names, and can keep a cache of demangled
+# names on disk that is shared across recordings and runs.
+
+import ctypes
+import ctypes.util
+import os
+import re
+import subprocess
+
+DEFAULT_COMMAND = "c++filt -n"
+# Command line tools cache demangled names here unless a demangler command is given.
+DEFAULT_CACHE_FILENAME = os.path.join(os.path.expanduser("~"), ".cache", "cct", "demangled-names")
+
+# Use a demangler command to build a map from mangled function names to demangled function names.
+# See c++filt: https://linux.die.net/man/1/c++filt
+def demangleNamesWithCommand(command, mangledNames):
+    mangledNames = list(mangledNames)
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate('\n'.join(str(e) for e in mangledNames))
+    if err != "":
+        raise AssertionError(err)
+    demangledNames = filter(None, out.split("\n"))
+
+    mangledCount = len(mangledNames)
+    demangledCount = len(demangledNames)
+    if mangledCount != demangledCount:
+        raise AssertionError("Demangling failed: tried to demangle " + str(mangledCount) + " functions but " + str(demangledCount) + " were demangled.")
+
+    demangledNameMap = {}
+    for index, mangledName in enumerate(mangledNames):
+        demangledNameMap[mangledName] = demangledNames[index]
+    return demangledNameMap
+
+# Names that no demangler changes, such as C function names.
+_PLAIN_NAME_RX = re.compile(r"^[A-Za-z][A-Za-z0-9]*(_[A-Za-z0-9]+)*$")
+
+# Load the C++ runtime's __cxa_demangle as a function returning a demangled name, or None if the
+# name could not be demangled. Returns None if the C++ runtime cannot be loaded.
+def _loadCxaDemangle():
+    for library in [ctypes.util.find_library("stdc++"), ctypes.util.find_library("c++"), "libstdc++.so.6", "libc++.1.dylib"]:
+        if not library:
+            continue
+        try:
+            runtime = ctypes.CDLL(library)
+            cxaDemangle = runtime["__cxa_demangle"]
+            free = ctypes.CDLL(None)["free"]
+        except (OSError, AttributeError):
+            continue
+        cxaDemangle.restype = ctypes.c_void_p
+        cxaDemangle.argtypes = [ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+        free.argtypes = [ctypes.c_void_p]
+
+        def demangle(name):
+            status = ctypes.c_int()
+            demangled = cxaDemangle(name, None, None, ctypes.byref(status))
+            if not demangled:
+                return None
+            try:
+                if status.value != 0:
+                    return None
+                return ctypes.string_at(demangled)
+            finally:
+                free(demangled)
+        return demangle
+    return None
+
+# Demangle function names, remembering every name that has been demangled. If command is None,
+# Itanium C++ ABI names are demangled in-process and other names use c++filt; otherwise every name
+# is demangled by command. If cacheFilename is given, demangled names are also read from and added
+# to that file, which should only be shared by Demanglers using the same command.
+class Demangler(object):
+
+    def __init__(self, command = None, cacheFilename = None):
+        self.command = command
+        self.cacheFilename = cacheFilename
+        self._cxaDemangle = None
+        if command is None:
+            self._cxaDemangle = _loadCxaDemangle()
+        self._demangledNames = {}
+        if cacheFilename and os.path.exists(cacheFilename):
+            self._readCache()
+
+    # Return a map from each of mangledNames to its demangled name.
+    def demangleNames(self, mangledNames):
+        demangledNameMap = {}
+        newNames = []
+        for name in mangledNames:
+            demangled = self._demangledNames.get(name)
+            if demangled is None:
+                newNames.append(name)
+            else:
+                demangledNameMap[name] = demangled
+        if not newNames:
+            return demangledNameMap
+
+        newDemangledNames = {}
+        commandNames = []
+        for name in newNames:
+            if self.command is None and _PLAIN_NAME_RX.match(name):
+                newDemangledNames[name] = name
+                continue
+            if self._cxaDemangle and name.startswith("_Z"):
+                demangled = self._cxaDemangle(str(name))
+                if demangled is not None:
+                    newDemangledNames[name] = demangled
+                    continue
+            commandNames.append(name)
+        if commandNames:
+            newDemangledNames.update(demangleNamesWithCommand(self.command or DEFAULT_COMMAND, commandNames))
+
+        self._demangledNames.update(newDemangledNames)
+        demangledNameMap.update(newDemangledNames)
+        if self.cacheFilename:
+            self._appendToCache(newDemangledNames)
+        return demangledNameMap
+
+    # The cache is a file of "[mangled name]\t[demangled name]" lines.
+    def _readCache(self):
+        try:
+            with open(self.cacheFilename, 'r') as cacheFile:
+                for line in cacheFile:
+                    entry = line.rstrip("\n").split("\t")
+                    if len(entry) == 2:
+                        self._demangledNames[entry[0]] = entry[1]
+        except IOError:
+            pass
+
+    # Add names to the cache in a single append, so Demanglers in concurrent runs can share a cache.
+    def _appendToCache(self, demangledNameMap):
+        lines = []
+        for name, demangled in demangledNameMap.iteritems():
+            entry = str(name) + "\t" + str(demangled)
+            if entry.count("\t") == 1 and "\n" not in entry:
+                lines.append(entry + "\n")
+        # The cache only saves time, so failing to write it is not an error.
+        try:
+            cacheDirectory = os.path.dirname(self.cacheFilename)
+            if cacheDirectory and not os.path.isdir(cacheDirectory):
+                os.makedirs(cacheDirectory)
+            with open(self.cacheFilename, 'a') as cacheFile:
+                cacheFile.write("".join(lines))
+        except (IOError, OSError):
+            pass
+
+# Use a Demangler to build a map from mangled function names to demangled function names, mapping
+# every name to itself if demangling fails. This is for reports, where demangling is optional.
+def tryDemangleNames(demangler, mangledNames):
+    try:
+        return demangler.demangleNames(mangledNames)
+    except:
+        return dict((name, name) for name in mangledNames)
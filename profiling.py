@@ -0,0 +1,171 @@
+# profiling.py - measure the phases of an analysis.
+#
+# A Profiler records the wall time, CPU time, node count and peak RSS of each phase of a run (e.g.,
+# loading each recording, finding divergences and printing them) so it can be seen where a slow
+# run spends its time:
+#
+#   profiler = Profiler()
+#   with profiler.phase("load") as phase:
+#       cct = loadRecordingFile(filename)
+#   phase.nodes = len(cct)
+#   profiler.printReport(sys.stderr)
+#
+# A Profiler can also run each phase under cProfile and keep the profile of the slowest phase. A
+# disabled Profiler measures nothing, so code can be written with phases whether or not it is
+# being profiled.
+
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+
+# Return the peak RSS of this process in KB: its high water mark since it was last reset (see:
+# _resetPeakRss) where the platform reports one, or since the process started.
+def peakRss():
+    try:
+        with open("/proc/self/status", 'r') as inFile:
+            for line in inFile:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Darwin reports bytes rather than KB.
+        maxRss /= 1024
+    return maxRss
+
+# Reset the high water mark of this process's RSS, so the peak RSS of each phase can be measured.
+# Only Linux supports this; elsewhere peakRss keeps returning the peak since the process started.
+def _resetPeakRss():
+    try:
+        with open("/proc/self/clear_refs", 'w') as outFile:
+            outFile.write("5")
+    except (IOError, OSError):
+        pass
+
+# The CPU time used by this process and the child processes it has waited for, such as the
+# workers of a multiprocessing pool, in seconds.
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+# The measurements of one phase. Times are in seconds and peakRss is in KB. nodes is the number of
+# things the phase processed (calls, names, events or divergences), if it was set.
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.peakRss = 0
+        self.nodes = None
+
+    def asJson(self):
+        return {"name": self.name, "wallTime": self.wallTime, "cpuTime": self.cpuTime, "nodes": self.nodes, "peakRss": self.peakRss}
+
+class Profiler(object):
+
+    # If enabled is false, phases are not measured. If useCProfile is set, each phase is also run
+    # under cProfile, which slows it down, and the profile of the slowest phase is kept (see:
+    # dumpSlowestPhase).
+    def __init__(self, enabled = True, useCProfile = False):
+        self.enabled = enabled
+        self.useCProfile = useCProfile
+        self.phases = []
+        self._slowestProfile = None
+        self._slowestPhase = None
+
+    # Measure the code run in a with statement as a phase named name, returning its Phase.
+    @contextmanager
+    def phase(self, name):
+        phase = Phase(name)
+        if not self.enabled:
+            yield phase
+            return
+        profile = None
+        if self.useCProfile:
+            profile = cProfile.Profile()
+        _resetPeakRss()
+        startCpuTime = _cpuTime()
+        startTime = time.time()
+        if profile:
+            profile.enable()
+        try:
+            yield phase
+        finally:
+            if profile:
+                profile.disable()
+            phase.wallTime = time.time() - startTime
+            phase.cpuTime = _cpuTime() - startCpuTime
+            phase.peakRss = peakRss()
+            self.phases.append(phase)
+            if profile and (self._slowestPhase is None or phase.wallTime > self._slowestPhase.wallTime):
+                self._slowestPhase = phase
+                self._slowestProfile = profile
+
+    def wallTime(self):
+        return sum(phase.wallTime for phase in self.phases)
+
+    def cpuTime(self):
+        return sum(phase.cpuTime for phase in self.phases)
+
+    def asJson(self):
+        profileJson = {
+            "phases": [phase.asJson() for phase in self.phases],
+            "wallTime": self.wallTime(),
+            "cpuTime": self.cpuTime(),
+            "peakRss": max([phase.peakRss for phase in self.phases] or [0]),
+        }
+        if self._slowestPhase:
+            profileJson["profiledPhase"] = self._slowestPhase.name
+        return profileJson
+
+    def printReport(self, outFile, format = "text"):
+        if format == "json":
+            json.dump(self.asJson(), outFile, indent=2, sort_keys=True, separators=(",", ": "))
+            outFile.write("\n")
+            return
+        outFile.write("Phase                         Wall time    CPU time        Nodes  Peak RSS\n")
+        for phase in self.phases:
+            nodes = ""
+            if phase.nodes is not None:
+                nodes = "{:,}".format(phase.nodes)
+            outFile.write("{:<28}{:>10.3f}s{:>11.3f}s{:>13}{:>8.0f}MB\n".format(phase.name, phase.wallTime, phase.cpuTime, nodes, phase.peakRss / 1024.0))
+        outFile.write("{:<28}{:>10.3f}s{:>11.3f}s\n".format("total", self.wallTime(), self.cpuTime()))
+
+    # Write the cProfile profile of the slowest phase to filename, in the format read by pstats.
+    # Returns the name of the phase, or None if no phase was profiled.
+    def dumpSlowestPhase(self, filename):
+        if self._slowestProfile is None:
+            return None
+        self._slowestProfile.dump_stats(filename)
+        return self._slowestPhase.name
+
+# Add the options that profile a script's phases to an argparse parser.
+def addProfileArguments(parser):
+    parser.add_argument("--profile", action="store_true", help="Print the wall time, CPU time, node count and peak RSS of each phase to stderr")
+    parser.add_argument("--profile-format", choices=["text", "json"], default="text", help="Format of the --profile report")
+    parser.add_argument("--profile-output", metavar="FILE", help="Write the --profile report to FILE rather than stderr")
+    parser.add_argument("--profile-dump", metavar="FILE", help="Run each phase under cProfile and write the profile of the slowest phase to FILE (see: pstats)")
+
+# Return a Profiler for the options added by addProfileArguments, which is disabled unless one of
+# them was given.
+def profilerFromArguments(args):
+    enabled = args.profile or args.profile_output is not None or args.profile_dump is not None
+    return Profiler(enabled, args.profile_dump is not None)
+
+# Write the report and cProfile dump of a Profiler as asked for by the options added by
+# addProfileArguments.
+def reportProfile(profiler, args):
+    if not profiler.enabled:
+        return
+    if args.profile_dump is not None:
+        profiler.dumpSlowestPhase(args.profile_dump)
+    if args.profile_output is not None:
+        with open(args.profile_output, 'w') as outFile:
+            profiler.printReport(outFile, args.profile_format)
+    else:
+        profiler.printReport(sys.stderr, args.profile_format)
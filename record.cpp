@@ -1,10 +1,10 @@
 // Helper utility to record all function calls.
-// Compile the target executable with: -finstrument-functions record.o
+// Compile the target executable with: -finstrument-functions record.o -lpthread
 // Run the target executable with: RECORD_CCT=recording.txt
 //
 // Example:
 //   g++ -c record.cpp -o record.o
-//   g++ -finstrument-functions record.o my_program.cpp -o my_program
+//   g++ -finstrument-functions record.o my_program.cpp -lpthread -o my_program
 //   RECORD_CCT=recording.txt ./my_program
 //
 //   recording.txt will look like:
@@ -13,69 +13,629 @@
 //       [thread id] entering functionB()
 //       [thread id] exiting functionB()
 //       ... etc ...
+//
+// Set RECORD_CCT_FORMAT=ids to write function ids instead of names, followed by a table of
+// function ids, addresses and names when the recording ends:
+//       [thread id] entering #0
+//       [thread id] entering #1
+//       [thread id] exiting #1
+//       ... etc ...
+//       symbol 0 0x4005d0 main
+//       symbol 1 0x400580 functionA()
+//
+// Set RECORD_CCT_FORMAT=binary to write a compact binary recording instead (see: CCT.fromBinaryRecord
+// in cct.py). Binary recordings are a header followed by fixed-size event records and, once the
+// recording ends, a table of function names:
+//   "CCTRECB1"
+//   [uint32 thread index][uint32 0 if entering, 1 if exiting][uint32 function id] ...
+//   [uint32 function id][uint32 name length][name] ...
+//   [uint64 offset of the function name table]"CCTSYMB1"
+// Integers are written in the native byte order.
+//
+// Set RECORD_CCT_TIMESTAMPS=1 to also record when each event happened, in nanoseconds of a monotonic
+// clock. Text events are then prefixed with the time:
+//       @[nanoseconds] [thread id] entering main
+// and binary recordings start with "CCTRECT1" instead, with two more uint32s per event holding the
+// low and high halves of the time:
+//   [uint32 thread index][uint32 0 if entering, 1 if exiting][uint32 function id][uint32][uint32] ...
+//
+// Set RECORD_CCT_FORMAT=aggregate to merge calls with the same calling context instead of recording
+// every event (see: AggregatedCCT.fromAggregateRecord in cct.py). Each thread counts its calls in a
+// calling context tree in memory, and the trees are written when the recording ends, so the
+// recording's size depends on the number of distinct calling contexts rather than the number of
+// calls:
+//   CCTAGGR1
+//   node [node id] [parent node id, 0 for the root] [function id] [calls] [calls per parent] ...
+//   symbol [function id] [function address] [function]
+// where [calls per parent] lists how many parent calls made each number of calls to the node, as
+// [number of calls]:[number of parent calls] separated by commas. With RECORD_CCT_TIMESTAMPS=1,
+// each node line ends with the total nanoseconds spent in its calls.
+//
+// Recordings can be limited to the calls of interest, which also speeds up recording:
+//   RECORD_CCT_INCLUDE=regex    Only record functions whose name matches regex (e.g., '^blink::').
+//                               Calls to other functions are skipped but their callees are not.
+//   RECORD_CCT_TRIGGER=regex    Only record calls made while a function whose name matches regex is
+//                               running on the same thread (e.g., 'FrameView::layout\(\)$').
+//   RECORD_CCT_MAX_DEPTH=n      Only record calls nested at most n recorded calls deep.
+// Names are matched after demangling, and filter decisions are cached for each function address.
+//
+// Each thread appends events to its own buffer without taking any locks. Full buffers are handed to
+// a background writer thread which looks up function names (once per function address) and writes
+// the recording, so instrumented threads never block each other.
 
+#include <cxxabi.h>
 #include <dlfcn.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <cstdlib>
+#include <cstring>
 #include <fstream>
+#include <functional>
+#include <map>
 #include <mutex>
+#include <regex>
+#include <string>
 #include <thread>
+#include <unordered_map>
+#include <vector>
 
 namespace {
 
-// True while in recording logic that should not be recorded.
-static bool g_in_record = false;
+// True while in recording logic that should not be recorded. The writer thread never records.
+static thread_local bool t_in_record = false;
 
-static std::mutex mut;
 static std::ofstream* g_file;
+// True from when the recording file is opened until the recording is finished.
+static std::atomic<bool> g_recording(false);
+
+static const char kBinaryHeader[] = "CCTRECB1";
+static const char kTimedBinaryHeader[] = "CCTRECT1";
+static const char kBinaryFooter[] = "CCTSYMB1";
+static const char kAggregateHeader[] = "CCTAGGR1";
+static const size_t kBinaryMagicLength = 8;
+
+struct BinaryEvent {
+  uint32_t thread;
+  uint32_t exiting;
+  uint32_t function;
+};
+
+struct TimedBinaryEvent {
+  uint32_t thread;
+  uint32_t exiting;
+  uint32_t function;
+  uint32_t time_low;
+  uint32_t time_high;
+};
+
+enum class Format { kText, kIds, kBinary, kAggregate };
+static Format g_format = Format::kText;
+// True if events are timestamped (see: RECORD_CCT_TIMESTAMPS above).
+static bool g_timestamps = false;
+
+// Number of events each thread buffers before handing them to the writer thread.
+static const size_t kBufferEvents = 1 << 13;
+
+struct Event {
+  void* function;
+  bool exiting;
+  uint64_t time;
+};
+
+struct ThreadState;
+
+struct Buffer {
+  Buffer* next;
+  ThreadState* thread;
+  size_t size;
+  Event events[kBufferEvents];
+};
+
+// A calling context in a thread's AggregateTree.
+struct AggregateNode {
+  uint32_t parent;
+  void* function;
+  uint64_t calls;
+  // Nanoseconds spent in the calls that have exited.
+  uint64_t duration;
+  // The calls to this node made by the parent call with activation parent_activation, which are
+  // added to calls_per_parent once another parent call calls this node or the recording ends.
+  uint64_t parent_activation;
+  uint64_t parent_calls;
+  // The node of the last call this node made, which loops usually call again. 0 if none.
+  uint32_t last_call;
+  // The number of parent calls by the number of calls they made to this node.
+  std::map<uint64_t, uint64_t> calls_per_parent;
+};
+
+// A call being made, identified by its activation: the number of calls the thread had entered.
+struct AggregateFrame {
+  uint32_t node;
+  uint64_t activation;
+  uint64_t enter_time;
+};
+
+struct AggregateKeyHash {
+  __attribute__((no_instrument_function))
+  size_t operator()(const std::pair<uint32_t, void*>& key) const {
+    return std::hash<void*>()(key.second) ^ (static_cast<size_t>(key.first) * 0x9e3779b97f4a7c15ull);
+  }
+};
+
+// A thread's calling context tree (see: RECORD_CCT_FORMAT=aggregate above). nodes[0] and
+// stack[0] are the root.
+struct AggregateTree {
+  std::vector<AggregateNode> nodes;
+  // Node index by (parent node index, function address).
+  std::unordered_map<std::pair<uint32_t, void*>, uint32_t, AggregateKeyHash> nodes_by_call;
+  std::vector<AggregateFrame> stack;
+  uint64_t activations;
+};
+
+// Filters (see: RECORD_CCT_INCLUDE, RECORD_CCT_TRIGGER and RECORD_CCT_MAX_DEPTH above).
+static bool g_filtering = false;
+static std::regex* g_include_filter;
+static std::regex* g_trigger_filter;
+static uint32_t g_max_depth = 0;
+
+// Filter decisions for a function.
+enum FilterFlags : uint8_t {
+  kIncluded = 1,
+  kTrigger = 2,
+};
+
+// Recording state owned by a single instrumented thread.
+struct ThreadState {
+  ThreadState* next;
+  uint32_t index;
+  std::thread::id id;
+  Buffer* buffer;
+  // The thread's calls when aggregating, or null.
+  AggregateTree* tree;
+  // Filter decisions by function address, and the number of running trigger functions and
+  // recorded functions.
+  std::unordered_map<void*, uint8_t>* filter_flags;
+  uint32_t trigger_depth;
+  uint32_t depth;
+  // True while the thread is recording an event. This lets destructor() take the buffers of
+  // threads that are still running.
+  std::atomic<bool> busy;
+};
+
+static thread_local ThreadState* t_state = nullptr;
+// Every ThreadState, pushed without locking.
+static std::atomic<ThreadState*> g_threads(nullptr);
+static std::atomic<uint32_t> g_thread_count(0);
+// Full buffers waiting for the writer thread, newest first, pushed without locking.
+static std::atomic<Buffer*> g_full_buffers(nullptr);
+
+// These are never destroyed because static destructors run before destructor().
+static std::thread* g_writer;
+static std::mutex* g_writer_mutex;
+static std::condition_variable* g_writer_wakeup;
+static bool g_writer_stopping = false;
+
+// Function ids by address, and the address and name of each function id. Only used by the writer.
+static std::unordered_map<void*, uint32_t>* g_function_ids;
+static std::vector<void*>* g_function_addresses;
+static std::vector<std::string>* g_function_names;
+
+__attribute__((no_instrument_function))
+void writeBinaryFunctionNames() {
+  uint64_t offset = g_file->tellp();
+  for (uint32_t id = 0; id < g_function_names->size(); id++) {
+    const std::string& name = (*g_function_names)[id];
+    uint32_t length = name.size();
+    g_file->write(reinterpret_cast<const char*>(&id), sizeof(id));
+    g_file->write(reinterpret_cast<const char*>(&length), sizeof(length));
+    g_file->write(name.data(), length);
+  }
+  g_file->write(reinterpret_cast<const char*>(&offset), sizeof(offset));
+  g_file->write(kBinaryFooter, kBinaryMagicLength);
+}
+
+__attribute__((no_instrument_function))
+void writeTextFunctionNames() {
+  for (uint32_t id = 0; id < g_function_names->size(); id++) {
+    *g_file << "symbol " << id << " " << (*g_function_addresses)[id] << " "
+            << (*g_function_names)[id] << "\n";
+  }
+}
+
+__attribute__((no_instrument_function))
+uint32_t functionId(void* function) {
+  auto found = g_function_ids->find(function);
+  if (found != g_function_ids->end())
+    return found->second;
+  uint32_t id = g_function_names->size();
+  Dl_info info;
+  g_function_names->push_back(dladdr(function, &info) && info.dli_sname ? info.dli_sname : "?");
+  g_function_addresses->push_back(function);
+  g_function_ids->emplace(function, id);
+  return id;
+}
+
+__attribute__((no_instrument_function))
+void writeBuffer(const Buffer* buffer) {
+  if (g_format == Format::kBinary && g_timestamps) {
+    static TimedBinaryEvent binary_events[kBufferEvents];
+    for (size_t i = 0; i < buffer->size; i++) {
+      const Event& event = buffer->events[i];
+      binary_events[i] = {buffer->thread->index, event.exiting ? 1u : 0u, functionId(event.function),
+                          static_cast<uint32_t>(event.time), static_cast<uint32_t>(event.time >> 32)};
+    }
+    g_file->write(reinterpret_cast<const char*>(binary_events), buffer->size * sizeof(TimedBinaryEvent));
+    return;
+  }
+  if (g_format == Format::kBinary) {
+    static BinaryEvent binary_events[kBufferEvents];
+    for (size_t i = 0; i < buffer->size; i++) {
+      const Event& event = buffer->events[i];
+      binary_events[i] = {buffer->thread->index, event.exiting ? 1u : 0u, functionId(event.function)};
+    }
+    g_file->write(reinterpret_cast<const char*>(binary_events), buffer->size * sizeof(BinaryEvent));
+    return;
+  }
+
+  for (size_t i = 0; i < buffer->size; i++) {
+    const Event& event = buffer->events[i];
+    uint32_t id = functionId(event.function);
+    if (g_timestamps)
+      *g_file << "@" << event.time << " ";
+    *g_file << "tid" << buffer->thread->id;
+    *g_file << " " << (event.exiting ? "exiting" : "entering");
+    if (g_format == Format::kIds)
+      *g_file << " #" << id;
+    else
+      *g_file << " " << (*g_function_names)[id];
+    *g_file << "\n";
+  }
+}
+
+// Add the calls made to a node by its last parent call to its calls per parent.
+__attribute__((no_instrument_function))
+void finishParentCalls(AggregateNode* node) {
+  if (node->parent_calls > 0)
+    node->calls_per_parent[node->parent_calls]++;
+  node->parent_calls = 0;
+}
+
+__attribute__((no_instrument_function))
+void aggregateEvent(ThreadState* state, void* function, bool is_enter, uint64_t time) {
+  AggregateTree* tree = state->tree;
+  if (!tree) {
+    tree = state->tree = new AggregateTree();
+    tree->nodes.push_back(AggregateNode{0, nullptr, 0, 0, 0, 0, 0, {}});
+    tree->stack.push_back(AggregateFrame{0, 0, 0});
+    tree->activations = 0;
+  }
+  if (is_enter) {
+    AggregateFrame parent = tree->stack.back();
+    uint32_t index = tree->nodes[parent.node].last_call;
+    if (index == 0 || tree->nodes[index].function != function) {
+      auto found = tree->nodes_by_call.emplace(std::make_pair(parent.node, function), tree->nodes.size());
+      if (found.second)
+        tree->nodes.push_back(AggregateNode{parent.node, function, 0, 0, parent.activation, 0, 0, {}});
+      index = found.first->second;
+      tree->nodes[parent.node].last_call = index;
+    }
+    AggregateNode& node = tree->nodes[index];
+    if (node.parent_activation != parent.activation) {
+      finishParentCalls(&node);
+      node.parent_activation = parent.activation;
+    }
+    node.parent_calls++;
+    node.calls++;
+    tree->stack.push_back(AggregateFrame{index, ++tree->activations, time});
+    return;
+  }
+  // Exits that do not match a call being made, such as exits of calls entered before recording
+  // started, are ignored.
+  for (size_t depth = tree->stack.size() - 1; depth > 0; depth--) {
+    const AggregateFrame& frame = tree->stack[depth];
+    if (tree->nodes[frame.node].function == function) {
+      tree->nodes[frame.node].duration += time - frame.enter_time;
+      tree->stack.resize(depth);
+      return;
+    }
+  }
+}
+
+// Write every thread's calling context tree, numbering nodes across threads.
+__attribute__((no_instrument_function))
+void writeAggregateTrees() {
+  std::vector<ThreadState*> threads;
+  for (ThreadState* state = g_threads.load(std::memory_order_acquire); state; state = state->next)
+    threads.push_back(state);
+  *g_file << kAggregateHeader << "\n";
+  uint64_t offset = 0;
+  for (auto thread = threads.rbegin(); thread != threads.rend(); ++thread) {
+    AggregateTree* tree = (*thread)->tree;
+    if (!tree)
+      continue;
+    for (uint32_t index = 1; index < tree->nodes.size(); index++) {
+      AggregateNode& node = tree->nodes[index];
+      finishParentCalls(&node);
+      *g_file << "node " << offset + index << " " << (node.parent ? offset + node.parent : 0) << " "
+              << functionId(node.function) << " " << node.calls << " ";
+      const char* separator = "";
+      for (const auto& calls : node.calls_per_parent) {
+        *g_file << separator << calls.first << ":" << calls.second;
+        separator = ",";
+      }
+      if (g_timestamps)
+        *g_file << " " << node.duration;
+      *g_file << "\n";
+    }
+    offset += tree->nodes.size() - 1;
+  }
+}
+
+// Write and free every full buffer, in the order they were handed off.
+__attribute__((no_instrument_function))
+void writeFullBuffers() {
+  Buffer* newest = g_full_buffers.exchange(nullptr, std::memory_order_acquire);
+  Buffer* oldest = nullptr;
+  while (newest) {
+    Buffer* next = newest->next;
+    newest->next = oldest;
+    oldest = newest;
+    newest = next;
+  }
+  while (oldest) {
+    Buffer* next = oldest->next;
+    writeBuffer(oldest);
+    delete oldest;
+    oldest = next;
+  }
+}
+
+__attribute__((no_instrument_function))
+void writerMain() {
+  t_in_record = true;
+  std::unique_lock<std::mutex> lock(*g_writer_mutex);
+  while (!g_writer_stopping) {
+    // Hand-offs do not take the lock, so a wakeup can be missed; poll as well.
+    g_writer_wakeup->wait_for(lock, std::chrono::milliseconds(10));
+    lock.unlock();
+    writeFullBuffers();
+    lock.lock();
+  }
+  lock.unlock();
+  writeFullBuffers();
+}
+
+__attribute__((no_instrument_function))
+void handOffBuffer(ThreadState* state) {
+  Buffer* buffer = state->buffer;
+  state->buffer = nullptr;
+  if (!buffer)
+    return;
+  if (buffer->size == 0) {
+    delete buffer;
+    return;
+  }
+  buffer->next = g_full_buffers.load(std::memory_order_relaxed);
+  while (!g_full_buffers.compare_exchange_weak(buffer->next, buffer, std::memory_order_release,
+                                               std::memory_order_relaxed)) {
+  }
+  g_writer_wakeup->notify_one();
+}
+
+__attribute__((no_instrument_function))
+uint8_t filterFlags(ThreadState* state, void* function) {
+  auto found = state->filter_flags->find(function);
+  if (found != state->filter_flags->end())
+    return found->second;
+
+  std::string name = "?";
+  Dl_info info;
+  if (dladdr(function, &info) && info.dli_sname) {
+    name = info.dli_sname;
+    int status;
+    if (char* demangled = abi::__cxa_demangle(info.dli_sname, nullptr, nullptr, &status)) {
+      name = demangled;
+      std::free(demangled);
+    }
+  }
+  uint8_t flags = 0;
+  if (!g_include_filter || std::regex_search(name, *g_include_filter))
+    flags |= kIncluded;
+  if (g_trigger_filter && std::regex_search(name, *g_trigger_filter))
+    flags |= kTrigger;
+  state->filter_flags->emplace(function, flags);
+  return flags;
+}
+
+// Returns whether an event passes the filters, updating the thread's trigger and depth counts.
+__attribute__((no_instrument_function))
+bool passesFilters(ThreadState* state, void* function, bool is_enter) {
+  uint8_t flags = filterFlags(state, function);
+  if (is_enter && (flags & kTrigger))
+    state->trigger_depth++;
+
+  bool passes = (flags & kIncluded) && (!g_trigger_filter || state->trigger_depth > 0);
+  if (passes && g_max_depth) {
+    if (is_enter) {
+      state->depth++;
+      passes = state->depth <= g_max_depth;
+    } else {
+      passes = state->depth <= g_max_depth;
+      if (state->depth > 0)
+        state->depth--;
+    }
+  }
+
+  if (!is_enter && (flags & kTrigger) && state->trigger_depth > 0)
+    state->trigger_depth--;
+  return passes;
+}
+
+// Compile a filter regex from the environment, returning false if it is invalid.
+__attribute__((no_instrument_function))
+bool readFilter(const char* variable, std::regex** filter) {
+  const char* pattern = std::getenv(variable);
+  if (!pattern)
+    return true;
+  try {
+    *filter = new std::regex(pattern);
+  } catch (const std::regex_error& error) {
+    fprintf(stderr, "Not recording: %s is not a valid regular expression (%s).\n", variable, error.what());
+    return false;
+  }
+  g_filtering = true;
+  return true;
+}
+
+// Hands off a thread's remaining events when the thread exits.
+struct ThreadExit {
+  __attribute__((no_instrument_function))
+  ~ThreadExit() {
+    t_in_record = true;
+    t_state->busy.store(true);
+    if (g_recording.load())
+      handOffBuffer(t_state);
+    t_state->busy.store(false);
+  }
+};
+
+__attribute__((no_instrument_function))
+ThreadState* registerThread() {
+  ThreadState* state = new ThreadState();
+  state->index = g_thread_count.fetch_add(1);
+  state->id = std::this_thread::get_id();
+  state->buffer = nullptr;
+  state->tree = nullptr;
+  state->filter_flags = g_filtering ? new std::unordered_map<void*, uint8_t>() : nullptr;
+  state->trigger_depth = 0;
+  state->depth = 0;
+  state->busy.store(false);
+  state->next = g_threads.load(std::memory_order_relaxed);
+  while (!g_threads.compare_exchange_weak(state->next, state, std::memory_order_release,
+                                          std::memory_order_relaxed)) {
+  }
+  static thread_local ThreadExit thread_exit;
+  (void)thread_exit;
+  return state;
+}
 
 __attribute__((constructor, no_instrument_function))
 void constructor() {
-  g_in_record = true;
-  // TODO(phil): Improve performance when RECORD_CCT is not specified.
-  if (const char* filename = std::getenv("RECORD_CCT")) {
+  t_in_record = true;
+  const char* filename = std::getenv("RECORD_CCT");
+  if (filename && readFilter("RECORD_CCT_INCLUDE", &g_include_filter) &&
+      readFilter("RECORD_CCT_TRIGGER", &g_trigger_filter)) {
+    if (const char* max_depth = std::getenv("RECORD_CCT_MAX_DEPTH")) {
+      g_max_depth = std::strtoul(max_depth, nullptr, 10);
+      g_filtering = g_filtering || g_max_depth > 0;
+    }
+    if (const char* format = std::getenv("RECORD_CCT_FORMAT")) {
+      if (std::strcmp(format, "ids") == 0)
+        g_format = Format::kIds;
+      else if (std::strcmp(format, "binary") == 0)
+        g_format = Format::kBinary;
+      else if (std::strcmp(format, "aggregate") == 0)
+        g_format = Format::kAggregate;
+    }
+    if (const char* timestamps = std::getenv("RECORD_CCT_TIMESTAMPS"))
+      g_timestamps = std::strcmp(timestamps, "") != 0 && std::strcmp(timestamps, "0") != 0;
+    g_function_ids = new std::unordered_map<void*, uint32_t>();
+    g_function_addresses = new std::vector<void*>();
+    g_function_names = new std::vector<std::string>();
     g_file = new std::ofstream();
-    g_file->open(filename);
+    if (g_format == Format::kBinary) {
+      g_file->open(filename, std::ios::out | std::ios::binary);
+      g_file->write(g_timestamps ? kTimedBinaryHeader : kBinaryHeader, kBinaryMagicLength);
+    } else {
+      g_file->open(filename);
+    }
+    g_writer_mutex = new std::mutex();
+    g_writer_wakeup = new std::condition_variable();
+    g_writer = new std::thread(writerMain);
+    g_recording.store(true);
   }
-  g_in_record = false;
+  t_in_record = false;
 }
 
 __attribute__((destructor, no_instrument_function))
 void destructor() {
-  g_in_record = true;
-  if (g_file)
+  t_in_record = true;
+  if (g_recording.exchange(false)) {
+    // Take the remaining events of every thread, waiting for threads that are mid-event.
+    for (ThreadState* state = g_threads.load(std::memory_order_acquire); state; state = state->next) {
+      while (state->busy.load())
+        std::this_thread::yield();
+      handOffBuffer(state);
+    }
+    {
+      std::lock_guard<std::mutex> lock(*g_writer_mutex);
+      g_writer_stopping = true;
+    }
+    g_writer_wakeup->notify_one();
+    g_writer->join();
+
+    if (g_format == Format::kAggregate)
+      writeAggregateTrees();
+    if (g_format == Format::kBinary)
+      writeBinaryFunctionNames();
+    else if (g_format == Format::kIds || g_format == Format::kAggregate)
+      writeTextFunctionNames();
     g_file->close();
-  g_in_record = false;
+  }
+  t_in_record = false;
 }
 
 __attribute__((no_instrument_function))
 void record(void *dest, void *src, bool is_enter) {
-  // TODO(phil): Consider lock-free approach such as glog.
-  std::lock_guard<std::mutex> lock(mut);
-  if (!g_in_record && g_file) {
-    g_in_record = true;
-
-    // TODO(phil): Cache the dladdr call to reduce lookups (see:
-    // https://michael.hinespot.com/tutorials/gcc_trace_functions).
-    Dl_info dest_info;
-    // TODO(phil): Add a buffer for better performance (see:
-    // https://github.com/microsoft/ChakraCore/blob/master/lib/Runtime/PlatformAgnostic/Platform/Common/Trace.cpp).
-    *g_file << "tid" <<  std::this_thread::get_id();
-    *g_file << " " << (is_enter ? "entering" : "exiting");
-    *g_file << " " << (dladdr(dest, &dest_info) ? dest_info.dli_sname : "?");
-    *g_file << std::endl;
+  if (t_in_record || !g_recording.load(std::memory_order_relaxed))
+    return;
+  t_in_record = true;
+  // Read the clock first so that recording overhead is not counted in the event's time.
+  uint64_t time = 0;
+  if (g_timestamps) {
+    time = std::chrono::duration_cast<std::chrono::nanoseconds>(
+        std::chrono::steady_clock::now().time_since_epoch()).count();
+  }
 
-    g_in_record = false;
+  ThreadState* state = t_state;
+  if (!state)
+    state = t_state = registerThread();
+  state->busy.store(true);
+  if (g_recording.load() && (!g_filtering || passesFilters(state, dest, is_enter))) {
+    if (g_format == Format::kAggregate) {
+      aggregateEvent(state, dest, is_enter, time);
+    } else {
+      Buffer* buffer = state->buffer;
+      if (!buffer) {
+        buffer = state->buffer = new Buffer;
+        buffer->thread = state;
+        buffer->size = 0;
+      }
+      buffer->events[buffer->size++] = {dest, !is_enter, time};
+      if (buffer->size == kBufferEvents)
+        handOffBuffer(state);
+    }
   }
+  state->busy.store(false);
+
+  t_in_record = false;
 }
 
 }
 
+// When RECORD_CCT is not set, each instrumented call only costs a call and a load of g_recording.
 extern "C" {
   __attribute__((no_instrument_function))
   extern void __cyg_profile_func_enter(void *dest, void *src) {
-    record(dest, src, true);
+    if (__builtin_expect(g_recording.load(std::memory_order_relaxed), false))
+      record(dest, src, true);
   }
   __attribute__((no_instrument_function))
   extern void __cyg_profile_func_exit(void *dest, void *src) {
-    record(dest, src, false);
+    if (__builtin_expect(g_recording.load(std::memory_order_relaxed), false))
+      record(dest, src, false);
   }
 }
@@ -4,37 +4,355 @@
 
 import argparse
 from collections import defaultdict
+import heapq
 import json
-from cct import CCT, Function
-
-def _loadCCT(file):
-    with open (file, 'r') as inFile:
-        data = inFile.read()
-    return CCT.fromRecord(data)
-
-def _countFunctionCallNames(subtree, functionNameCount):
-    for function in subtree.calls:
-        functionNameCount[function.name] += 1
-        _countFunctionCallNames(function, functionNameCount)
-
-def _topCalledFunctionCallNames(cct, count):
-    functionNamesCount = defaultdict(int)
-    _countFunctionCallNames(cct, functionNamesCount)
-    sortedFunctionNameCount = [(functionNamesCount[name], name) for name in functionNamesCount]
-    sortedFunctionNameCount.sort()
-    sortedFunctionNameCount.reverse()
-    return sortedFunctionNameCount[:count]
+from cct import CompactCCT, EXIT, isAggregateRecordingFile, loadRecordingFile, recordingFileEvents, treeEvents, walk
+from demangler import DEFAULT_CACHE_FILENAME, Demangler, tryDemangleNames
+from profiling import addProfileArguments, profilerFromArguments, reportProfile
+
+# Return a copy of countsByName with names renamed using nameMap, adding the counts of names that
+# are renamed to the same name.
+def _renameCounts(countsByName, nameMap):
+    renamedCounts = defaultdict(int)
+    for name, count in countsByName.iteritems():
+        renamedCounts[nameMap.get(name, name)] += count
+    return renamedCounts
+
+# Return the count most called names as (count, name), most called first.
+def _topCounts(countsByName, count):
+    return heapq.nlargest(count, ((nameCount, name) for name, nameCount in countsByName.iteritems()))
+
+# Metrics of a recording, computed in a single pass over its events without building a CCT:
+#    * The number of calls to each function name.
+#    * The depth of each call, where calls from the root are at depth 1.
+#    * The fan-out of each call: the number of calls it makes.
+#    * The number of events recorded by each thread.
+#    * The number of unique calling contexts (call name stacks).
+#    * If the recording has times (see: RECORD_CCT_TIMESTAMPS in record.cpp), the inclusive time
+#      (including calls) and exclusive time (excluding calls) of each function name and calling
+#      context. A recursive function's inclusive time only counts its outermost calls.
+class RecordingStats(object):
+
+    def __init__(self):
+        self.callCountsByName = defaultdict(int)
+        self.eventCountsByThread = defaultdict(int)
+        self.callCount = 0
+        self.maxDepth = 0
+        self.maxFanOut = 0
+        self.maxFanOutName = None
+        # Whether the recording has times, and the times in nanoseconds by function name.
+        self.timed = False
+        self.inclusiveTimeByName = defaultdict(int)
+        self.exclusiveTimeByName = defaultdict(int)
+        self._totalDepth = 0
+        self._totalFanOut = 0
+        # The number of calls that made at least one call.
+        self._callingCallCount = 0
+        # (parent context, function name) -> context, where the root's context is 0.
+        self._contexts = {}
+        # Each thread's stack of [context, function name, fan-out, time entered, time in calls]
+        # for the calls being made.
+        self._stacksByThread = {}
+        # context -> [inclusive time, exclusive time]
+        self._contextTimes = {}
+        # Each thread's number of calls being made to each function name.
+        self._activeCallCountsByThread = {}
+        # Function ids to names (see: finish).
+        self._symbols = {}
+
+    def addEvents(self, events):
+        callCountsByName = self.callCountsByName
+        eventCountsByThread = self.eventCountsByThread
+        contexts = self._contexts
+        stacksByThread = self._stacksByThread
+        for threadId, entering, functionName, time in events:
+            eventCountsByThread[threadId] += 1
+            stack = stacksByThread.get(threadId)
+            if stack is None:
+                stack = stacksByThread[threadId] = []
+            if entering:
+                callCountsByName[functionName] += 1
+                if stack:
+                    parent = stack[-1]
+                    parent[2] += 1
+                    parentContext = parent[0]
+                else:
+                    parentContext = 0
+                key = (parentContext, functionName)
+                context = contexts.get(key)
+                if context is None:
+                    context = contexts[key] = len(contexts) + 1
+                stack.append([context, functionName, 0, time, 0])
+                depth = len(stack)
+                self._totalDepth += depth
+                if depth > self.maxDepth:
+                    self.maxDepth = depth
+                if time is not None:
+                    self._enterTimedCall(threadId, functionName)
+            else:
+                if not stack or stack[-1][1] != functionName:
+                    raise AssertionError("Incorrect nesting found when exiting " + functionName)
+                context, name, fanOut, startTime, callsTime = stack.pop()
+                if time is not None:
+                    self._exitTimedCall(threadId, stack, context, name, time - startTime, callsTime)
+                if fanOut > 0:
+                    self._callingCallCount += 1
+                    self._totalFanOut += fanOut
+                    if fanOut > self.maxFanOut:
+                        self.maxFanOut = fanOut
+                        self.maxFanOutName = name
+        self.callCount = sum(callCountsByName.itervalues())
+
+    # Add the calls of an AggregatedCCT (see: cct.py), whose calls are counted as if made by one
+    # thread. The fan-out of each call it merged is not kept, so the number of calls that made calls
+    # is counted from the call made by the most of them, and the maximum fan-out is the sum of the
+    # most calls made by a single call to each function it calls. Both are exact for calls that call
+    # one function.
+    def addAggregatedCCT(self, tree):
+        callCountsByName = self.callCountsByName
+        contexts = self._contexts
+        # The context of each call being walked, starting with the root's.
+        contextStack = [0]
+        # The number of calls being walked to each function name.
+        activeCallCounts = defaultdict(int)
+        callCount = 0
+        for event, function in walk(tree):
+            if function is tree:
+                continue
+            name = function.name
+            if event == EXIT:
+                contextStack.pop()
+                activeCallCounts[name] -= 1
+                continue
+            callCountsByName[name] += function.count
+            callCount += function.count
+            key = (contextStack[-1], name)
+            context = contexts.get(key)
+            if context is None:
+                context = contexts[key] = len(contexts) + 1
+            contextStack.append(context)
+            depth = len(contextStack) - 1
+            self._totalDepth += depth * function.count
+            if depth > self.maxDepth:
+                self.maxDepth = depth
+            if function.calls:
+                self._totalFanOut += sum(call.count for call in function.calls)
+                self._callingCallCount += min(function.count, max(sum(call.callsPerParent.itervalues()) for call in function.calls))
+                fanOut = sum(call.mostCallsPerParent() for call in function.calls)
+                if fanOut > self.maxFanOut:
+                    self.maxFanOut = fanOut
+                    self.maxFanOutName = name
+            if function.duration is not None:
+                self.timed = True
+                exclusiveTime = function.exclusiveDuration()
+                if activeCallCounts[name] == 0:
+                    self.inclusiveTimeByName[name] += function.duration
+                self.exclusiveTimeByName[name] += exclusiveTime
+                times = self._contextTimes.get(context)
+                if times is None:
+                    times = self._contextTimes[context] = [0, 0]
+                times[0] += function.duration
+                times[1] += exclusiveTime
+            activeCallCounts[name] += 1
+        self.callCount = sum(callCountsByName.itervalues())
+        self.eventCountsByThread["all threads"] += 2 * callCount
+
+    def _enterTimedCall(self, threadId, name):
+        self.timed = True
+        activeCallCounts = self._activeCallCountsByThread.get(threadId)
+        if activeCallCounts is None:
+            activeCallCounts = self._activeCallCountsByThread[threadId] = defaultdict(int)
+        activeCallCounts[name] += 1
+
+    def _exitTimedCall(self, threadId, stack, context, name, duration, callsTime):
+        exclusiveTime = duration - callsTime
+        if stack:
+            stack[-1][4] += duration
+        activeCallCounts = self._activeCallCountsByThread[threadId]
+        activeCallCounts[name] -= 1
+        if activeCallCounts[name] == 0:
+            self.inclusiveTimeByName[name] += duration
+        self.exclusiveTimeByName[name] += exclusiveTime
+        times = self._contextTimes.get(context)
+        if times is None:
+            times = self._contextTimes[context] = [0, 0]
+        times[0] += duration
+        times[1] += exclusiveTime
+
+    # Check that every call exited, and rename function ids (see: record.cpp) using symbols.
+    # Calling contexts are counted by function id, so ids with the same name count separately.
+    def finish(self, symbols = None):
+        for threadId, stack in self._stacksByThread.iteritems():
+            if stack:
+                raise AssertionError("Incorrect nesting found when exiting " + stack[-1][1])
+        if symbols:
+            self.callCountsByName = _renameCounts(self.callCountsByName, symbols)
+            self.maxFanOutName = symbols.get(self.maxFanOutName, self.maxFanOutName)
+            self.inclusiveTimeByName = _renameCounts(self.inclusiveTimeByName, symbols)
+            self.exclusiveTimeByName = _renameCounts(self.exclusiveTimeByName, symbols)
+            self._symbols = symbols
+
+    def uniqueContextCount(self):
+        return len(self._contexts)
+
+    def averageDepth(self):
+        if not self.callCount:
+            return 0.0
+        return float(self._totalDepth) / self.callCount
+
+    # The average fan-out of calls that make calls.
+    def averageFanOut(self):
+        if not self._callingCallCount:
+            return 0.0
+        return float(self._totalFanOut) / self._callingCallCount
+
+    def topCalledNames(self, count):
+        return _topCounts(self.callCountsByName, count)
+
+    # Return the count function names with the most exclusive time as (time, name), most first.
+    def topExclusiveTimeNames(self, count):
+        return _topCounts(self.exclusiveTimeByName, count)
+
+    # Return the count calling contexts with the most inclusive time as (inclusive time, exclusive
+    # time, call name stack), most first.
+    def topInclusiveTimeContexts(self, count):
+        top = heapq.nlargest(count, ((times[0], times[1], context) for context, times in self._contextTimes.iteritems()))
+        if not top:
+            return []
+        parents = {}
+        for (parentContext, name), context in self._contexts.iteritems():
+            parents[context] = (parentContext, name)
+        result = []
+        for inclusiveTime, exclusiveTime, context in top:
+            nameStack = []
+            while context:
+                context, name = parents[context]
+                nameStack.append(self._symbols.get(name, name))
+            nameStack.reverse()
+            result.append((inclusiveTime, exclusiveTime, nameStack))
+        return result
+
+# Compute the stats of a recording on disk in any format (see: cct.loadRecordingFile). If aggregate
+# is set, or the recording is an aggregated recording, which has no events, the recording is loaded
+# as an AggregatedCCT rather than read as events.
+#
+# Otherwise the stats are computed from the recording's cache if useCache is set and the cache was
+# built from the recording (see: CompactCCT.fromRecordFileWithCache), which has no thread ids. If
+# processes is more than 1, the recording is parsed in parallel (writing the cache if useCache is
+# set). Otherwise its events are read in a single pass, which is about as fast as building the
+# cache, so no cache is written.
+def _recordingStats(filename, aggregate = False, processes = 1, useCache = False):
+    stats = RecordingStats()
+    if aggregate or isAggregateRecordingFile(filename):
+        stats.addAggregatedCCT(loadRecordingFile(filename, processes, useCache, aggregate=True))
+        return stats
+    tree = None
+    if useCache:
+        tree = CompactCCT.fromRecordFileCache(filename)
+    if tree is None and processes > 1:
+        tree = loadRecordingFile(filename, processes, useCache)
+    symbols = {}
+    if tree is None:
+        stats.addEvents(recordingFileEvents(filename, symbols))
+    else:
+        stats.addEvents(treeEvents(tree))
+    stats.finish(symbols)
+    return stats
+
+# Format a time in nanoseconds as milliseconds.
+def _formatTime(time):
+    return "{:.3f}ms".format(time / 1e6)
+
+def _statsAsJson(stats, topCalledNames, topTimeNames, topTimeContexts, demangledNames):
+    statsJson = {
+        "calls": stats.callCount,
+        "uniqueContexts": stats.uniqueContextCount(),
+        "maxDepth": stats.maxDepth,
+        "averageDepth": stats.averageDepth(),
+        "maxFanOut": stats.maxFanOut,
+        "maxFanOutName": demangledNames.get(stats.maxFanOutName, stats.maxFanOutName),
+        "averageFanOut": stats.averageFanOut(),
+        "eventsByThread": stats.eventCountsByThread,
+        "topCalledFunctions": [{"name": demangledNames[name], "calls": count} for count, name in topCalledNames],
+    }
+    if stats.timed:
+        statsJson["topExclusiveTimeFunctions"] = [{"name": demangledNames[name], "exclusiveTime": time, "inclusiveTime": stats.inclusiveTimeByName[name]} for time, name in topTimeNames]
+        statsJson["topInclusiveTimeContexts"] = [{"callStack": [demangledNames[name] for name in nameStack], "inclusiveTime": inclusiveTime, "exclusiveTime": exclusiveTime} for inclusiveTime, exclusiveTime, nameStack in topTimeContexts]
+    return statsJson
+
+def _printStats(stats, topCalledNames, topTimeNames, topTimeContexts, demangledNames):
+    print "Calls:                   " + str(stats.callCount)
+    print "Unique calling contexts: " + str(stats.uniqueContextCount())
+    print "Maximum depth:           " + str(stats.maxDepth)
+    print "Average depth:           " + "{:.2f}".format(stats.averageDepth())
+    maxFanOut = str(stats.maxFanOut)
+    if stats.maxFanOutName:
+        maxFanOut += " (" + demangledNames.get(stats.maxFanOutName, stats.maxFanOutName) + ")"
+    print "Maximum fan-out:         " + maxFanOut
+    print "Average fan-out:         " + "{:.2f}".format(stats.averageFanOut())
+    print ""
+    print "Events per thread:"
+    for count, threadId in _topCounts(stats.eventCountsByThread, len(stats.eventCountsByThread)):
+        print "{:12}".format(count) + "  " + str(threadId)
+    print ""
+    print "Top called functions:"
+    for count, functionName in topCalledNames:
+        print "{:12}".format(count) + "  " + demangledNames[functionName]
+    if not stats.timed:
+        return
+    print ""
+    print "Top functions by exclusive time (exclusive, inclusive):"
+    for time, functionName in topTimeNames:
+        print "{:>14}".format(_formatTime(time)) + "{:>14}".format(_formatTime(stats.inclusiveTimeByName[functionName])) + "  " + demangledNames[functionName]
+    print ""
+    print "Top calling contexts by inclusive time (inclusive, exclusive):"
+    for inclusiveTime, exclusiveTime, nameStack in topTimeContexts:
+        print "{:>14}".format(_formatTime(inclusiveTime)) + "{:>14}".format(_formatTime(exclusiveTime)) + "  " + " -> ".join(demangledNames[name] for name in nameStack)
 
 def main():
     parser = argparse.ArgumentParser(description="Calling context tree stats")
     parser.add_argument("recording", help="Calling context tree recording")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used to parse the recording's threads")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the parsed recording cached next to it (recording.cctb)")
+    parser.add_argument("--aggregate", action="store_true", help="Load the recording as a tree that merges calls with the same call stack rather than reading its events. Threads are not counted separately, and fan-out is estimated for calls that call several functions")
+    parser.add_argument("-n", "--top", type=int, default=100, help="Number of top functions and calling contexts to print")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Output format")
+    parser.add_argument("-d", "--demangler", help="Demangler")
+    parser.add_argument("--demangle-cache", help="File caching demangled names across runs (default for the built-in demangler: " + DEFAULT_CACHE_FILENAME + ")")
+    addProfileArguments(parser)
     args = parser.parse_args()
+    profiler = profilerFromArguments(args)
 
-    cct = _loadCCT(args.recording)
+    with profiler.phase("read events") as phase:
+        stats = _recordingStats(args.recording, args.aggregate, args.jobs, not args.no_cache)
+    phase.nodes = sum(stats.eventCountsByThread.itervalues())
+    with profiler.phase("find top functions") as phase:
+        topCalledNames = stats.topCalledNames(args.top)
+        topTimeNames = stats.topExclusiveTimeNames(args.top)
+        topTimeContexts = stats.topInclusiveTimeContexts(args.top)
+    phase.nodes = len(stats.callCountsByName)
 
-    print "Top called functions:"
-    for count, functionName in _topCalledFunctionCallNames(cct, 100):
-        print "{:12}".format(count) + "  " + functionName
+    # Only the names that are printed are demangled.
+    with profiler.phase("demangle names") as phase:
+        names = set(functionName for count, functionName in topCalledNames)
+        names.update(functionName for time, functionName in topTimeNames)
+        for inclusiveTime, exclusiveTime, nameStack in topTimeContexts:
+            names.update(nameStack)
+        if stats.maxFanOutName:
+            names.add(stats.maxFanOutName)
+        if args.demangler:
+            demangledNames = Demangler(args.demangler, args.demangle_cache).demangleNames(names)
+        else:
+            demangledNames = tryDemangleNames(Demangler(cacheFilename=args.demangle_cache or DEFAULT_CACHE_FILENAME), names)
+    phase.nodes = len(names)
+
+    with profiler.phase("print stats"):
+        if args.format == "json":
+            print json.dumps(_statsAsJson(stats, topCalledNames, topTimeNames, topTimeContexts, demangledNames), indent=2, sort_keys=True)
+        else:
+            _printStats(stats, topCalledNames, topTimeNames, topTimeContexts, demangledNames)
+
+    reportProfile(profiler, args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,42 @@
+import benchmark
+from cct import CCT, preOrder
+import compare
+import StringIO
+import unittest
+
+class TestBenchmark(unittest.TestCase):
+
+    def _generate(self, eventCount, **options):
+        outFile = StringIO.StringIO()
+        written = benchmark.generateRecording(outFile, eventCount, **options)
+        return written, outFile.getvalue()
+
+    def testGenerateRecording(self):
+        written, record = self._generate(1000, depth=4, fanOut=3, threadCount=3, nameCount=10)
+        # Each thread writes 333 events less its unmatched last event.
+        self.assertEquals(written, 996)
+        self.assertEquals(record.count("\n"), 996)
+        cct = CCT.fromRecord(record)
+        self.assertEquals(sorted(call.name for call in cct.calls), ["_Z7thread0v", "_Z7thread1v", "_Z7thread2v"])
+        self.assertEquals(max(len(function.callStack()) for function in preOrder(cct)), 4)
+        self.assertTrue(set(function.name for function in preOrder(cct.calls[0])) <= set(benchmark._functionNames(10) + ["_Z7thread0v"]))
+        self.assertEquals(self._generate(1000, depth=4, fanOut=3, threadCount=3, nameCount=10)[1], record)
+
+    def testGenerateDivergentRecording(self):
+        recordA = self._generate(2000, seed=1)[1]
+        recordB = self._generate(2000, seed=1, divergenceRate=0.05)[1]
+        self.assertNotEquals(recordA, recordB)
+        cctA = CCT.fromRecord(recordA)
+        cctB = CCT.fromRecord(recordB)
+        self.assertEquals(len(list(preOrder(cctA))), len(list(preOrder(cctB))))
+        self.assertTrue(len(compare._findDivergences(cctA, cctB)) > 0)
+        self.assertEquals(compare._findDivergences(cctA, CCT.fromRecord(self._generate(2000, seed=1)[1])), [])
+
+    def testBaselineChanges(self):
+        results = {"config": {"events": 10}, "stages": {"parse": {"seconds": 1.5}}}
+        self.assertEquals(benchmark._baselineChanges(results, {"config": {"events": 10}, "stages": {"parse": {"seconds": 1.0}}}), {"parse": 50.0})
+        self.assertEquals(benchmark._baselineChanges(results, {"config": {"events": 20}, "stages": {"parse": {"seconds": 1.0}}}), None)
+        self.assertEquals(benchmark._baselineChanges(results, None), None)
+
+if __name__ == "__main__":
+    unittest.main()
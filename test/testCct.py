@@ -1,4 +1,15 @@
-from cct import CCT, Function
+from cct import AggregatedCCT, CCT, CompactCCT, ContextIndex, Function, loadRecordingFile, preOrder, recordingFileEvents
+from cct import _findRecordRuns as cct_findRecordRuns
+from cct import _loadJson as cct_loadJson
+import bz2
+import gzip
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
 import unittest
 
 class TestCCT(unittest.TestCase):
@@ -76,6 +87,84 @@ class TestCCT(unittest.TestCase):
         cct.addCall(secondFn2)
         self.assertEquals(cct.uniqueCallNames(), ["fn2", "fn1"])
 
+    def testContextIndex(self):
+        cct = self._simpleCCT()
+        fn1 = cct.calls[0]
+        fn1.addCall(Function("fn3"))
+        secondFn1 = Function("fn1")
+        secondFn1.addCall(Function("fn3"))
+        cct.addCall(secondFn1)
+        index = ContextIndex(cct)
+        self.assertEquals(len(index), 3)
+
+        fn1Context, fn1Count = index.find(ContextIndex.ROOT_CONTEXT, "fn1")
+        self.assertEquals(fn1Count, 2)
+        self.assertEquals(index.contextOf(fn1), fn1Context)
+        self.assertEquals(index.contextOf(secondFn1), fn1Context)
+
+        # The most calls to fn3 from a single fn1 was 2.
+        fn3Context, fn3Count = index.find(fn1Context, "fn3")
+        self.assertEquals(fn3Count, 2)
+        self.assertEquals(index.contextOf(fn1.calls[1]), fn3Context)
+
+        self.assertEquals(index.find(fn3Context, "fn3"), (None, 0))
+        self.assertEquals(index.find(ContextIndex.ROOT_CONTEXT, "fn3"), (None, 0))
+        self.assertEquals(index.contextOf(cct), ContextIndex.ROOT_CONTEXT)
+
+        # Only calls from the root to fn1 and below are indexed.
+        fn1Index = ContextIndex(cct, (set(), set([("fn1",)])))
+        self.assertEquals(len(fn1Index), 2)
+        self.assertEquals(fn1Index.find(ContextIndex.ROOT_CONTEXT, "fn2"), (None, 0))
+        fn1Context, fn1Count = fn1Index.find(ContextIndex.ROOT_CONTEXT, "fn1")
+        self.assertEquals(fn1Count, 2)
+        self.assertEquals(fn1Index.find(fn1Context, "fn3")[1], 2)
+
+        # Only calls from the root to fn1 and from fn1 to fn3 are indexed.
+        interiorIndex = ContextIndex(cct, (set([("fn1",), ("fn1", "fn3")]), None))
+        self.assertEquals(len(interiorIndex), 2)
+        fn1Context, fn1Count = interiorIndex.find(ContextIndex.ROOT_CONTEXT, "fn1")
+        self.assertEquals(interiorIndex.find(fn1Context, "fn3")[1], 2)
+        self.assertEquals(interiorIndex.find(ContextIndex.ROOT_CONTEXT, "fn2"), (None, 0))
+        self.assertEquals(index.contextOf(Function("fn3")), None)
+
+    def testSubtreeHash(self):
+        record = "entering main\nentering a\nentering b\nexiting b\nentering c\nexiting c\nexiting a\nexiting main\n"
+        reordered = "entering main\nentering a\nentering c\nexiting c\nentering b\nexiting b\nexiting a\nexiting main\n"
+        different = "entering main\nentering a\nentering b\nentering c\nexiting c\nexiting b\nexiting a\nexiting main\n"
+        cct = CCT.fromRecord(record)
+        # Call order does not change the hash, and a CompactCCT hashes the same.
+        self.assertEquals(CCT.fromRecord(reordered).subtreeHash(), cct.subtreeHash())
+        self.assertEquals(CompactCCT.fromRecord(reordered).subtreeHash(), cct.subtreeHash())
+        self.assertEquals(CompactCCT.fromRecord(record).calls[0].calls[0].subtreeHash(), cct.calls[0].calls[0].subtreeHash())
+        self.assertNotEqual(CCT.fromRecord(different).subtreeHash(), cct.subtreeHash())
+        self.assertNotEqual(CompactCCT.fromRecord(different).subtreeHash(), cct.subtreeHash())
+        self.assertEquals(AggregatedCCT.fromRecord(reordered).subtreeHash(), AggregatedCCT.fromRecord(record).subtreeHash())
+
+        # Hashes change when a Function is called or renamed.
+        main = cct.calls[0]
+        hashes = [cct.subtreeHash(), main.subtreeHash()]
+        main.calls[0].calls[0].addCall(Function("d"))
+        self.assertNotEqual(cct.subtreeHash(), hashes[0])
+        self.assertNotEqual(main.subtreeHash(), hashes[1])
+        hashes = [cct.subtreeHash(), main.subtreeHash()]
+        cct._renameFunctions({None: None, "main": "main", "a": "a", "b": "b", "c": "e", "d": "d"})
+        self.assertNotEqual(cct.subtreeHash(), hashes[0])
+        self.assertNotEqual(main.subtreeHash(), hashes[1])
+        tree = CompactCCT.fromRecord(record)
+        hashes = [tree.subtreeHash()]
+        tree._renameFunctions({"main": "main", "a": "a", "b": "b", "c": "e"})
+        self.assertNotEqual(tree.subtreeHash(), hashes[0])
+
+        # The index finds subtrees by context.
+        index = ContextIndex(CCT.fromRecord(reordered))
+        mainContext = index.find(ContextIndex.ROOT_CONTEXT, "main")[0]
+        aContext = index.find(mainContext, "a")[0]
+        other = CCT.fromRecord(record)
+        self.assertTrue(index.hasSubtree(mainContext, other.calls[0]))
+        self.assertTrue(index.hasSubtree(aContext, other.calls[0].calls[0]))
+        self.assertFalse(index.hasSubtree(mainContext, other.calls[0].calls[0]))
+        self.assertFalse(index.hasSubtree(mainContext, CCT.fromRecord(different).calls[0]))
+
     def testJsonEncoding(self):
         cct = self._simpleCCT()
         fn1 = cct.calls[0]
@@ -89,6 +178,42 @@ class TestCCT(unittest.TestCase):
         self.assertEquals(fn1.fromJson(fn1.asJson()).asJson(), fn1.asJson())
         self.assertEquals(cct.fromJson(cct.asJson()).asJson(), cct.asJson())
 
+    def testJsonStreaming(self):
+        # A file object that reads a few bytes at a time, so values span several reads.
+        class SlowFile(object):
+            def __init__(self, string):
+                self._file = io.BytesIO(string)
+            def read(self, size):
+                return self._file.read(3)
+
+        examplesDir = os.path.join(os.path.dirname(__file__), "..", "examples", "chromiumArithmeticBug")
+        with open(os.path.join(examplesDir, "bug.json"), 'r') as inFile:
+            string = inFile.read()
+        cct = CCT.fromJson(string)
+        self.assertEquals(CCT.loadJson(io.BytesIO(string)).asJson(), cct.asJson())
+        self.assertEquals(CCT.loadJson(SlowFile(string)).asJson(), cct.asJson())
+
+        for indent in [None, 2]:
+            outFile = io.BytesIO()
+            cct.dumpJson(outFile, indent)
+            self.assertEquals(outFile.getvalue(), cct.asJson(indent))
+        outFile = io.BytesIO()
+        cct.dumpJson(outFile, compact=True)
+        self.assertTrue(len(outFile.getvalue()) < len(cct.asJson()))
+        self.assertEquals(CCT.loadJson(SlowFile(outFile.getvalue())).asJson(), cct.asJson())
+
+        outFile = io.BytesIO()
+        cct.calls[0].dumpJson(outFile)
+        self.assertEquals(outFile.getvalue(), cct.calls[0].asJson())
+
+        # Values that are not Functions decode as json would decode them.
+        string = '{"x": [1, -2.5e3, 0.5, true, false, null, {}, []], "y": "z"}'
+        self.assertEquals(cct_loadJson(SlowFile(string)), json.loads(string))
+        self.assertEquals(CCT.loadJson(SlowFile('[{"name": "a\\u00e9"}]')).calls[0].name, u"a\u00e9")
+        self.assertEquals(CCT.loadJson(io.BytesIO("[]")).calls, [])
+        for invalid in ['[{"name": "a"}', '[{"name": "a"}] x', '[{"name" "a"}]', '[nul]', '["a]']:
+            self.assertRaises(ValueError, CCT.loadJson, io.BytesIO(invalid))
+
     def testRecordDecoding(self):
         cct = CCT.fromRecord("entering a\nentering b\nentering c\nexiting c\nexiting b\nexiting a\n")
         self.assertEquals(len(cct.calls), 1)
@@ -115,6 +240,195 @@ class TestCCT(unittest.TestCase):
         cct = CCT.fromRecord("tid123 entering a\ntid234 entering b\ntid234 entering c\ntid234 exiting c\ntid234 exiting b\ntid123 exiting a\n")
         self.assertEquals(cct.asJson(), '[{"name": "a"}, {"name": "b", "calls": [{"name": "c"}]}]')
 
+    def testRecordStreamDecoding(self):
+        lines = ["tid1 entering a\n", "tid1 entering b\n", "tid2 entering c\n", "tid2 exiting c\n", "tid1 exiting b\n", "tid1 exiting a\n"]
+        cct = CCT.fromRecordStream(iter(lines))
+        self.assertEquals(cct.asJson(), '[{"name": "a", "calls": [{"name": "b"}]}, {"name": "c"}]')
+        self.assertEquals(cct.asJson(), CCT.fromRecord("".join(lines)).asJson())
+        self.assertRaises(AssertionError, CCT.fromRecordStream, iter(["entering a\n", "exiting b\n"]))
+
+    def testRecordFileDecoding(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            with open(recording, 'w') as outFile:
+                outFile.write("entering a\nentering b\nexiting b\nentering c\nexiting c\nexiting a\n")
+            cct = CCT.fromRecordFile(recording)
+            self.assertEquals(cct.asJson(), '[{"name": "a", "calls": [{"name": "b"}, {"name": "c"}]}]')
+
+            with open(recording, 'w') as outFile:
+                outFile.write("entering a\nentering b\nexiting a\n")
+            self.assertRaises(AssertionError, CCT.fromRecordFile, recording)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testParallelRecordFileDecoding(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            record = "tid1 entering a\ntid2 entering b\ntid3 entering c\ntid2 entering d\ntid2 exiting d\n"
+            record += "tid1 exiting a\ntid3 exiting c\ntid1 entering a\ntid2 exiting b\ntid1 exiting a\n"
+            record += "entering e\nexiting e\n"
+            idRecord = "tid1 entering #0\ntid2 entering #1\ntid2 exiting #1\ntid1 exiting #0\n"
+            idRecord += "symbol 0 0x4005d0 main\nsymbol 1 0x400580 _Z1Av\n"
+            timedRecord = "@1 tid1 entering a\n@2 tid1 entering b\n@3 tid2 entering c\n@5 tid1 exiting b\n@8 tid2 exiting c\n@13 tid1 exiting a\n"
+            for record in [record, idRecord, timedRecord]:
+                with open(recording, 'w') as outFile:
+                    outFile.write(record)
+                expected = CCT.fromRecord(record).asJson()
+                for processes in [2, 3, 8]:
+                    self.assertEquals(CCT.fromRecordFile(recording, processes).asJson(), expected)
+                    self.assertEquals(CompactCCT.fromRecordFile(recording, processes).asJson(), expected)
+            compact = CompactCCT.fromRecordFile(recording, 2)
+            self.assertEquals([call.duration for call in preOrder(compact) if call is not compact], [12, 3, 5])
+
+            # Each thread's runs of lines are found with the number of calls they enter.
+            with open(recording, 'w') as outFile:
+                outFile.write("tid1 entering a\ntid1 entering b\ntid2 entering c\ntid2 exiting c\ntid1 exiting b\ntid1 exiting a\nsymbol 0 0x1 d\n")
+            self.assertEquals(cct_findRecordRuns((recording, 0, os.path.getsize(recording))), ([("tid1", 0, 32, 2), ("tid2", 32, 63, 1), ("tid1", 63, 93, 0)], {"#0": "d"}))
+            self.assertEquals(cct_findRecordRuns((recording, 1, 20))[0], [("tid1", 16, 32, 1)])
+
+            with open(recording, 'w') as outFile:
+                outFile.write("tid1 entering a\ntid2 entering b\ntid2 exiting c\ntid1 exiting d\n")
+            with self.assertRaises(AssertionError) as context:
+                CCT.fromRecordFile(recording, 2)
+            self.assertEquals(str(context.exception), "Incorrect nesting found when exiting c")
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRecordFileCache(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            cacheFilename = recording + ".cctb"
+            record = "tid1 entering a\ntid2 entering b\ntid1 entering c\ntid1 exiting c\ntid2 exiting b\ntid1 exiting a\n"
+            with open(recording, 'w') as outFile:
+                outFile.write(record)
+            expected = CCT.fromRecord(record).asJson()
+            self.assertEquals(CompactCCT.fromRecordFileWithCache(recording).asJson(), expected)
+            self.assertTrue(os.path.exists(cacheFilename))
+
+            cct = CompactCCT.fromCacheFile(cacheFilename, recording)
+            self.assertEquals(cct.asJson(), expected)
+            self.assertEquals(cct.calls[0].callCountToFunctionName("c"), 1)
+            self.assertEquals(CompactCCT.fromRecordFileWithCache(recording).asJson(), expected)
+
+            # A cache is not used once its recording changes.
+            record = "tid1 entering d\ntid1 exiting d\n"
+            with open(recording, 'w') as outFile:
+                outFile.write(record)
+            self.assertEquals(CompactCCT.fromCacheFile(cacheFilename, recording), None)
+            self.assertEquals(CompactCCT.fromRecordFileWithCache(recording).asJson(), '[{"name": "d"}]')
+            self.assertEquals(CompactCCT.fromCacheFile(cacheFilename, recording).asJson(), '[{"name": "d"}]')
+
+            with open(cacheFilename, 'w') as outFile:
+                outFile.write("CCTCACH1")
+            self.assertEquals(CompactCCT.fromCacheFile(cacheFilename, recording), None)
+            self.assertEquals(CompactCCT.fromCacheFile(os.path.join(tempOutputDir, "missing.cctb"), recording), None)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRecordingFileFormats(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            record = "tid1 entering a\ntid2 entering b\ntid1 entering c\ntid1 exiting c\ntid2 exiting b\ntid1 exiting a\n"
+            expected = CCT.fromRecord(record).asJson()
+            binaryRecord = self._binaryRecord([(0, 0, 0), (1, 0, 1), (0, 0, 2), (0, 1, 2), (1, 1, 1), (0, 1, 0)], ["a", "b", "c"])
+            recordings = {"cct.txt": record, "cct.cctr": binaryRecord, "cct.json": CCT.fromRecord(record).asJson(2)}
+            for name, data in recordings.items():
+                recording = os.path.join(tempOutputDir, name)
+                with open(recording, 'wb') as outFile:
+                    outFile.write(data)
+                compressedRecordings = [recording]
+
+                with gzip.open(recording + ".gz", 'wb') as outFile:
+                    outFile.write(data)
+                compressedRecordings.append(recording + ".gz")
+                with bz2.BZ2File(recording + ".bz2", 'wb') as outFile:
+                    outFile.write(data)
+                compressedRecordings.append(recording + ".bz2")
+                if subprocess.call("xz --keep " + recording, shell=True) == 0:
+                    compressedRecordings.append(recording + ".xz")
+
+                for compressedRecording in compressedRecordings:
+                    self.assertEquals(loadRecordingFile(compressedRecording).asJson(), expected)
+                    self.assertEquals(loadRecordingFile(compressedRecording, 2).asJson(), expected)
+                    self.assertEquals(loadRecordingFile(compressedRecording, useCache=True).asJson(), expected)
+                    self.assertEquals(os.path.exists(compressedRecording + ".cctb"), not name.endswith(".json"))
+
+            recording = os.path.join(tempOutputDir, "broken.txt")
+            with gzip.open(recording, 'wb') as outFile:
+                outFile.write("tid1 entering a\ntid1 exiting b\n")
+            self.assertRaises(AssertionError, loadRecordingFile, recording)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRecordDecodingWithSymbols(self):
+        record = "tid1 entering #0\ntid1 entering #1\ntid1 exiting #1\ntid1 entering #1\ntid1 exiting #1\ntid1 exiting #0\n"
+        record += "symbol 0 0x4005d0 main\nsymbol 1 0x400580 _Z1Av\n"
+        for cct in [CCT.fromRecord(record), CompactCCT.fromRecord(record)]:
+            self.assertEquals(cct.asJson(), '[{"name": "main", "calls": [{"name": "_Z1Av"}, {"name": "_Z1Av"}]}]')
+            self.assertEquals(cct.calls[0].callCountToFunctionName("_Z1Av"), 2)
+        self.assertRaises(AssertionError, CCT.fromRecord, "entering #0\nexiting #1\nsymbol 0 0x1 a\nsymbol 1 0x2 a\n")
+
+    # Events are (thread index, exiting, function id), or (thread index, exiting, function id, time)
+    # for a recording with times.
+    def _binaryRecord(self, events, names):
+        if events and len(events[0]) == 4:
+            record = "CCTRECT1"
+            for threadIndex, exiting, functionId, time in events:
+                record += struct.pack("=IIIII", threadIndex, exiting, functionId, time & 0xffffffff, time >> 32)
+        else:
+            record = "CCTRECB1"
+            for threadIndex, exiting, functionId in events:
+                record += struct.pack("=III", threadIndex, exiting, functionId)
+        namesOffset = len(record)
+        for functionId, name in enumerate(names):
+            record += struct.pack("=II", functionId, len(name)) + name
+        return record + struct.pack("=Q", namesOffset) + "CCTSYMB1"
+
+    def testBinaryRecordDecoding(self):
+        record = self._binaryRecord([(0, 0, 0), (1, 0, 1), (1, 0, 2), (1, 1, 2), (0, 0, 2), (0, 1, 2), (1, 1, 1), (0, 1, 0)], ["a", "b", "c"])
+        self.assertEquals(CCT.fromBinaryRecord(record).asJson(), '[{"name": "a", "calls": [{"name": "c"}]}, {"name": "b", "calls": [{"name": "c"}]}]')
+        self.assertEquals(CompactCCT.fromBinaryRecord(record).asJson(), CCT.fromBinaryRecord(record).asJson())
+
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.bin")
+            with open(recording, 'wb') as outFile:
+                outFile.write(record)
+            self.assertEquals(CCT.fromBinaryRecordFile(recording).asJson(), CCT.fromBinaryRecord(record).asJson())
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testMalformedBinaryRecordDecoding(self):
+        self.assertRaises(AssertionError, CCT.fromBinaryRecord, self._binaryRecord([(0, 0, 0)], ["a"]))
+        self.assertRaises(AssertionError, CCT.fromBinaryRecord, self._binaryRecord([(0, 0, 0), (0, 1, 1)], ["a", "b"]))
+        self.assertRaises(AssertionError, CCT.fromBinaryRecord, self._binaryRecord([(0, 0, 0), (1, 1, 0)], ["a"]))
+        # Recordings without the footer are incomplete.
+        self.assertRaises(ValueError, CCT.fromBinaryRecord, self._binaryRecord([(0, 0, 0), (0, 1, 0)], ["a"])[:-8])
+        self.assertRaises(ValueError, CCT.fromBinaryRecord, "entering a\nexiting a\n")
+
+    def testDeepTree(self):
+        # Trees far deeper than the recursion limit can be loaded, traversed and serialized.
+        depth = 100000
+        record = "entering _Z1fv\n" * depth + "entering _Z1gv\nexiting _Z1gv\n" + "exiting _Z1fv\n" * depth
+        for cct in [CCT.fromRecord(record), CompactCCT.fromRecord(record)]:
+            deepest = cct
+            while deepest.calls:
+                deepest = deepest.calls[0]
+            self.assertEquals(len(deepest.callStack()), depth + 1)
+            self.assertEquals(len(ContextIndex(cct)), depth + 1)
+            self.assertTrue(cct.asJson().endswith('{"name": "_Z1gv"}' + ']}' * depth + ']'))
+            self.assertEquals(CompactCCT.fromCCT(cct).asJson(), cct.asJson())
+            outFile = io.BytesIO()
+            cct.dumpJson(outFile, compact=True)
+            self.assertEquals(CCT.loadJson(io.BytesIO(outFile.getvalue())).asJson(), cct.asJson())
+            self.assertEquals(CCT.fromJson(outFile.getvalue()).asJson(), cct.asJson())
+            self.assertEquals(Function.fromJson(cct.calls[0].asJson()).asJson(), cct.calls[0].asJson())
+            cct.demangle("c++filt -n")
+            self.assertEquals(deepest.name, "g()")
+
     def testDemangling(self):
         cct = CCT()
         # Demangling empty recording should not assert.
@@ -144,5 +458,139 @@ class TestCCT(unittest.TestCase):
         fn3 = fn2.calls[0]
         self.assertEquals(fn3.name, "NotMangledAbc")
 
+    def testCompactRecordDecoding(self):
+        record = "tid1 entering a\ntid1 entering b\ntid2 entering c\ntid1 exiting b\ntid1 entering b\ntid1 exiting b\ntid2 exiting c\ntid1 exiting a\n"
+        compact = CompactCCT.fromRecord(record)
+        self.assertEquals(compact.asJson(), CCT.fromRecord(record).asJson())
+        self.assertEquals(len(compact.names), 3)
+
+        a = compact.calls[0]
+        c = compact.calls[1]
+        self.assertEquals(a.name, "a")
+        self.assertEquals(a.parent, compact)
+        self.assertEquals(a.callCountToFunctionName("b"), 2)
+        self.assertEquals(a.callCountToFunctionName("c"), 0)
+        self.assertEquals(a.uniqueCallNames(), ["b"])
+        self.assertEquals(compact.uniqueCallNames(), ["a", "c"])
+        self.assertEquals(a.calls[1].callStack(), [a, a.calls[1]])
+        self.assertEquals(a.calls[1].callNameStack(), ["a", "b"])
+        self.assertEquals(c.callNameStack(), ["c"])
+        self.assertEquals(compact.callStack(), [])
+
+    def testMalformedCompactRecordDecoding(self):
+        self.assertRaises(AssertionError, CompactCCT.fromRecord, "entering a\n")
+        self.assertRaises(AssertionError, CompactCCT.fromRecord, "exiting a\n")
+        self.assertRaises(AssertionError, CompactCCT.fromRecord, "entering a\nexiting b\n")
+        self.assertRaises(AssertionError, CompactCCT.fromRecord, "entering a\nentering b\nexiting a\n")
+
+    def testAggregatedRecordDecoding(self):
+        record = "tid1 entering a\ntid1 entering b\ntid1 exiting b\ntid1 entering b\ntid1 exiting b\ntid1 exiting a\n"
+        record += "tid2 entering a\ntid2 entering b\ntid2 exiting b\ntid2 exiting a\n"
+        for aggregated in [AggregatedCCT.fromRecord(record), AggregatedCCT.fromCCT(CCT.fromRecord(record)), AggregatedCCT.fromCCT(CompactCCT.fromRecord(record))]:
+            self.assertEquals(aggregated.asJson(), '[{"name": "a", "calls": [{"name": "b"}]}]')
+            a = aggregated.calls[0]
+            b = a.calls[0]
+            self.assertEquals(a.count, 2)
+            self.assertEquals(dict(a.callsPerParent), {2: 1})
+            self.assertEquals(aggregated.callCountToFunctionName("a"), 2)
+            self.assertEquals(b.count, 3)
+            self.assertEquals(dict(b.callsPerParent), {1: 1, 2: 1})
+            self.assertEquals(b.mostCallsPerParent(), 2)
+            self.assertEquals(b.callsFromParentsWithMoreCallsThan(1), 2)
+            self.assertEquals(b.callsFromParentsWithMoreCallsThan(0), 3)
+            self.assertEquals(b.callNameStack(), ["a", "b"])
+
+        # Functions renamed to the same name are merged.
+        record = "entering #2\nentering #0\nexiting #0\nentering #1\nexiting #1\nexiting #2\n"
+        record += "symbol 0 0x1 b\nsymbol 1 0x2 b\nsymbol 2 0x3 a\n"
+        aggregated = AggregatedCCT.fromRecord(record)
+        self.assertEquals(aggregated.asJson(), '[{"name": "a", "calls": [{"name": "b"}]}]')
+        self.assertEquals(aggregated.calls[0].callCountToFunctionName("b"), 2)
+
+        self.assertRaises(AssertionError, AggregatedCCT.fromRecord, "entering a\n")
+        self.assertRaises(AssertionError, AggregatedCCT.fromRecord, "exiting a\n")
+        self.assertRaises(AssertionError, AggregatedCCT.fromRecord, "entering a\nentering b\nexiting a\n")
+
+    def testAggregateRecordDecoding(self):
+        record = "tid1 entering a\ntid1 entering b\ntid1 exiting b\ntid1 entering b\ntid1 exiting b\ntid1 exiting a\n"
+        record += "tid2 entering a\ntid2 entering b\ntid2 exiting b\ntid2 exiting a\n"
+        # Each thread's calls are counted separately, and b has two addresses with the same name.
+        aggregateRecord = "CCTAGGR1\nnode 1 0 0 1 1:1 50\nnode 2 1 1 2 2:1 20\nnode 3 0 0 1 1:1 10\nnode 4 3 2 1 1:1 5\n"
+        aggregateRecord += "symbol 0 0x1 a\nsymbol 1 0x2 b\nsymbol 2 0x3 b\n"
+        aggregated = AggregatedCCT.fromAggregateRecord(aggregateRecord)
+        expected = AggregatedCCT.fromRecord(record)
+        self.assertEquals(aggregated.asJson(), expected.asJson())
+        for function, expectedFunction in zip(preOrder(aggregated), preOrder(expected)):
+            self.assertEquals(function.count, expectedFunction.count)
+            self.assertEquals(dict(function.callsPerParent), dict(expectedFunction.callsPerParent))
+        self.assertEquals(aggregated.calls[0].duration, 60)
+        self.assertEquals(aggregated.calls[0].calls[0].duration, 25)
+
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            with gzip.open(recording, 'wb') as outFile:
+                outFile.write(aggregateRecord)
+            self.assertEquals(loadRecordingFile(recording, useCache=True).asJson(), expected.asJson())
+            self.assertFalse(os.path.exists(recording + ".cctb"))
+            self.assertRaises(ValueError, list, recordingFileEvents(recording))
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+        self.assertRaises(ValueError, AggregatedCCT.fromAggregateRecord, "entering a\nexiting a\n")
+        self.assertRaises(ValueError, AggregatedCCT.fromAggregateRecord, "CCTAGGR1\nnode 2 1 0 1 1:1\n")
+
+    def testTimedRecordDecoding(self):
+        record = "@100 tid1 entering a\n@110 tid1 entering b\n@130 tid1 exiting b\n@135 tid1 entering b\n@140 tid1 exiting b\n"
+        record += "@150 tid1 exiting a\n@120 tid2 entering a\n@125 tid2 exiting a\n"
+        for cct in [CCT.fromRecord(record), CompactCCT.fromRecord(record), CompactCCT.fromCCT(CCT.fromRecord(record)), CCT._fromCompactCCT(CompactCCT.fromRecord(record))]:
+            a = cct.calls[0]
+            self.assertEquals([call.duration for call in a.calls], [20, 5])
+            self.assertEquals(a.duration, 50)
+            self.assertEquals(a.exclusiveDuration(), 25)
+            self.assertEquals(cct.calls[1].duration, 5)
+        self.assertEquals(CCT.fromRecord("entering a\nexiting a\n").calls[0].duration, None)
+        self.assertEquals(CompactCCT.fromRecord("entering a\nexiting a\n").calls[0].exclusiveDuration(), None)
+        self.assertRaises(ValueError, CompactCCT.fromRecord, "@1 entering a\nexiting a\n")
+
+        for aggregated in [AggregatedCCT.fromRecord(record), AggregatedCCT.fromCCT(CCT.fromRecord(record)), AggregatedCCT.fromCCT(CompactCCT.fromRecord(record))]:
+            a = aggregated.calls[0]
+            self.assertEquals(a.duration, 55)
+            self.assertEquals(a.calls[0].duration, 25)
+            self.assertEquals(a.exclusiveDuration(), 30)
+
+        binaryRecord = self._binaryRecord([(0, 0, 0, 1 << 40), (0, 0, 1, (1 << 40) + 10), (0, 1, 1, (1 << 40) + 15), (0, 1, 0, (1 << 40) + 20)], ["a", "b"])
+        cct = CCT.fromBinaryRecord(binaryRecord)
+        self.assertEquals(cct.asJson(), '[{"name": "a", "calls": [{"name": "b"}]}]')
+        self.assertEquals(cct.calls[0].duration, 20)
+        self.assertEquals(cct.calls[0].exclusiveDuration(), 15)
+
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            with open(recording, 'w') as outFile:
+                outFile.write(record)
+            compact = CompactCCT.fromRecordFile(recording, 2)
+            self.assertEquals([call.duration for call in compact.calls], [50, 5])
+            self.assertEquals(CompactCCT.fromRecordFileWithCache(recording).calls[0].duration, 50)
+            cached = CompactCCT.fromCacheFile(recording + ".cctb", recording)
+            self.assertEquals([call.duration for call in cached.calls[0].calls], [20, 5])
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testCompactFromCCT(self):
+        cct = self._simpleCCT()
+        compact = CompactCCT.fromCCT(cct)
+        self.assertEquals(compact.asJson(), cct.asJson())
+        self.assertEquals(compact.calls[0].asJson(), cct.calls[0].asJson())
+        with self.assertRaises(ValueError):
+            compact.addCall(Function("fn4"))
+
+    def testCompactDemangling(self):
+        compact = CompactCCT.fromRecord("entering _Z8MangledAv\nentering _Z8MangledBv\nentering NotMangledAbc\nexiting NotMangledAbc\nexiting _Z8MangledBv\nexiting _Z8MangledAv\n")
+        compact.demangle("c++filt -n")
+        self.assertEquals(compact.asJson(), '[{"name": "MangledA()", "calls": [{"name": "MangledB()", "calls": [{"name": "NotMangledAbc"}]}]}]')
+        self.assertEquals(compact.calls[0].callCountToFunctionName("MangledB()"), 1)
+
 if __name__ == "__main__":
     unittest.main()
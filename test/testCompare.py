@@ -1,5 +1,10 @@
-from cct import CCT, Function
+from cct import AggregatedCCT, CCT, CompactCCT, ContextIndex, Function
 import compare
+from demangler import Demangler
+import json
+import random
+import StringIO
+import sys
 import unittest
 
 class TestCompare(unittest.TestCase):
@@ -14,35 +19,83 @@ class TestCompare(unittest.TestCase):
         fn1.addCall(fn3)
         return cct
 
+    # Check for the following relationship between a call stack and a subtree:
+    #     1) foundStack: Do the function names in the stack appear in the subtree in the correct order?
+    #     2) foundStackWithEnoughCalls: Let lastCallName be the name of the last function call in the
+    #        call stack. If lastCallName is called N times by the last call's parent, does the subtree
+    #        contain at least N calls to lastCallName?
+    def _findStack(self, callStack, otherSubtree):
+        function = callStack[-1]
+        # Find every Function in otherSubtree that has the call stack of function's parent.
+        otherParents = [otherSubtree]
+        for call in callStack[:-1]:
+            otherParents = [otherCall for otherParent in otherParents for otherCall in otherParent.calls if otherCall.name == call.name]
+
+        foundStack = False
+        for otherParent in otherParents:
+            callCountToFunctionName = otherParent.callCountToFunctionName(function.name)
+            if callCountToFunctionName < 1:
+                continue
+            foundStack = True
+            if callCountToFunctionName >= function.parent.callCountToFunctionName(function.name):
+                return True, True
+        return foundStack, False
+
+    # The divergence search by call stack, used as a reference for compare._findDivergences.
+    def _findDivergencesBySearch(self, subtree, otherCCT):
+        divergences = []
+        for call in subtree.calls:
+            foundStack, foundStackWithEnoughCalls = self._findStack(call.callStack(), otherCCT)
+            if not foundStack:
+                divergences.append((call, "Equivalent stack was not found."))
+                continue
+            if not foundStackWithEnoughCalls:
+                divergences.append((call, "Did not find sufficient calls to " + call.name + "."))
+            divergences.extend(self._findDivergencesBySearch(call, otherCCT))
+        return divergences
+
+    def _randomCCT(self, random, size):
+        cct = CCT()
+        functions = [cct]
+        for i in range(size):
+            call = Function(random.choice(["fn1", "fn2", "fn3", "fn4"]))
+            random.choice(functions[-4:]).addCall(call)
+            functions.append(call)
+        return cct
+
     def testFindStack(self):
         cct = self._simpleCCT()
         cctOther = self._simpleCCT()
+        otherIndex = ContextIndex(cctOther)
 
         fn1 = cct.calls[0]
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn1.callStack(), cctOther)
-        self.assertTrue(foundStack)
-        self.assertTrue(foundStackWithEnoughCalls)
+        fn1Context = otherIndex.contextOf(fn1)
+        self.assertNotEqual(fn1Context, None)
+        self.assertEquals(otherIndex.find(ContextIndex.ROOT_CONTEXT, "fn1"), (fn1Context, 1))
 
         fn3 = fn1.calls[0]
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn3.callStack(), cctOther)
-        self.assertTrue(foundStack)
-        self.assertTrue(foundStackWithEnoughCalls)
+        fn3Context = otherIndex.contextOf(fn3)
+        self.assertNotEqual(fn3Context, None)
+        self.assertEquals(otherIndex.find(fn1Context, "fn3"), (fn3Context, 1))
 
         fn4 = Function("fn4")
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn4.callStack(), cctOther)
-        self.assertFalse(foundStack)
-        self.assertFalse(foundStackWithEnoughCalls)
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn4.callStack(), cct)
-        self.assertFalse(foundStack)
-        self.assertFalse(foundStackWithEnoughCalls)
+        self.assertEquals(otherIndex.contextOf(fn4), None)
+        self.assertEquals(ContextIndex(cct).contextOf(fn4), None)
+        self.assertEquals(otherIndex.find(ContextIndex.ROOT_CONTEXT, "fn4"), (None, 0))
 
         fn3.addCall(fn4)
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn4.callStack(), cctOther)
-        self.assertFalse(foundStack)
-        self.assertFalse(foundStackWithEnoughCalls)
-        foundStack, foundStackWithEnoughCalls = compare._findStack(fn4.callStack(), cct)
-        self.assertTrue(foundStack)
-        self.assertTrue(foundStackWithEnoughCalls)
+        self.assertEquals(ContextIndex(cctOther).contextOf(fn4), None)
+        self.assertNotEqual(ContextIndex(cct).contextOf(fn4), None)
+        divergences = compare._findDivergences(cct, cctOther)
+        self.assertEquals([(divergence.function, divergence.reason) for divergence in divergences], [(fn4, "Equivalent stack was not found.")])
+        self.assertEquals(compare._findDivergences(cctOther, cct), [])
+
+        # The stack of a second call to fn3 is found, but not with enough calls.
+        secondFn3 = Function("fn3")
+        fn1.addCall(secondFn3)
+        divergences = compare._findDivergences(cct, cctOther)
+        self.assertEquals([(divergence.function, divergence.reason) for divergence in divergences], [(fn3, "Did not find sufficient calls to fn3."), (fn4, "Equivalent stack was not found."), (secondFn3, "Did not find sufficient calls to fn3.")])
+        self.assertEquals(self._findDivergencesBySearch(cct, cctOther), [(divergence.function, divergence.reason) for divergence in divergences])
 
     def testSimpleTreeDivergence(self):
         cctA = self._simpleCCT()
@@ -166,5 +219,263 @@ class TestCompare(unittest.TestCase):
         self.assertEqual(divergences[0].reason, "Equivalent stack was not found.")
         self.assertEqual(divergences[0].function, fn5)
 
+    def testCompactTreeDivergence(self):
+        cctA = CompactCCT.fromRecord("entering fn1\nentering fn3\nexiting fn3\nexiting fn1\nentering fn2\nexiting fn2\n")
+        cctB = CompactCCT.fromRecord("entering fn1\nentering fn3\nexiting fn3\nentering fn3\nexiting fn3\nexiting fn1\nentering fn2\nexiting fn2\n")
+        self.assertEqual(compare._findDivergences(cctA, cctB), [])
+        divergences = compare._findDivergences(cctB, cctA)
+        self.assertEqual(len(divergences), 2)
+        self.assertEqual(divergences[0].function, cctB.calls[0].calls[0])
+        self.assertEqual(divergences[0].reason, "Did not find sufficient calls to fn3.")
+        self.assertEqual(divergences[1].function, cctB.calls[0].calls[1])
+
+        # Compact trees can also be compared against regular trees.
+        self.assertEqual(compare._findDivergences(cctA, self._simpleCCT()), [])
+
+    def testDivergencesMatchStackSearch(self):
+        rand = random.Random(42)
+        for i in range(50):
+            cctA = self._randomCCT(rand, 30)
+            cctB = self._randomCCT(rand, 30)
+            for subtree, otherCCT in [(cctA, cctB), (cctB, cctA), (cctA.calls[0], cctB)]:
+                divergences = [(divergence.function, divergence.reason) for divergence in compare._findDivergences(subtree, otherCCT)]
+                self.assertEqual(divergences, self._findDivergencesBySearch(subtree, otherCCT))
+
+    def testParallelDivergences(self):
+        rand = random.Random(7)
+        for i in range(5):
+            cctA = self._randomCCT(rand, 200)
+            cctB = self._randomCCT(rand, 200)
+            divergencesAB, divergencesBA = compare._findDivergencesInParallel(cctA, cctB, 3)
+            for divergences, subtree, otherCCT in [(divergencesAB, cctA, cctB), (divergencesBA, cctB, cctA)]:
+                expected = [(divergence.function, divergence.reason) for divergence in compare._findDivergences(subtree, otherCCT)]
+                self.assertEqual([(divergence.function, divergence.reason) for divergence in divergences], expected)
+
+            output = []
+            for processes in [1, 3]:
+                stdout = sys.stdout
+                sys.stdout = StringIO.StringIO()
+                try:
+                    compare._printCCTDivergences(cctA, cctB, processes=processes)
+                    output.append(sys.stdout.getvalue())
+                finally:
+                    sys.stdout = stdout
+            self.assertEqual(output[0], output[1])
+
+    def testParallelDivergencesFromMain(self):
+        # Recordings of one thread have a single call from the root, so the calls below it are
+        # sharded instead.
+        rand = random.Random(11)
+        ccts = []
+        for i in range(2):
+            cct = CCT()
+            main = Function("main")
+            cct.addCall(main)
+            functions = [main]
+            for j in range(300):
+                call = Function(rand.choice(["fn1", "fn2", "fn3", "fn4", "fn5", "fn6"]))
+                rand.choice(functions[-4:]).addCall(call)
+                functions.append(call)
+            ccts.append(cct)
+        cctA, cctB = ccts
+        interior, units = compare._shardContexts(cctA, cctB, 12)
+        self.assertTrue(("main",) in interior)
+        self.assertTrue(len(units) >= 12)
+        self.assertTrue(all(nameStack[0] == "main" and len(nameStack) > 1 for nameStack in units))
+        divergencesAB, divergencesBA = compare._findDivergencesInParallel(cctA, cctB, 3)
+        for divergences, subtree, otherCCT in [(divergencesAB, cctA, cctB), (divergencesBA, cctB, cctA)]:
+            expected = [(divergence.function, divergence.reason) for divergence in compare._findDivergences(subtree, otherCCT)]
+            self.assertTrue(expected)
+            self.assertEqual([(divergence.function, divergence.reason) for divergence in divergences], expected)
+
+    def _divergenceCounts(self, divergences):
+        counts = {}
+        for divergence in divergences:
+            key = (tuple(divergence.function.callNameStack()), divergence.reason)
+            counts[key] = counts.get(key, 0) + divergence.count
+        return counts
+
+    def testAggregatedDivergences(self):
+        rand = random.Random(3)
+        for i in range(50):
+            cctA = self._randomCCT(rand, 60)
+            cctB = self._randomCCT(rand, 60)
+            aggregatedA = AggregatedCCT.fromCCT(cctA)
+            aggregatedB = AggregatedCCT.fromCCT(cctB)
+            self.assertEqual(AggregatedCCT.fromCCT(CompactCCT.fromCCT(cctA)).asJson(), aggregatedA.asJson())
+            for subtree, otherCCT, aggregatedSubtree, aggregatedOther in [(cctA, cctB, aggregatedA, aggregatedB), (cctB, cctA, aggregatedB, aggregatedA)]:
+                expected = self._divergenceCounts(compare._findDivergences(subtree, otherCCT))
+                self.assertEqual(self._divergenceCounts(compare._findDivergences(aggregatedSubtree, aggregatedOther)), expected)
+                self.assertEqual(self._divergenceCounts(compare._findDivergences(aggregatedSubtree, otherCCT)), expected)
+                self.assertEqual(self._divergenceCounts(compare._findDivergences(subtree, aggregatedOther)), expected)
+
+        divergencesAB, divergencesBA = compare._findDivergencesInParallel(aggregatedA, aggregatedB, 3)
+        self.assertEqual(self._divergenceCounts(divergencesAB), self._divergenceCounts(compare._findDivergences(cctA, cctB)))
+        self.assertEqual(self._divergenceCounts(divergencesBA), self._divergenceCounts(compare._findDivergences(cctB, cctA)))
+
+        output = []
+        for a, b in [(cctA, cctB), (aggregatedA, aggregatedB)]:
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                compare._printCCTDivergences(a, b)
+                output.append(sorted(sys.stdout.getvalue().split("\n")))
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(output[0], output[1])
+
+    def testTimeChanges(self):
+        recordA = "@0 entering main\n@0 entering a\n@10 exiting a\n@10 entering a\n@20 exiting a\n@20 entering b\n@50 exiting b\n@100 exiting main\n"
+        recordB = "@0 entering main\n@0 entering a\n@40 exiting a\n@40 entering b\n@71 exiting b\n@80 entering c\n@90 exiting c\n@100 exiting main\n"
+        for cctA, cctB in [(CCT.fromRecord(recordA), CCT.fromRecord(recordB)), (AggregatedCCT.fromRecord(recordA), CompactCCT.fromRecord(recordB))]:
+            timeChanges = compare._findTimeChanges(cctA, cctB, 10, 5)
+            self.assertEqual([(timeChange.nameStack, timeChange.durationA, timeChange.durationB) for timeChange in timeChanges], [(["main", "a"], 20, 40)])
+            self.assertEqual(timeChanges[0].percentChange(), 100.0)
+            self.assertEqual(len(compare._findTimeChanges(cctA, cctB, 0, 0)), 3)
+            self.assertEqual(compare._findTimeChanges(cctA, cctB, 101, 0), [])
+
+        self.assertTrue(compare._isTimed(CCT.fromRecord(recordA)))
+        self.assertFalse(compare._isTimed(CCT.fromRecord("entering main\nexiting main\n")))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            compare._printTimeChanges(compare._findTimeChanges(CCT.fromRecord(recordA), CCT.fromRecord(recordB), 10, 5))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, "Time changed from A to B in 1 places:\n  main -> a: 0.000ms -> 0.000ms (+100.0%)\n")
+
+        # Every name in a changed context is demangled, not only the last two.
+        recordA = "@0 entering main\n@0 entering _Z1Av\n@0 entering _Z1Bv\n@0 entering _Z1Cv\n@5000000 exiting _Z1Cv\n@1000000000 exiting _Z1Bv\n@1000000000 exiting _Z1Av\n@1000000000 exiting main\n"
+        recordB = "@0 entering main\n@0 entering _Z1Av\n@0 entering _Z1Bv\n@0 entering _Z1Cv\n@9000000 exiting _Z1Cv\n@1000000000 exiting _Z1Bv\n@1000000000 exiting _Z1Av\n@1000000000 exiting main\n"
+        timeChanges = compare._findTimeChanges(CCT.fromRecord(recordA), CCT.fromRecord(recordB), 10, 0)
+        self.assertEqual([timeChange.nameStack for timeChange in timeChanges], [["main", "_Z1Av", "_Z1Bv", "_Z1Cv"]])
+        demangled = {"_Z1Av": "A()", "_Z1Bv": "B()", "_Z1Cv": "C()"}
+        demangleNames = lambda names: dict((name, demangled.get(name, name)) for name in names)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            compare._printTimeChanges(timeChanges, demangledNames=compare._demangleTimeChangeNames(timeChanges, demangleNames))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, "Time changed from A to B in 1 places:\n  main -> A() -> B() -> C(): 5.000ms -> 9.000ms (+80.0%)\n")
+
+    def testBatchDivergences(self):
+        good = "entering main\nentering a\nexiting a\nexiting main\n"
+        flaky = "entering main\nentering a\nentering c\nexiting c\nexiting a\nexiting main\n"
+        bad = "entering main\nentering a\nentering b\nexiting b\nentering b\nexiting b\nexiting a\nexiting main\n"
+        goodCCTs = [CCT.fromRecord(good), CompactCCT.fromRecord(good), CCT.fromRecord(flaky)]
+        badCCTs = [CCT.fromRecord(bad), AggregatedCCT.fromRecord(bad)]
+        results = []
+        for processes in [1, 3]:
+            badDivergences, goodDivergences, comparisonCount = compare._findBatchDivergences(iter(goodCCTs), iter(badCCTs), processes)
+            self.assertEqual(comparisonCount, 6)
+            results.append(([(divergence.name, divergence.parentName, divergence.comparisons, divergence.count) for divergence in badDivergences], [(divergence.name, divergence.parentName, divergence.comparisons, divergence.count) for divergence in goodDivergences]))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], ([("b", "a", 6, 12)], [("c", "a", 2, 2)]))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            compare._printBatchCCTDivergences(goodCCTs, badCCTs, 0.5)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, "Bad runs diverged from good runs in 1 places:\n  b which was called by a (in 6/6 comparisons, 12 instances)\n")
+
+    # Batch comparisons of summaries must find the same divergences as comparing the CCTs.
+    def testBatchDivergencesMatchCCTDivergences(self):
+        rand = random.Random(5)
+        for i in range(50):
+            cctA = self._randomCCT(rand, 60)
+            cctB = self._randomCCT(rand, 60)
+            batchContexts = compare.BatchContexts()
+            summaryA = batchContexts.summarize(cctA)
+            summaryB = batchContexts.summarize(AggregatedCCT.fromCCT(cctB))
+            for summary, otherSummary, subtree, otherCCT in [(summaryA, summaryB, cctA, cctB), (summaryB, summaryA, cctB, cctA)]:
+                expected = {}
+                for divergence in compare._findDivergences(subtree, otherCCT):
+                    parent = divergence.function.parent
+                    key = (divergence.function.name, parent.name if parent else None)
+                    expected[key] = expected.get(key, 0) + divergence.count
+                self.assertEqual(dict(batchContexts.divergenceCounts(summary, otherSummary)), expected)
+
+    def testJsonLinesDivergences(self):
+        recordA = "entering main\nentering a\nexiting a\nentering b\nexiting b\nexiting main\n"
+        recordB = "entering main\nentering a\nexiting a\nentering a\nexiting a\nentering c\nentering d\nexiting d\nexiting c\nexiting main\n"
+        cctA = CCT.fromRecord(recordA)
+        cctB = CCT.fromRecord(recordB)
+        outFile = StringIO.StringIO()
+        compare._writeCCTDivergencesAsJsonLines(outFile, cctA, cctB, "a.txt", "b.txt", demangleNames=lambda names: dict((name, name.upper()) for name in names))
+        lines = [json.loads(line) for line in outFile.getvalue().splitlines()]
+        self.assertEqual(lines, [
+            {"type": "divergence", "from": "a.txt", "to": "b.txt", "stack": ["MAIN", "B"], "reason": "Equivalent stack was not found.", "count": 1},
+            {"type": "summary", "from": "a.txt", "to": "b.txt", "divergences": 1, "count": 1, "maxDivergencesReached": False, "groups": [{"name": "B", "calledBy": "MAIN", "count": 1}]},
+            {"type": "divergence", "from": "b.txt", "to": "a.txt", "stack": ["MAIN", "A"], "reason": "Did not find sufficient calls to A.", "count": 1},
+            {"type": "divergence", "from": "b.txt", "to": "a.txt", "stack": ["MAIN", "A"], "reason": "Did not find sufficient calls to A.", "count": 1},
+            {"type": "divergence", "from": "b.txt", "to": "a.txt", "stack": ["MAIN", "C"], "reason": "Equivalent stack was not found.", "count": 1},
+            {"type": "summary", "from": "b.txt", "to": "a.txt", "divergences": 3, "count": 3, "maxDivergencesReached": False, "groups": [{"name": "A", "calledBy": "MAIN", "count": 2}, {"name": "C", "calledBy": "MAIN", "count": 1}]},
+        ])
+
+        # The search stops after maxDivergences.
+        outFile = StringIO.StringIO()
+        self.assertEqual(compare._writeDivergencesAsJsonLines(outFile, cctB, cctA, "b.txt", "a.txt", 2), 2)
+        lines = [json.loads(line) for line in outFile.getvalue().splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]["divergences"], 2)
+        self.assertTrue(lines[-1]["maxDivergencesReached"])
+        self.assertEqual(len(compare._findDivergences(cctB, cctA, maxDivergences=2)), 2)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            compare._printCCTDivergences(cctA, cctB, maxDivergences=1)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, "A diverged from B in 1 places:\n  b which was called by main\n  (stopped searching after 1 divergences)\n\n"
+            "B diverged from A in 1 places:\n  a which was called by main\n  (stopped searching after 1 divergences)\n")
+
+    def testLazyDemangling(self):
+        recordA = "entering main\nentering _Z1Av\nentering _Z1Bi\nexiting _Z1Bi\nexiting _Z1Av\nexiting main\n"
+        recordB = "entering main\nentering _Z1Av\nexiting _Z1Av\nentering _Z1Cv\nexiting _Z1Cv\nexiting main\n"
+        output = []
+        for demangleTrees in [True, False]:
+            cctA = CCT.fromRecord(recordA)
+            cctB = CCT.fromRecord(recordB)
+            demangler = Demangler("c++filt -n")
+            demangleNames = demangler.demangleNames
+            if demangleTrees:
+                cctA.demangle(demangler)
+                cctB.demangle(demangler)
+                demangleNames = None
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                compare._printCCTDivergences(cctA, cctB, demangleNames=demangleNames)
+                output.append(sys.stdout.getvalue())
+            finally:
+                sys.stdout = stdout
+            if not demangleTrees:
+                # The CCTs keep their mangled names.
+                self.assertEqual(cctA.calls[0].calls[0].name, "_Z1Av")
+        self.assertEqual(output[0], output[1])
+        self.assertTrue("  B(int) which was called by A()\n" in output[1])
+        self.assertTrue("  C() which was called by main\n" in output[1])
+
+    def testDeepTreeDivergence(self):
+        depth = 100000
+        cctA = CCT.fromRecord("entering f\n" * depth + "exiting f\n" * depth)
+        cctB = CCT.fromRecord("entering f\n" * depth + "entering g\nexiting g\n" + "exiting f\n" * depth)
+        self.assertEqual(compare._findDivergences(cctA, cctB), [])
+        divergences = compare._findDivergences(cctB, cctA)
+        self.assertEqual(len(divergences), 1)
+        self.assertEqual(divergences[0].function.name, "g")
+        self.assertEqual(len(divergences[0].function.callStack()), depth + 1)
+        foundStack, foundStackWithEnoughCalls = self._findStack(divergences[0].function.callStack(), cctA)
+        self.assertFalse(foundStack)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,55 @@
+from cct import CCT, Function
+import demangler
+from demangler import Demangler
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestDemangler(unittest.TestCase):
+
+    def _names(self):
+        return ["_Z8MangledAv", "_ZN3foo3barIiEEvT_", "_Z1fv.cold", "main", "not_mangled", "_Znotmangled", "_GLOBAL__sub_I_main.cpp"]
+
+    def testMatchesCommand(self):
+        expected = demangler.demangleNamesWithCommand("c++filt -n", self._names())
+        self.assertEquals(expected["_Z8MangledAv"], "MangledA()")
+        self.assertEquals(Demangler().demangleNames(self._names()), expected)
+        self.assertEquals(Demangler("c++filt -n").demangleNames(self._names()), expected)
+        self.assertEquals(Demangler().demangleNames([]), {})
+
+    def testInProcessDemangling(self):
+        if demangler._loadCxaDemangle() is None:
+            self.skipTest("The C++ runtime could not be loaded.")
+        # Itanium C++ ABI and plain names do not need a demangler command.
+        names = ["_Z8MangledAv", "_ZN3foo3barIiEEvT_", "main", "not_mangled"]
+        defaultCommand = demangler.DEFAULT_COMMAND
+        demangler.DEFAULT_COMMAND = "c--filt"
+        try:
+            inProcessDemangler = Demangler()
+            self.assertEquals(inProcessDemangler.demangleNames(names)["_ZN3foo3barIiEEvT_"], "void foo::bar<int>(int)")
+            self.assertRaises(AssertionError, inProcessDemangler.demangleNames, ["_Znotmangled"])
+        finally:
+            demangler.DEFAULT_COMMAND = defaultCommand
+
+    def testCache(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            cacheFilename = os.path.join(tempOutputDir, "cache", "demangled-names")
+            expected = Demangler(cacheFilename=cacheFilename).demangleNames(self._names())
+            self.assertTrue(os.path.exists(cacheFilename))
+
+            # Cached names are not demangled again.
+            cachedDemangler = Demangler("c--filt", cacheFilename)
+            self.assertEquals(cachedDemangler.demangleNames(self._names()), expected)
+            self.assertRaises(AssertionError, cachedDemangler.demangleNames, ["_Z1gv"])
+
+            cct = CCT()
+            cct.addCall(Function("_Z8MangledAv"))
+            cct.demangle(cachedDemangler)
+            self.assertEquals(cct.calls[0].name, "MangledA()")
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+if __name__ == "__main__":
+    unittest.main()
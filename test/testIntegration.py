@@ -6,6 +6,11 @@ import unittest
 
 class TestIntegration(unittest.TestCase):
 
+    # Build the example program, which is not checked in.
+    @classmethod
+    def setUpClass(cls):
+        subprocess.check_call(["make", "-s", "test/data/out/brokenQuicksort"])
+
     def testBrokenQuicksortExample(self):
         try:
             # Use a temporary scratch directory.
@@ -33,13 +38,15 @@ class TestIntegration(unittest.TestCase):
             if not os.path.isfile(badRecording):
                 raise AssertionError("Recording was not saved to \"" + badRecording + "\"" + (": " + err if err else ""))
 
-            # Compare the two runs.
-            command = "./compare.py " + goodRecording + " " + badRecording
-            proc = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            out, err = proc.communicate()
-            self.assertEqual("", err)
-            self.assertEqual(badRecording + " diverged from " + goodRecording + " in 1 places:"
-                "\n  swap(int*, int, int) which was called by quicksort(int*, int, int)\n", out)
+            # Compare the two runs, the second time using the cached parsed recordings.
+            command = "./compare.py --demangle-cache " + os.path.join(tempOutputDir, "demangled-names") + " " + goodRecording + " " + badRecording
+            for run in range(2):
+                proc = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+                out, err = proc.communicate()
+                self.assertEqual("", err)
+                self.assertEqual(badRecording + " diverged from " + goodRecording + " in 1 places:"
+                    "\n  swap(int*, int, int) which was called by quicksort(int*, int, int)\n", out)
+                self.assertTrue(os.path.isfile(goodRecording + ".cctb"))
         finally:
             shutil.rmtree(tempOutputDir)
 
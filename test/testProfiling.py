@@ -0,0 +1,99 @@
+from cct import CCT
+import compare
+import json
+import os
+import profiling
+import pstats
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+class TestProfiling(unittest.TestCase):
+
+    def testPhases(self):
+        profiler = profiling.Profiler()
+        with profiler.phase("build") as phase:
+            values = [str(value) for value in range(100000)]
+        phase.nodes = len(values)
+        with profiler.phase("join"):
+            "".join(values)
+        self.assertEquals([phase.name for phase in profiler.phases], ["build", "join"])
+        self.assertEquals(profiler.phases[0].nodes, 100000)
+        self.assertEquals(profiler.phases[1].nodes, None)
+        for phase in profiler.phases:
+            self.assertTrue(phase.wallTime > 0)
+            self.assertTrue(phase.cpuTime >= 0)
+            self.assertTrue(phase.peakRss > 0)
+        self.assertEquals(profiler.wallTime(), profiler.phases[0].wallTime + profiler.phases[1].wallTime)
+
+        # A phase that raises is still measured.
+        try:
+            with profiler.phase("fail"):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(profiler.phases[-1].name, "fail")
+
+    def testDisabledProfiler(self):
+        profiler = profiling.Profiler(enabled=False)
+        with profiler.phase("build") as phase:
+            pass
+        phase.nodes = 1
+        self.assertEquals(profiler.phases, [])
+
+    def testReports(self):
+        profiler = profiling.Profiler()
+        with profiler.phase("build") as phase:
+            phase.nodes = 1234
+        outFile = StringIO.StringIO()
+        profiler.printReport(outFile)
+        lines = outFile.getvalue().split("\n")
+        self.assertTrue(lines[0].startswith("Phase"))
+        self.assertTrue(lines[1].startswith("build"))
+        self.assertTrue("1,234" in lines[1])
+        self.assertTrue(lines[2].startswith("total"))
+
+        outFile = StringIO.StringIO()
+        profiler.printReport(outFile, "json")
+        report = json.loads(outFile.getvalue())
+        self.assertEquals([phase["name"] for phase in report["phases"]], ["build"])
+        self.assertEquals(report["phases"][0]["nodes"], 1234)
+        self.assertEquals(report["peakRss"], profiler.phases[0].peakRss)
+        self.assertFalse("profiledPhase" in report)
+
+    def testSlowestPhaseDump(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            profiler = profiling.Profiler(useCProfile=True)
+            with profiler.phase("fast"):
+                pass
+            with profiler.phase("slow"):
+                sorted(range(200000), reverse=True)
+            filename = os.path.join(tempOutputDir, "slow.prof")
+            self.assertEquals(profiler.dumpSlowestPhase(filename), "slow")
+            self.assertTrue(pstats.Stats(filename).total_calls > 0)
+            self.assertEquals(profiler.asJson()["profiledPhase"], "slow")
+        finally:
+            shutil.rmtree(tempOutputDir)
+        self.assertEquals(profiling.Profiler().dumpSlowestPhase(filename), None)
+
+    def testComparePhases(self):
+        cctA = CCT.fromRecord("entering main\nentering a\nexiting a\nexiting main\n")
+        cctB = CCT.fromRecord("entering main\nentering b\nexiting b\nexiting main\n")
+        self.assertEquals(compare._callCount(cctA), 2)
+        profiler = profiling.Profiler()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            compare._printCCTDivergences(cctA, cctB, demangleNames=lambda names: dict((name, name) for name in names), profiler=profiler)
+            compare._printBatchCCTDivergences([cctA], [cctB], 0.5, profiler=profiler)
+        finally:
+            sys.stdout = stdout
+        self.assertEquals([(phase.name, phase.nodes) for phase in profiler.phases], [
+            ("find divergences", 2), ("demangle names", 3), ("print divergences", None),
+            ("summarize CCT 1", 2), ("summarize CCT 2", 2), ("find divergences", 2), ("print divergences", None)])
+
+if __name__ == "__main__":
+    unittest.main()
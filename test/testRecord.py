@@ -1,4 +1,4 @@
-from cct import CCT, Function
+from cct import AggregatedCCT, CCT, Function, preOrder
 import os
 import shutil
 import subprocess
@@ -7,7 +7,12 @@ import unittest
 
 class TestRecord(unittest.TestCase):
 
-    def _record(self, executable, argsList = None):
+    # Build the test programs, which are not checked in.
+    @classmethod
+    def setUpClass(cls):
+        subprocess.check_call(["make", "-s", "test/data/out/quicksort", "test/data/out/fibonacciThread", "test/data/out/singleInstructionInline", "test/data/out/dynamicLoaderDarwin"])
+
+    def _record(self, executable, argsList = None, extraEnvironment = None):
         try:
             # Use a temporary scratch directory.
             tempOutputDir = tempfile.mkdtemp()
@@ -18,6 +23,8 @@ class TestRecord(unittest.TestCase):
                 command.extend(argsList)
             environment = os.environ.copy()
             environment["RECORD_CCT"] = outputFile
+            if extraEnvironment:
+                environment.update(extraEnvironment)
             proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
             out, err = proc.communicate()
 
@@ -25,7 +32,7 @@ class TestRecord(unittest.TestCase):
             if not os.path.isfile(outputFile):
                 raise AssertionError("Recording not saved to \"" + outputFile + "\"" + (": " + err if err else ""))
 
-            with open (outputFile, 'r') as inFile:
+            with open (outputFile, 'rb') as inFile:
                 record = inFile.read()
             return record
         finally:
@@ -61,5 +68,64 @@ class TestRecord(unittest.TestCase):
         record = self._record("test/data/out/singleInstructionInline")
         self.assertEquals(CCT.fromRecord(record).asJson(), '[{"name": "main", "calls": [{"name": "_Z1Av", "calls": [{"name": "_Z7inlineBv", "calls": [{"name": "_Z1Cv", "calls": [{"name": "_Z1Dv"}]}]}]}]}]')
 
+    def testRecordingWithSymbols(self):
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"])
+        idsRecord = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_FORMAT": "ids"})
+        self.assertEquals(idsRecord.count("symbol "), 5)
+        self.assertEquals(CCT.fromRecord(idsRecord).asJson(), CCT.fromRecord(record).asJson())
+
+    def testRecordingWithFilters(self):
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_INCLUDE": "^(main|quicksort)"})
+        self.assertEquals(CCT.fromRecord(record).asJson(), '[{"name": "main", "calls": [{"name": "_Z9quicksortPiii", "calls": [{"name": "_Z9quicksortPiii"}, {"name": "_Z9quicksortPiii"}]}]}]')
+
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_TRIGGER": "^partition"})
+        self.assertEquals(CCT.fromRecord(record).asJson(), '[{"name": "_Z9partitionPiii", "calls": [{"name": "_Z4swapPiii"}, {"name": "_Z4swapPiii"}]}]')
+
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_MAX_DEPTH": "2"})
+        self.assertEquals(CCT.fromRecord(record).asJson(), '[{"name": "main", "calls": [{"name": "_Z4sortPii"}]}]')
+
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_INCLUDE": "^(swap|main)", "RECORD_CCT_TRIGGER": "^sort", "RECORD_CCT_MAX_DEPTH": "1"})
+        self.assertEquals(CCT.fromRecord(record).asJson(), '[{"name": "_Z4swapPiii"}, {"name": "_Z4swapPiii"}]')
+
+    def testBinaryRecording(self):
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"])
+        binaryRecord = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_FORMAT": "binary"})
+        self.assertEquals(CCT.fromBinaryRecord(binaryRecord).asJson(), CCT.fromRecord(record).asJson())
+
+        record = self._record("test/data/out/fibonacciThread", ["2"], {"RECORD_CCT_FORMAT": "binary"})
+        cct = CCT.fromBinaryRecord(record)
+        threadCalls = [call for call in preOrder(cct) if call.name == "_Z34computeFibonacciUsingJustOneThreadmm"]
+        self.assertEquals(len(threadCalls), 3)
+
+    def _aggregatedContexts(self, aggregated):
+        return sorted((function.callNameStack(), function.count, dict(function.callsPerParent)) for function in preOrder(aggregated))
+
+    def testAggregateRecording(self):
+        for executable, args in [("test/data/out/quicksort", ["3", "1", "2", "5", "4"]), ("test/data/out/fibonacciThread", ["2"])]:
+            expected = AggregatedCCT.fromRecord(self._record(executable, args))
+            aggregated = AggregatedCCT.fromAggregateRecord(self._record(executable, args, {"RECORD_CCT_FORMAT": "aggregate"}))
+            # Threads are merged in a different order, so calls can be in a different order.
+            self.assertEquals(self._aggregatedContexts(aggregated), self._aggregatedContexts(expected))
+
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_FORMAT": "aggregate", "RECORD_CCT_TIMESTAMPS": "1"})
+        aggregated = AggregatedCCT.fromAggregateRecord(record)
+        self.assertTrue(aggregated.calls[0].exclusiveDuration() > 0)
+
+    def testRecordingWithTimes(self):
+        record = self._record("test/data/out/quicksort", ["3", "1", "2"])
+        timedRecord = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_TIMESTAMPS": "1"})
+        self.assertTrue(timedRecord.startswith("@"))
+        cct = CCT.fromRecord(timedRecord)
+        self.assertEquals(cct.asJson(), CCT.fromRecord(record).asJson())
+        for function in preOrder(cct):
+            if function is not cct:
+                self.assertTrue(function.exclusiveDuration() >= 0)
+
+        binaryRecord = self._record("test/data/out/quicksort", ["3", "1", "2"], {"RECORD_CCT_TIMESTAMPS": "1", "RECORD_CCT_FORMAT": "binary"})
+        self.assertTrue(binaryRecord.startswith("CCTRECT1"))
+        cct = CCT.fromBinaryRecord(binaryRecord)
+        self.assertEquals(cct.asJson(), CCT.fromRecord(record).asJson())
+        self.assertTrue(cct.calls[0].duration > 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,14 @@
-from cct import CCT, Function
+from cct import AggregatedCCT, CCT, CompactCCT, Function, preOrder, treeEvents
 from collections import defaultdict
+import gzip
+import heapq
+import os
+import shutil
 import stats
+import StringIO
+import struct
+import sys
+import tempfile
 import unittest
 
 class TestStats(unittest.TestCase):
@@ -15,33 +23,205 @@ class TestStats(unittest.TestCase):
         fn1.addCall(fn3)
         return cct
 
-    def testCountFunctionCallNames(self):
+    # The most called names of a tree as (count, name), counted by walking the tree, used as a
+    # reference for RecordingStats.topCalledNames.
+    def _topCalledNamesByWalk(self, cct, count):
+        countsByName = defaultdict(int)
+        for function in preOrder(cct):
+            if function is not cct:
+                countsByName[function.name] += function.count
+        return heapq.nlargest(count, ((nameCount, name) for name, nameCount in countsByName.iteritems()))
+
+    def _treeStats(self, cct):
+        recordingStats = stats.RecordingStats()
+        recordingStats.addEvents(treeEvents(cct))
+        return recordingStats
+
+    def testCallCounts(self):
         cct = self._simpleCCT()
         cct.addCall(Function("fn1"))
 
-        functionNamesCount = defaultdict(int)
-        stats._countFunctionCallNames(cct, functionNamesCount)
-        self.assertEquals(len(functionNamesCount), 3)
-        self.assertEquals(functionNamesCount["fn1"], 2)
-        self.assertEquals(functionNamesCount["fn2"], 1)
-        self.assertEquals(functionNamesCount["fn3"], 1)
+        recordingStats = self._treeStats(cct)
+        self.assertEquals(recordingStats.callCount, 4)
+        self.assertEquals(dict(recordingStats.callCountsByName), {"fn1": 2, "fn2": 1, "fn3": 1})
 
-    def testTopCalledFunctionCallNames(self):
+    def testTopCalledNames(self):
         cct = self._simpleCCT()
         cct.addCall(Function("fn1"))
+        recordingStats = self._treeStats(cct)
 
         # Check results when count > |calls in tree|.
-        topCalls = stats._topCalledFunctionCallNames(cct, 5)
-        self.assertEquals(len(topCalls), 3)
-        self.assertEquals(topCalls[0], (2, "fn1"))
-        self.assertEquals(topCalls[1], (1, "fn3"))
-        self.assertEquals(topCalls[2], (1, "fn2"))
+        topCalls = recordingStats.topCalledNames(5)
+        self.assertEquals(topCalls, [(2, "fn1"), (1, "fn3"), (1, "fn2")])
+        self.assertEquals(topCalls, self._topCalledNamesByWalk(cct, 5))
 
         # Check results when count < |calls in tree|.
-        topCalls = stats._topCalledFunctionCallNames(cct, 2)
-        self.assertEquals(len(topCalls), 2)
-        self.assertEquals(topCalls[0], (2, "fn1"))
-        self.assertEquals(topCalls[1], (1, "fn3"))
+        topCalls = recordingStats.topCalledNames(2)
+        self.assertEquals(topCalls, [(2, "fn1"), (1, "fn3")])
+        self.assertEquals(topCalls, self._topCalledNamesByWalk(cct, 2))
+
+    def testCompactTopCalledNames(self):
+        cct = self._simpleCCT()
+        cct.addCall(Function("fn1"))
+        compact = CompactCCT.fromCCT(cct)
+        self.assertEquals(self._treeStats(compact).topCalledNames(5), self._treeStats(cct).topCalledNames(5))
+
+    def testDeepTreeTopCalledNames(self):
+        depth = 100000
+        cct = CCT.fromRecord("entering f\n" * depth + "exiting f\n" * depth)
+        self.assertEquals(self._treeStats(cct).topCalledNames(5), [(depth, "f")])
+        self.assertEquals(self._topCalledNamesByWalk(cct, 5), [(depth, "f")])
+
+    def testRecordingStats(self):
+        record = "tid1 entering a\ntid1 entering b\ntid2 entering c\ntid1 exiting b\ntid1 entering b\ntid1 entering c\n"
+        record += "tid1 exiting c\ntid1 exiting b\ntid1 entering c\ntid1 exiting c\ntid2 exiting c\ntid1 exiting a\n"
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            with open(recording, 'w') as outFile:
+                outFile.write(record)
+            compressedRecording = os.path.join(tempOutputDir, "cct.json.gz")
+            with gzip.open(compressedRecording, 'wb') as outFile:
+                outFile.write(CCT.fromRecord(record).asJson())
+
+            for filename in [recording, compressedRecording]:
+                recordingStats = stats._recordingStats(filename)
+                self.assertEquals(recordingStats.callCount, 6)
+                self.assertEquals(recordingStats.topCalledNames(2), [(3, "c"), (2, "b")])
+                self.assertEquals(recordingStats.topCalledNames(2), self._topCalledNamesByWalk(CCT.fromRecord(record), 2))
+                # a, a->b, a->b->c, a->c and c.
+                self.assertEquals(recordingStats.uniqueContextCount(), 5)
+                self.assertEquals(recordingStats.maxDepth, 3)
+                self.assertEquals(recordingStats.averageDepth(), 11.0 / 6)
+                self.assertEquals(recordingStats.maxFanOut, 3)
+                self.assertEquals(recordingStats.maxFanOutName, "a")
+                self.assertEquals(recordingStats.averageFanOut(), 2.0)
+            self.assertEquals(dict(stats._recordingStats(recording).eventCountsByThread), {"tid1": 10, "tid2": 2})
+
+            # A recording's cache and a parallel parse give the same stats, except that the cache
+            # has no thread ids.
+            self.assertEquals(sorted(stats._recordingStats(recording, useCache=True).eventCountsByThread), ["tid1", "tid2"])
+            self.assertFalse(os.path.exists(recording + ".cctb"))
+            parallelStats = stats._recordingStats(recording, processes=2, useCache=True)
+            self.assertTrue(os.path.exists(recording + ".cctb"))
+            cachedStats = stats._recordingStats(recording, useCache=True)
+            for recordingStats in [parallelStats, cachedStats]:
+                self.assertEquals(recordingStats.topCalledNames(2), [(3, "c"), (2, "b")])
+                self.assertEquals(recordingStats.uniqueContextCount(), 5)
+                self.assertEquals(recordingStats.averageDepth(), 11.0 / 6)
+                self.assertEquals(recordingStats.maxFanOut, 3)
+                self.assertEquals(recordingStats.averageFanOut(), 2.0)
+            self.assertEquals(dict(cachedStats.eventCountsByThread), {"no thread": 12})
+
+            # Aggregated trees have the same stats, except that threads are not counted separately.
+            for filename in [recording, compressedRecording]:
+                recordingStats = stats._recordingStats(filename, aggregate=True)
+                self.assertEquals(recordingStats.callCount, 6)
+                self.assertEquals(recordingStats.topCalledNames(2), [(3, "c"), (2, "b")])
+                self.assertEquals(recordingStats.uniqueContextCount(), 5)
+                self.assertEquals(recordingStats.maxDepth, 3)
+                self.assertEquals(recordingStats.averageDepth(), 11.0 / 6)
+                self.assertEquals(recordingStats.maxFanOut, 3)
+                self.assertEquals(recordingStats.maxFanOutName, "a")
+                self.assertEquals(recordingStats.averageFanOut(), 2.0)
+                self.assertEquals(dict(recordingStats.eventCountsByThread), {"all threads": 12})
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRecordingStatsWithSymbols(self):
+        recordingStats = stats.RecordingStats()
+        recordingStats.addEvents([("t", True, "#0", None), ("t", True, "#1", None), ("t", False, "#1", None), ("t", True, "#1", None), ("t", False, "#1", None), ("t", False, "#0", None)])
+        recordingStats.finish({"#0": "main", "#1": "_Z1Av"})
+        self.assertEquals(recordingStats.topCalledNames(5), [(2, "_Z1Av"), (1, "main")])
+        self.assertEquals(recordingStats.maxFanOutName, "main")
+
+        recordingStats = stats.RecordingStats()
+        self.assertRaises(AssertionError, recordingStats.addEvents, [("t", True, "a", None), ("t", False, "b", None)])
+        recordingStats = stats.RecordingStats()
+        recordingStats.addEvents([("t", True, "a", None)])
+        self.assertRaises(AssertionError, recordingStats.finish)
+
+    def testRecordingStatsWithTimes(self):
+        recordingStats = stats.RecordingStats()
+        # a calls b, which calls a recursively.
+        recordingStats.addEvents([("t", True, "#0", 0), ("t", True, "b", 10), ("t", True, "#0", 20), ("t", False, "#0", 25), ("t", False, "b", 40), ("t", False, "#0", 100)])
+        recordingStats.addEvents([("u", True, "b", 0), ("u", False, "b", 7)])
+        recordingStats.finish({"#0": "a"})
+        self.assertTrue(recordingStats.timed)
+        self.assertEquals(dict(recordingStats.inclusiveTimeByName), {"a": 100, "b": 37})
+        self.assertEquals(dict(recordingStats.exclusiveTimeByName), {"a": 75, "b": 32})
+        self.assertEquals(recordingStats.topExclusiveTimeNames(1), [(75, "a")])
+        self.assertEquals(recordingStats.topInclusiveTimeContexts(3), [(100, 70, ["a"]), (30, 25, ["a", "b"]), (7, 7, ["b"])])
+
+        # The events of a timed tree keep its times.
+        treeStats = stats.RecordingStats()
+        treeStats.addEvents(treeEvents(CCT.fromRecord("@0 entering a\n@10 entering b\n@20 entering a\n@25 exiting a\n@40 exiting b\n@100 exiting a\n@0 entering b\n@7 exiting b\n")))
+        self.assertEquals(dict(treeStats.inclusiveTimeByName), dict(recordingStats.inclusiveTimeByName))
+        self.assertEquals(dict(treeStats.exclusiveTimeByName), dict(recordingStats.exclusiveTimeByName))
+        self.assertEquals(treeStats.topInclusiveTimeContexts(3), recordingStats.topInclusiveTimeContexts(3))
+
+        aggregatedStats = stats.RecordingStats()
+        aggregatedStats.addAggregatedCCT(AggregatedCCT._fromEvents([("t", True, "a", 0), ("t", True, "b", 10), ("t", True, "a", 20), ("t", False, "a", 25), ("t", False, "b", 40), ("t", False, "a", 100), ("u", True, "b", 0), ("u", False, "b", 7)]))
+        self.assertTrue(aggregatedStats.timed)
+        self.assertEquals(dict(aggregatedStats.inclusiveTimeByName), dict(recordingStats.inclusiveTimeByName))
+        self.assertEquals(dict(aggregatedStats.exclusiveTimeByName), dict(recordingStats.exclusiveTimeByName))
+        self.assertEquals(aggregatedStats.topInclusiveTimeContexts(3), recordingStats.topInclusiveTimeContexts(3))
+
+        recordingStats = stats.RecordingStats()
+        recordingStats.addEvents([("t", True, "a", None), ("t", False, "a", None)])
+        self.assertFalse(recordingStats.timed)
+        self.assertEquals(recordingStats.topInclusiveTimeContexts(3), [])
+
+    def testAggregateRecordingStats(self):
+        # Aggregated recordings (see: RECORD_CCT_FORMAT in record.cpp) have no events, so their
+        # stats are computed from an AggregatedCCT, with or without --aggregate.
+        aggregateRecord = "CCTAGGR1\nnode 1 0 0 1 1:1 50\nnode 2 1 1 2 2:1 20\nnode 3 0 0 1 1:1 10\nnode 4 3 2 1 1:1 5\n"
+        aggregateRecord += "symbol 0 0x1 a\nsymbol 1 0x2 b\nsymbol 2 0x3 b\n"
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.txt")
+            with gzip.open(recording, 'wb') as outFile:
+                outFile.write(aggregateRecord)
+            for aggregate in [False, True]:
+                recordingStats = stats._recordingStats(recording, aggregate)
+                self.assertEquals(recordingStats.topCalledNames(2), [(3, "b"), (2, "a")])
+                self.assertEquals(recordingStats.uniqueContextCount(), 2)
+                self.assertEquals(recordingStats.maxDepth, 2)
+                self.assertEquals(recordingStats.maxFanOut, 2)
+                self.assertEquals(dict(recordingStats.eventCountsByThread), {"all threads": 10})
+                self.assertEquals(recordingStats.topInclusiveTimeContexts(2), [(60, 35, ["a"]), (25, 25, ["a", "b"])])
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testBinaryRecordingStats(self):
+        # Binary recordings (see: RECORD_CCT_FORMAT in record.cpp) number their threads.
+        events = [(0, 0, 0), (1, 0, 1), (1, 1, 1), (0, 0, 1), (0, 1, 1), (0, 1, 0)]
+        record = "CCTRECB1"
+        for threadIndex, exiting, functionId in events:
+            record += struct.pack("=III", threadIndex, exiting, functionId)
+        namesOffset = len(record)
+        for functionId, name in enumerate(["main", "b"]):
+            record += struct.pack("=II", functionId, len(name)) + name
+        record += struct.pack("=Q", namesOffset) + "CCTSYMB1"
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            recording = os.path.join(tempOutputDir, "cct.bin")
+            with open(recording, 'wb') as outFile:
+                outFile.write(record)
+            recordingStats = stats._recordingStats(recording)
+            self.assertEquals(recordingStats.topCalledNames(2), [(2, "b"), (1, "main")])
+            self.assertEquals(dict(recordingStats.eventCountsByThread), {0: 4, 1: 2})
+
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                stats._printStats(recordingStats, recordingStats.topCalledNames(2), [], [], {"b": "b", "main": "main"})
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertTrue("Events per thread:\n           4  0\n           2  1\n" in output)
+        finally:
+            shutil.rmtree(tempOutputDir)
 
 if __name__ == "__main__":
     unittest.main()